@@ -24,6 +24,14 @@ Adjustments:
 - Crispy: Configured to use Bootstrap 5 as the template pack for crispy forms.
 - Strava Integration: Added authentication backends and settings for Strava integration.
 - Social Auth Pipeline: Custom pipeline for handling social authentication and Strava profile data.
+- Strava Rate Limits: STRAVA_RATE_LIMIT_15MIN and STRAVA_RATE_LIMIT_DAILY are the app's Strava limits until Strava reports them.
+- Strava Background Share: STRAVA_BACKGROUND_SHARE is the share of each Strava limit background calls may use.
+- Cache: CACHE_BACKEND and CACHE_LOCATION choose the cache shared by the processes (Strava tokens and rate limits).
+- Strava API: STRAVA_API_BASE_URL is where the Strava API is called, e.g. a fake Strava (`manage.py run_fake_strava`).
+- Strava Webhook: STRAVA_WEBHOOK_VERIFY_TOKEN is the token Strava echoes when validating the webhook subscription.
+- Job Queue: JOB_QUEUE_EAGER runs background jobs as soon as they are enqueued instead of in `manage.py run_worker`.
+- Runner Context: RUNNER_CONTEXT_CACHE_TIMEOUT caches each runner's plan and Strava profile for that many seconds (0 disables it).
+- Plan Storage: PLAN_STORAGE chooses whether new plans store a row per run ("materialized") or compute runs on read ("virtual").
 """
 
 import os
@@ -68,6 +76,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'training_plan.middleware.RunnerContextMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'social_django.middleware.SocialAuthExceptionMiddleware',
@@ -110,6 +119,15 @@ DATABASES = {
     }
 }
 
+# Cache: the default is per process; use a shared backend with an atomic incr (Redis or Memcached) when running
+# several processes, so they share the Strava tokens and rate limit budget
+CACHES = {
+    'default': {
+        'BACKEND': config("CACHE_BACKEND", default="django.core.cache.backends.locmem.LocMemCache"),
+        'LOCATION': config("CACHE_LOCATION", default=""),
+    }
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -175,6 +193,16 @@ SOCIAL_AUTH_LOGIN_REDIRECT_URL = "/"
 SOCIAL_AUTH_STRAVA_SCOPE = ['activity:read']
 SOCIAL_AUTH_STRAVA_KEY = config("STRAVA_CLIENT_ID")
 SOCIAL_AUTH_STRAVA_SECRET = config("STRAVA_CLIENT_SECRET")
+# Base URL of the Strava API and OAuth endpoints, e.g. a fake Strava for load tests (see utils/fake_strava.py)
+STRAVA_API_BASE_URL = config("STRAVA_API_BASE_URL", default="https://www.strava.com")
+# Token chosen when creating the Strava webhook subscription
+STRAVA_WEBHOOK_VERIFY_TOKEN = config("STRAVA_WEBHOOK_VERIFY_TOKEN", default="")
+# Requests per 15 minutes and per day allowed to the app, until the X-RateLimit-Limit header says otherwise
+STRAVA_RATE_LIMIT_15MIN = config("STRAVA_RATE_LIMIT_15MIN", default=200, cast=int)
+STRAVA_RATE_LIMIT_DAILY = config("STRAVA_RATE_LIMIT_DAILY", default=2000, cast=int)
+# Share of each limit background calls may use; the default keeps 40 of the 200 calls per 15 minutes for runners
+# loading pages, and can be raised for apps whose runners rarely wait on Strava
+STRAVA_BACKGROUND_SHARE = config("STRAVA_BACKGROUND_SHARE", default=0.8, cast=float)
 
 SOCIAL_AUTH_PIPELINE = (
     'social_core.pipeline.social_auth.social_details',
@@ -188,3 +216,12 @@ SOCIAL_AUTH_PIPELINE = (
     'social_core.pipeline.user.user_details',
     'training_plan.utils.strava_funcs.save_profile',
 )
+
+# Plan storage for new plans: "materialized" or "virtual"
+PLAN_STORAGE = config("PLAN_STORAGE", default="materialized")
+
+# Background jobs run by `manage.py run_worker`; set to True to run them when enqueued instead
+JOB_QUEUE_EAGER = config("JOB_QUEUE_EAGER", default=False, cast=bool)
+
+# Seconds a runner's plan and Strava profile stay cached between requests (see utils/runner_context.py), 0 to disable
+RUNNER_CONTEXT_CACHE_TIMEOUT = config("RUNNER_CONTEXT_CACHE_TIMEOUT", default=0, cast=int)
@@ -9,6 +9,8 @@ Models Registered:
 - CompletedRun: Model for recording completed runs.
 - ScheduledRun: Model for storing scheduled runs in training plans.
 - StravaUserProfile: Model for storing Strava user profile information.
+- Job: Model for the jobs of the background job queue.
+- StravaWebhookEvent: Model for the events received from the Strava webhook.
 
 Usage:
 - Visit the Django admin site to manage RunnerUser, MarathonPlan, CompletedRun, ScheduledRun, and StravaUserProfile models.
@@ -30,7 +32,8 @@ Note: Ensure that the models are appropriately defined in the 'models.py' file b
 """
 
 from django.contrib import admin
-from .models import RunnerUser, MarathonPlan, ScheduledRun, CompletedRun, StravaUserProfile
+from .models import (RunnerUser, MarathonPlan, ScheduledRun, CompletedRun, StravaUserProfile, Job, StravaWebhookEvent,
+                     ActivityStream)
 
 # Register your models here.
 admin.site.register(RunnerUser)
@@ -38,3 +41,6 @@ admin.site.register(MarathonPlan)
 admin.site.register(CompletedRun)
 admin.site.register(ScheduledRun)
 admin.site.register(StravaUserProfile)
+admin.site.register(Job)
+admin.site.register(StravaWebhookEvent)
+admin.site.register(ActivityStream)
@@ -14,7 +14,7 @@ class TrainingPlanConfig(AppConfig):
 
     Methods:
     - `ready()`: Method called when the app is ready.
-      Ensures that the `templatetags` directory is loaded.
+      Ensures that the `templatetags` directory is loaded, connects the signal handlers and registers the job handlers.
 
     Example:
     ```
@@ -37,9 +37,12 @@ class TrainingPlanConfig(AppConfig):
     def ready(self):
         """
         Method called when the app is ready.
-        Ensures that the `templatetags` directory is loaded.
+        Ensures that the `templatetags` directory is loaded, connects the signal handlers and registers the job handlers.
         """
         try:
             import training_plan.templatetags
         except ImportError:
             pass
+
+        import training_plan.signals  # noqa: F401
+        import training_plan.tasks  # noqa: F401
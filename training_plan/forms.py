@@ -8,7 +8,7 @@ from datetime import date, timedelta
 from crispy_forms.layout import Layout, Submit, Row, Column
 from crispy_forms.helper import FormHelper
 
-from .models import RunnerUser
+from .models import MarathonPlan, RunnerUser
 from .utils import p_a_constants as c
 
 
@@ -172,3 +172,21 @@ class MergedSignUpForm(UserCreationForm):
             raise ValidationError(f"Please enter a valid date of birth")
 
         return birth_date
+
+
+class PlanSettingsForm(forms.ModelForm):
+    """
+    Form letting a runner change the settings of their marathon plan, e.g. opting in to an adaptive plan (see
+    utils/plan_adapt.py).
+
+    Example:
+
+    form = PlanSettingsForm(request.POST, instance=request.runner.plan)
+
+    """
+
+    class Meta:
+        model = MarathonPlan
+        fields = ["adaptive"]
+        labels = {"adaptive": "Adapt my upcoming runs to the runs I complete"}
+        widgets = {"adaptive": forms.CheckboxInput(attrs={"class": "form-check-input"})}
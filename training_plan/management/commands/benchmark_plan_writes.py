@@ -0,0 +1,70 @@
+"""
+Management command that benchmarks how a marathon plan is written to the database.
+
+For a range of plan lengths, the plan is written once with one INSERT per run (batch size of 1, the
+behaviour before plans were bulk created) and once with the default batch size. The number of INSERT
+statements and the wall time of each write are reported. Everything is rolled back afterwards.
+
+Usage:
+python3 manage.py benchmark_plan_writes
+python3 manage.py benchmark_plan_writes --days 90 180 365 --batch-size 100
+"""
+
+import time
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from ...models import RunnerUser
+from ...utils import plan_algo
+from ...utils import p_a_constants as c
+
+
+class Command(BaseCommand):
+    help = "Compare the number of INSERTs needed to write a plan row by row and in batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", nargs="+", type=int, default=[c.MIN_DAYS, 180, c.MAX_DAYS],
+                            help="Plan lengths (days until the marathon) to benchmark.")
+        parser.add_argument("--batch-size", type=int, default=c.BULK_CREATE_BATCH_SIZE,
+                            help="Batch size of the bulk write.")
+        parser.add_argument("--fitness-level", default="intermediate",
+                            choices=[choice[0] for choice in RunnerUser.FITNESS_LEVEL_CHOICES])
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"{'days':>5} {'runs':>5} {'batch':>6} {'inserts':>8} {'ms':>9}")
+
+        for days in options["days"]:
+            for batch_size in (1, options["batch_size"]):
+                runs, inserts, elapsed = self._write_plan(
+                    days, batch_size, options["fitness_level"])
+                self.stdout.write(
+                    f"{days:>5} {runs:>5} {batch_size:>6} {inserts:>8} {elapsed * 1000:>9.1f}")
+
+    def _write_plan(self, days, batch_size, fitness_level):
+        """
+        Write one plan inside a transaction that is always rolled back.
+
+        Returns:
+        - tuple: The number of runs, the number of INSERT statements and the wall time in seconds.
+        """
+
+        with transaction.atomic():
+            user = RunnerUser.objects.create(
+                username="benchmark_plan_writes", dob=date(2000, 1, 1), fitness_level=fitness_level,
+                date_of_marathon=date.today() + timedelta(days=days))
+            new_plan = plan_algo.NewMarathonPlan(user)
+            new_plan.create_plan()
+
+            with CaptureQueriesContext(connection) as queries:
+                start = time.perf_counter()
+                runs = new_plan.create_runs_in_plan(batch_size=batch_size)
+                elapsed = time.perf_counter() - start
+
+            transaction.set_rollback(True)
+
+        inserts = sum(query["sql"].lstrip().upper().startswith("INSERT")
+                      for query in queries.captured_queries)
+        return len(runs), inserts, elapsed
@@ -0,0 +1,184 @@
+"""
+Management command that benchmarks plan generation across fitness levels, plan horizons and start weekdays.
+
+Every case creates a plan with NewMarathonPlan.create_plan and create_runs_in_plan inside a transaction that is
+rolled back afterwards. For each case the wall time (the best of --repeat runs), the number of SQL queries, the
+number of rows written and the peak memory (traced with tracemalloc, in a separate run) are recorded and written to
+a JSON file. Only the queries of plan generation are counted, not those creating the user, and they are counted on
+every run: a case whose runs don't all make the same number of queries fails the command, as its count couldn't be
+compared with a baseline.
+
+A previous results file can be passed as a baseline. Cases that run more queries are reported and the command
+fails. Single cases are too short to time reliably, so the wall time is only compared summed over all the cases,
+and a slow down beyond the tolerance is reported as a warning.
+
+Usage:
+python3 manage.py benchmark_plans
+python3 manage.py benchmark_plans --fitness-level beginner --step 7 --output before.json
+python3 manage.py benchmark_plans --output after.json --baseline before.json --tolerance 0.2 --repeat 10
+"""
+
+import json
+import statistics
+import time
+import tracemalloc
+from datetime import date, datetime, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, reset_queries, transaction
+from django.test.utils import CaptureQueriesContext
+
+from ...models import MarathonPlan, RunnerUser
+from ...utils import plan_algo, plan_compiler
+from ...utils import p_a_constants as c
+
+FIRST_MONDAY = date(2024, 1, 1)
+
+
+class Command(BaseCommand):
+    help = "Benchmark plan generation for every fitness level, plan horizon and start weekday."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--fitness-level", nargs="+", dest="fitness_levels",
+                            default=[choice[0] for choice in RunnerUser.FITNESS_LEVEL_CHOICES],
+                            choices=[choice[0] for choice in RunnerUser.FITNESS_LEVEL_CHOICES])
+        parser.add_argument("--min-days", type=int, default=c.MIN_DAYS)
+        parser.add_argument("--max-days", type=int, default=c.MAX_DAYS)
+        parser.add_argument("--step", type=int, default=1, help="Step between plan horizons, in days.")
+        parser.add_argument("--storage", default=MarathonPlan.MATERIALIZED,
+                            choices=[choice[0] for choice in MarathonPlan.STORAGE_CHOICES])
+        parser.add_argument("--cold", action="store_true",
+                            help="Clear the plan template cache before every case.")
+        parser.add_argument("--repeat", type=int, default=5, help="Timed runs of every case, the best is kept.")
+        parser.add_argument("--no-memory", action="store_true", help="Skip the peak memory run.")
+        parser.add_argument("--output", default="plan_benchmark.json", help="Where to write the results.")
+        parser.add_argument("--baseline", help="Results of a previous run to compare against.")
+        parser.add_argument("--tolerance", type=float, default=0.25,
+                            help="Allowed slow down of the total wall time against the baseline (0.25 is 25%%).")
+
+    def handle(self, *args, **options):
+        if options["repeat"] < 1:
+            raise CommandError("--repeat must be at least 1")
+
+        results = []
+        for fitness_level in options["fitness_levels"]:
+            for days in range(options["min_days"], options["max_days"] + 1, options["step"]):
+                for weekday in range(7):
+                    results.append(self._run_case(fitness_level, days, weekday, options))
+
+            timings = [r["wall_ms"] for r in results if r["fitness_level"] == fitness_level]
+            self.stdout.write(f"{fitness_level}: {len(timings)} cases, median {statistics.median(timings):.2f} ms, "
+                              f"max {max(timings):.2f} ms")
+
+        with open(options["output"], "w") as f:
+            json.dump({
+                "created": datetime.now().isoformat(timespec="seconds"),
+                "database": connection.vendor,
+                "storage": options["storage"],
+                "cold_cache": options["cold"],
+                "results": results,
+            }, f, indent=1)
+        self.stdout.write(self.style.SUCCESS(f"Wrote {len(results)} results to {options['output']}"))
+
+        if options["baseline"]:
+            self._compare(results, options["baseline"], options["tolerance"])
+
+    def _run_case(self, fitness_level, days, weekday, options):
+        """
+        Benchmark a single plan and return its measurements.
+        """
+
+        start = FIRST_MONDAY + timedelta(days=weekday)
+
+        timings, query_counts = [], []
+        for _ in range(options["repeat"]):
+            if options["cold"]:
+                plan_compiler.compile_template.cache_clear()
+            elapsed, queries, rows = self._create_plan(fitness_level, start, days, options["storage"])
+            timings.append(elapsed)
+            query_counts.append(queries)
+
+        if len(set(query_counts)) > 1:
+            raise CommandError(f"{fitness_level} {days} days (weekday {weekday}): the runs made "
+                               f"{', '.join(map(str, query_counts))} queries")
+
+        peak_kib = None
+        if not options["no_memory"]:
+            if options["cold"]:
+                plan_compiler.compile_template.cache_clear()
+            tracemalloc.start()
+            self._create_plan(fitness_level, start, days, options["storage"])
+            peak_kib = round(tracemalloc.get_traced_memory()[1] / 1024, 1)
+            tracemalloc.stop()
+
+        return {
+            "fitness_level": fitness_level,
+            "days": days,
+            "start_weekday": weekday,
+            "wall_ms": round(min(timings) * 1000, 3),
+            "queries": query_counts[0],
+            "rows_written": rows,
+            "peak_kib": peak_kib,
+        }
+
+    def _create_plan(self, fitness_level, start, days, storage):
+        """
+        Create a plan starting on start inside a transaction that is always rolled back.
+
+        Returns:
+        - tuple: The wall time in seconds, the number of queries and the number of rows written (the plan and its
+          runs) of plan generation.
+        """
+
+        with transaction.atomic():
+            user = RunnerUser.objects.create(
+                username="benchmark_plans", dob=date(2000, 1, 1), fitness_level=fitness_level,
+                date_of_marathon=start + timedelta(days=days))
+            new_plan = plan_algo.NewMarathonPlan(user, storage=storage)
+            new_plan.today = start
+
+            reset_queries()  # The query log is bounded, so runs past its limit would capture nothing
+            with CaptureQueriesContext(connection) as queries:
+                begin = time.perf_counter()
+                success, plan = new_plan.create_plan()
+                if not success:
+                    raise CommandError(plan)
+                runs = new_plan.create_runs_in_plan()
+                elapsed = time.perf_counter() - begin
+
+            transaction.set_rollback(True)
+
+        return elapsed, len(queries.captured_queries), 1 + len(runs)
+
+    def _compare(self, results, baseline_path, tolerance):
+        """
+        Report the cases that run more queries than in a baseline, and fail if there are any. The total wall time
+        of the cases in both is compared too, but a slow down only gives a warning.
+        """
+
+        with open(baseline_path) as f:
+            baseline = {(r["fitness_level"], r["days"], r["start_weekday"]): r for r in json.load(f)["results"]}
+
+        regressions = []
+        wall_ms_before = wall_ms_after = 0.0
+        for result in results:
+            before = baseline.get((result["fitness_level"], result["days"], result["start_weekday"]))
+            if before is None:
+                continue
+            if result["queries"] > before["queries"]:
+                regressions.append(f"{result['fitness_level']} {result['days']} days (weekday "
+                                   f"{result['start_weekday']}): {before['queries']} -> {result['queries']} queries")
+            wall_ms_before += before["wall_ms"]
+            wall_ms_after += result["wall_ms"]
+
+        message = f"Total wall time: {wall_ms_before:.1f} -> {wall_ms_after:.1f} ms"
+        if wall_ms_after > wall_ms_before * (1 + tolerance):
+            self.stdout.write(self.style.WARNING(f"{message}, more than {tolerance:.0%} slower"))
+        else:
+            self.stdout.write(message)
+
+        for regression in regressions:
+            self.stdout.write(self.style.WARNING(regression))
+        if regressions:
+            raise CommandError(f"{len(regressions)} regressions against {baseline_path}")
+        self.stdout.write(self.style.SUCCESS(f"No regressions against {baseline_path}"))
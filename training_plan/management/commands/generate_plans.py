@@ -0,0 +1,234 @@
+"""
+Management command that generates the marathon plans of many runners at once, e.g. when a coach or a club
+onboards a group of runners.
+
+The runners are either existing users without a plan, optionally narrowed down with --username or --filter, or the
+rows of a CSV file. Runners in the CSV that don't exist yet are created with an unusable password, so they choose
+one with a password reset. A username repeated in the CSV, or taken by someone else before its batch is written, is
+skipped, so it can't abort its batch.
+
+Plans are compiled across a pool of processes (see plan_compiler.py) and streamed back in order. They are written
+in batches, each batch in one transaction with all of its runs bulk created. The usernames of the runners whose plan
+has been written are appended to the checkpoint file after every batch, so an interrupted run can be resumed.
+
+Usage:
+python3 manage.py generate_plans
+python3 manage.py generate_plans --filter date_joined__gte=2024-01-01 --workers 4
+python3 manage.py generate_plans --csv runners.csv --checkpoint runners.ckpt
+python3 manage.py generate_plans --csv runners.csv --checkpoint runners.ckpt --resume
+python3 manage.py generate_plans --csv runners.csv --dry-run
+"""
+
+import csv
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+
+from django.core.exceptions import FieldError, ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from ...models import MarathonPlan, RunnerUser, ScheduledRun
+from ...utils import plan_algo, plan_compiler
+from ...utils import p_a_constants as c
+
+CSV_FIELDS = ["username", "first_name", "last_name", "email", "dob", "fitness_level", "date_of_marathon"]
+
+
+class Command(BaseCommand):
+    help = "Generate the marathon plans of many runners at once."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--username", nargs="+", dest="usernames", help="Only generate plans for these runners.")
+        parser.add_argument("--filter", nargs="+", dest="filters", default=[], metavar="LOOKUP=VALUE",
+                            help="Only generate plans for the runners matching these lookups.")
+        parser.add_argument("--csv", help=f"CSV file of runners, with the columns {', '.join(CSV_FIELDS)}.")
+        parser.add_argument("--storage", choices=[choice[0] for choice in MarathonPlan.STORAGE_CHOICES],
+                            help="How the runs are stored (defaults to settings.PLAN_STORAGE).")
+        parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                            help="Number of processes compiling the plans.")
+        parser.add_argument("--batch-size", type=int, default=c.GENERATE_PLANS_BATCH_SIZE,
+                            help="Number of plans written per transaction.")
+        parser.add_argument("--checkpoint", help="File recording the runners whose plan has been written.")
+        parser.add_argument("--resume", action="store_true", help="Skip the runners in the checkpoint file.")
+        parser.add_argument("--dry-run", action="store_true",
+                            help="Generate the plans without writing anything and report the throughput.")
+
+    def handle(self, *args, **options):
+        if options["resume"] and not options["checkpoint"]:
+            raise CommandError("--resume needs a --checkpoint file")
+        if options["workers"] < 1 or options["batch_size"] < 1:
+            raise CommandError("--workers and --batch-size must be at least 1")
+
+        done = set()
+        if options["resume"] and os.path.exists(options["checkpoint"]):
+            with open(options["checkpoint"]) as f:
+                done = {line.strip() for line in f if line.strip()}
+
+        runners = self._read_csv(options["csv"]) if options["csv"] else self._query_runners(options)
+
+        plans = []
+        for runner in runners:
+            if runner.username in done:
+                continue
+            new_plan = plan_algo.NewMarathonPlan(runner, storage=options["storage"])
+            try:
+                new_plan._validate_marathon_date()
+            except ValueError as e:
+                self.stderr.write(f"Skipping {runner.username}: {e}")
+                continue
+            plans.append(new_plan)
+
+        if done:
+            self.stdout.write(f"Resuming: {len(done)} runners already have a plan")
+        self.stdout.write(f"Generating {len(plans)} plans with {options['workers']} workers")
+
+        begin = time.perf_counter()
+        count = n_runs = 0
+        batch = []
+        for new_plan, plan_array in self._compile(plans, options["workers"]):
+            batch.append((new_plan, plan_array))
+            if len(batch) == options["batch_size"]:
+                written, runs = self._write_batch(batch, options["dry_run"], options["checkpoint"])
+                count, n_runs = count + written, n_runs + runs
+                batch = []
+                self._report(count, len(plans), begin)
+        if batch:
+            written, runs = self._write_batch(batch, options["dry_run"], options["checkpoint"])
+            count, n_runs = count + written, n_runs + runs
+            self._report(count, len(plans), begin)
+
+        elapsed = time.perf_counter() - begin
+        rate = count / elapsed if elapsed else 0
+        action = "Generated (dry run)" if options["dry_run"] else "Wrote"
+        self.stdout.write(self.style.SUCCESS(
+            f"{action} {count} plans and {n_runs} runs in {elapsed:.2f} s ({rate:.1f} plans/sec)"))
+
+    def _query_runners(self, options):
+        """
+        Get the existing runners without a plan, narrowed down by --username and --filter.
+        """
+
+        runners = RunnerUser.objects.filter(marathonplan__isnull=True).order_by("id")
+        if options["usernames"]:
+            runners = runners.filter(username__in=options["usernames"])
+
+        try:
+            lookups = dict(item.split("=", 1) for item in options["filters"])
+            return list(runners.filter(**lookups))
+        except ValueError:
+            raise CommandError("Filters must look like LOOKUP=VALUE")
+        except (FieldError, ValidationError) as e:
+            raise CommandError(f"Invalid filter: {e}")
+
+    def _read_csv(self, path):
+        """
+        Read the runners of a CSV file. Existing runners are used as they are; runners that already have a plan
+        are skipped, and the others are validated but only saved along with their plan. Only the first line of a
+        username is used.
+        """
+
+        with open(path, newline="") as f:
+            reader = csv.DictReader(f)
+            missing = set(CSV_FIELDS) - set(reader.fieldnames or [])
+            if missing:
+                raise CommandError(f"{path} is missing the columns {', '.join(sorted(missing))}")
+            rows = list(reader)
+
+        existing = RunnerUser.objects.in_bulk([row["username"] for row in rows], field_name="username")
+        with_plan = set(MarathonPlan.objects.filter(
+            user__username__in=existing).values_list("user__username", flat=True))
+
+        runners = []
+        first_lines = {}
+        for line, row in enumerate(rows, start=2):
+            if row["username"] in first_lines:
+                # Saving the same runner twice would abort the whole batch
+                self.stderr.write(f"Skipping line {line} ({row['username']}): already on line "
+                                  f"{first_lines[row['username']]}")
+                continue
+            first_lines[row["username"]] = line
+            if row["username"] in with_plan:
+                continue
+            runner = existing.get(row["username"])
+            if runner is None:
+                try:
+                    runner = RunnerUser(**{field: row[field] for field in CSV_FIELDS})
+                    runner.dob = date.fromisoformat(row["dob"])
+                    runner.date_of_marathon = date.fromisoformat(row["date_of_marathon"])
+                    runner.set_unusable_password()
+                    runner.full_clean()
+                except (ValueError, ValidationError) as e:
+                    self.stderr.write(f"Skipping line {line} ({row['username']}): {e}")
+                    continue
+            runners.append(runner)
+
+        return runners
+
+    def _compile(self, plans, workers):
+        """
+        Compile the plans across a pool of processes and yield each plan with its compiled array, in order, as
+        soon as it is ready. Virtual plans compute their runs on read, so they aren't compiled.
+        """
+
+        materialized = [new_plan for new_plan in plans if new_plan.storage != MarathonPlan.VIRTUAL]
+        if not materialized:
+            yield from ((new_plan, None) for new_plan in plans)
+            return
+
+        chunksize = max(1, len(materialized) // (workers * 4))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            arrays = pool.map(plan_compiler.compile_plan,
+                              *zip(*(new_plan.compile_args() for new_plan in materialized)), chunksize=chunksize)
+            for new_plan in plans:
+                yield new_plan, None if new_plan.storage == MarathonPlan.VIRTUAL else next(arrays)
+
+    def _write_batch(self, batch, dry_run, checkpoint):
+        """
+        Write a batch of plans, their new runners and all of their runs in one transaction, then record the
+        runners in the checkpoint file. New runners whose username has been taken since the CSV was read are
+        skipped rather than failing the batch.
+
+        Returns:
+        - tuple: The number of plans and the number of runs written.
+        """
+
+        runs = []
+        if dry_run:
+            for new_plan, plan_array in batch:
+                if plan_array is not None:
+                    runs.extend(new_plan.build_runs_from_array(plan_array))
+            return len(batch), len(runs)
+
+        new_usernames = [new_plan.user.username for new_plan, _ in batch if new_plan.user.pk is None]
+        if new_usernames:
+            taken = set(RunnerUser.objects.filter(username__in=new_usernames).values_list("username", flat=True))
+            for username in sorted(taken):
+                self.stderr.write(f"Skipping {username}: the username has been taken")
+            batch = [(new_plan, plan_array) for new_plan, plan_array in batch
+                     if new_plan.user.pk is not None or new_plan.user.username not in taken]
+
+        with transaction.atomic():
+            for new_plan, plan_array in batch:
+                if new_plan.user.pk is None:
+                    new_plan.user.save()
+                new_plan.create_plan()
+                if plan_array is not None:
+                    runs.extend(new_plan.build_runs_from_array(plan_array))
+            ScheduledRun.objects.bulk_create(runs, batch_size=c.BULK_CREATE_BATCH_SIZE)
+
+        if checkpoint:
+            with open(checkpoint, "a") as f:
+                f.writelines(f"{new_plan.user.username}\n" for new_plan, _ in batch)
+
+        return len(batch), len(runs)
+
+    def _report(self, count, total, begin):
+        """
+        Report the progress and the throughput so far.
+        """
+
+        elapsed = time.perf_counter() - begin
+        rate = count / elapsed if elapsed else 0
+        self.stdout.write(f"{count}/{total} plans ({count / total:.0%}), {rate:.1f} plans/sec")
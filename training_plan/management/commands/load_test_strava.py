@@ -0,0 +1,171 @@
+"""
+Management command that load tests the Strava integration against a fake Strava (see utils/fake_strava.py).
+
+Simulated runners with a virtual plan and a linked Strava account log in (which enqueues a sync of their
+activities) and load the index page, then the job queue is run as `manage.py run_worker` would. Further sync rounds
+follow, spread over the simulated days as `manage.py schedule_strava_sync` would enqueue them, the runners loading
+the index page again in every round.
+
+Strava is served in process with the given latency, errors and rate limits, unless --base-url points at a fake
+already running (see run_fake_strava). Everything is written inside a transaction that is rolled back at the end,
+and a local memory cache is used, so the rate limit budget and circuit breaker shared with the app are left alone.
+
+The throughput and error rate of the index page and of the jobs are reported, with the number of calls made to
+Strava per runner per simulated day.
+
+Usage:
+python3 manage.py load_test_strava
+python3 manage.py load_test_strava --users 200 --days 3 --latency 0.1 --error-rate 0.02 --rate-limit 600 30000
+python3 manage.py load_test_strava --base-url http://127.0.0.1:8001
+"""
+
+import re
+import statistics
+import time
+from collections import Counter
+from datetime import date, timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.test import Client
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from ...models import Job, MarathonPlan, RunnerUser, StravaUserProfile
+from ...utils import jobs, metrics, plan_algo, strava_funcs
+from ...utils.fake_strava import FakeStrava
+
+USERNAME_PREFIX = "loadtest-"
+FIRST_ATHLETE_ID = 900_000  # Strava athlete IDs of the simulated runners, clear of real ones
+LOCAL_CACHE = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "load_test"}}
+
+
+class Command(BaseCommand):
+    help = "Load test the Strava sync of simulated runners against a fake Strava."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=20, help="Number of simulated runners.")
+        parser.add_argument("--days", type=int, default=1, help="Number of simulated days.")
+        parser.add_argument("--syncs-per-day", type=int, default=4, help="Sync rounds per simulated day.")
+        parser.add_argument("--history-days", type=int, default=14,
+                            help="Days since the plans started, with runs on Strava.")
+        parser.add_argument("--base-url", help="URL of a running fake Strava (defaults to one started in process).")
+        parser.add_argument("--latency", type=float, default=0.02, help="Seconds added to every Strava response.")
+        parser.add_argument("--error-rate", type=float, default=0.0, help="Share of Strava responses that are 503s.")
+        parser.add_argument("--rate-limit", type=int, nargs=2, metavar=("15MIN", "DAILY"),
+                            help="Strava requests allowed per 15 minutes and per day (no limit by default).")
+        parser.add_argument("--seed", type=int)
+
+    def handle(self, *args, **options):
+        if options["users"] < 1 or options["days"] < 1 or options["syncs_per_day"] < 1:
+            raise CommandError("--users, --days and --syncs-per-day must be at least 1")
+
+        server = None
+        base_url = options["base_url"]
+        if base_url is None:
+            server = FakeStrava(latency=options["latency"], error_rate=options["error_rate"],
+                                rate_limit=options["rate_limit"], history_days=options["history_days"],
+                                seed=options["seed"])
+            base_url = server.url
+
+        metrics.reset()
+        try:
+            with override_settings(STRAVA_API_BASE_URL=base_url, CACHES=LOCAL_CACHE), transaction.atomic():
+                results = self._run(options)
+                transaction.set_rollback(True)
+        finally:
+            if server is not None:
+                server.shutdown()
+                server.server_close()
+
+        self._report(results, options)
+
+    def _run(self, options):
+        """
+        Create the runners and run the sync rounds.
+
+        Returns:
+        - dict: The latencies and statuses of the index pages, and the time spent running jobs.
+        """
+
+        users = [self._create_runner(FIRST_ATHLETE_ID + i, options["history_days"]) for i in range(options["users"])]
+        host = next((host.lstrip(".") for host in settings.ALLOWED_HOSTS if host != "*"), "localhost")
+        clients = []
+        for user in users:
+            client = Client(SERVER_NAME=host)
+            client.force_login(user)  # Enqueues a sync, like a real login
+            clients.append(client)
+
+        results = {"page_latencies": [], "page_statuses": Counter(), "jobs_run": 0, "jobs_seconds": 0.0}
+        rounds = options["days"] * options["syncs_per_day"]
+        start = timezone.now()
+        for i in range(rounds):
+            if i:
+                now = start + timedelta(days=i / options["syncs_per_day"])
+                for user in users:
+                    strava_funcs.enqueue_sync(user, now)
+
+            for client in clients:
+                begin = time.perf_counter()
+                response = client.get("/")
+                results["page_latencies"].append(time.perf_counter() - begin)
+                results["page_statuses"][response.status_code] += 1
+
+            begin = time.perf_counter()
+            results["jobs_run"] += jobs.run_pending()
+            results["jobs_seconds"] += time.perf_counter() - begin
+            self.stdout.write(f"Round {i + 1}/{rounds}: {results['jobs_run']} jobs run")
+
+        results["job_statuses"] = Counter(Job.objects.filter(user__in=users).values_list("status", flat=True))
+        return results
+
+    def _create_runner(self, athlete_id, history_days):
+        """
+        Create a runner with a virtual plan started history_days ago and a Strava account linked to the fake.
+        """
+
+        user = RunnerUser.objects.create(username=f"{USERNAME_PREFIX}{athlete_id}", dob=date(1990, 1, 1),
+                                         fitness_level="intermediate",
+                                         date_of_marathon=date.today() + timedelta(weeks=16))
+        new_plan = plan_algo.NewMarathonPlan(user, storage=MarathonPlan.VIRTUAL)
+        new_plan.today = date.today() - timedelta(days=history_days)
+        success, plan = new_plan.create_plan()
+        if not success:
+            raise CommandError(plan)
+        StravaUserProfile.objects.create(user=user, client_id=athlete_id, strava_access_token=f"fake-{athlete_id}",
+                                         strava_refresh_token=f"refresh-{athlete_id}",
+                                         expires_at=timezone.now() + timedelta(hours=6))
+        return user
+
+    def _report(self, results, options):
+        latencies = sorted(results["page_latencies"])
+        elapsed = sum(latencies)
+        failed = sum(count for status, count in results["page_statuses"].items() if status != 200)
+        self.stdout.write(
+            f"Index: {len(latencies)} pages in {elapsed:.2f} s ({len(latencies) / elapsed:.1f} pages/sec), "
+            f"{failed} failed ({failed / len(latencies):.1%}), median {statistics.median(latencies) * 1000:.1f} ms, "
+            f"p95 {latencies[int(0.95 * (len(latencies) - 1))] * 1000:.1f} ms")
+
+        job_statuses = results["job_statuses"]
+        jobs_seconds = results["jobs_seconds"] or float("inf")
+        self.stdout.write(
+            f"Jobs: {results['jobs_run']} run in {results['jobs_seconds']:.2f} s "
+            f"({results['jobs_run'] / jobs_seconds:.1f} jobs/sec), {job_statuses[Job.DONE]} done, "
+            f"{job_statuses[Job.FAILED]} failed, {job_statuses[Job.PENDING]} waiting to be retried")
+
+        # Every attempt made to Strava is counted by status in the strava.response counter (see strava_client.py)
+        calls, refused = Counter(), 0
+        for key, count in metrics.snapshot()["counters"].items():
+            match = re.fullmatch(r"strava\.response\{endpoint=(.*),status=(.*)\}", key)
+            if match:
+                calls[match.group(2)] += count
+            elif key.startswith("strava.ratelimit.refused"):
+                refused += count
+        total = sum(calls.values())
+        errors = sum(count for status, count in calls.items() if not status.startswith("2"))
+        self.stdout.write(
+            f"Strava: {total} calls, {errors} errors ({errors / max(total, 1):.1%}), "
+            f"{total / options['users'] / options['days']:.1f} calls per runner per day, "
+            f"{refused} refused by the rate limit budget")
+        self.stdout.write(", ".join(f"{status}: {count}" for status, count in sorted(calls.items())))
@@ -0,0 +1,85 @@
+"""
+Management command that refreshes the Strava access tokens that are about to expire, before they lapse.
+Run it on a schedule (e.g. every 10 minutes from cron) so requests and jobs only ever read a valid cached token.
+
+Profiles are scanned through the index on expires_at. Their tokens are refreshed in batches, with a bounded number
+of calls to Strava in flight, and each batch is saved with one UPDATE. The latency of every refresh and the number
+of failures are recorded with the metrics module and reported.
+
+Usage:
+python3 manage.py refresh_strava_tokens
+python3 manage.py refresh_strava_tokens --margin-minutes 30 --batch-size 100 --concurrency 8
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from ...models import StravaUserProfile
+from ...utils import metrics, runner_context, strava_client, strava_funcs, strava_ratelimit
+
+
+class Command(BaseCommand):
+    help = "Refresh the Strava access tokens that are about to expire."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--margin-minutes", type=int, default=30,
+                            help="Refresh the tokens expiring within this many minutes.")
+        parser.add_argument("--batch-size", type=int, default=100, help="Tokens refreshed per batch.")
+        parser.add_argument("--concurrency", type=int, default=8, help="Refreshes in flight at once.")
+
+    def handle(self, *args, **options):
+        expiring = list(StravaUserProfile.objects.filter(
+            expires_at__lte=timezone.now() + timedelta(minutes=options["margin_minutes"])
+        ).order_by("expires_at").values_list("id", flat=True))
+
+        refreshed = failed = 0
+        latencies = []
+        with ThreadPoolExecutor(max_workers=options["concurrency"]) as pool:
+            for i in range(0, len(expiring), options["batch_size"]):
+                profiles = list(StravaUserProfile.objects.filter(id__in=expiring[i:i + options["batch_size"]]))
+
+                updated = []
+                for strava_profile, (token_data, latency) in zip(profiles, pool.map(self._refresh, profiles)):
+                    latencies.append(latency)
+                    if token_data is None:
+                        failed += 1
+                        continue
+                    strava_funcs.apply_token(strava_profile, token_data)
+                    updated.append(strava_profile)
+
+                StravaUserProfile.objects.bulk_update(updated, strava_funcs.TOKEN_FIELDS)
+                for strava_profile in updated:
+                    runner_context.invalidate(strava_profile.user_id)  # The update doesn't send post_save
+                refreshed += len(updated)
+
+        summary = f"Refreshed {refreshed} of {len(expiring)} expiring Strava tokens, {failed} failed"
+        if latencies:
+            latencies.sort()
+            summary += (f" (latency median {latencies[len(latencies) // 2] * 1000:.0f} ms, "
+                        f"max {latencies[-1] * 1000:.0f} ms)")
+        self.stdout.write(self.style.WARNING(summary) if failed else self.style.SUCCESS(summary))
+
+    def _refresh(self, strava_profile):
+        """
+        Request a new token for a profile as a background call, recording the latency and the outcome.
+
+        Returns:
+        - tuple: The token data (None if the refresh failed) and the latency in seconds.
+        """
+
+        begin = time.perf_counter()
+        try:
+            with strava_ratelimit.background():
+                token_data = strava_funcs.request_token(strava_profile)
+        except strava_client.StravaError as e:
+            print(f"Token refresh failed for profile {strava_profile.id}: {e}")
+            token_data = None
+        latency = time.perf_counter() - begin
+
+        metrics.observe("strava.token_refresh", latency)
+        metrics.increment("strava.token_refresh", result="failed" if token_data is None else "refreshed")
+        return token_data, latency
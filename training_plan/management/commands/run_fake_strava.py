@@ -0,0 +1,46 @@
+"""
+Management command that serves a fake Strava (see utils/fake_strava.py), to run the app against it with
+STRAVA_API_BASE_URL, e.g. for load tests of the app as a whole or offline development.
+
+Runners are linked to the fake by giving their StravaUserProfile the tokens "fake-<athlete id>" and
+"refresh-<athlete id>".
+
+Usage:
+python3 manage.py run_fake_strava
+python3 manage.py run_fake_strava --port 8001 --latency 0.1 --error-rate 0.02 --rate-limit 600 30000
+STRAVA_API_BASE_URL=http://127.0.0.1:8001 python3 manage.py runserver
+"""
+
+import threading
+
+from django.core.management.base import BaseCommand
+
+from ...utils.fake_strava import FakeStrava
+
+
+class Command(BaseCommand):
+    help = "Serve a fake Strava API until interrupted."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8001)
+        parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every response.")
+        parser.add_argument("--error-rate", type=float, default=0.0, help="Share of responses that are 503s.")
+        parser.add_argument("--rate-limit", type=int, nargs=2, metavar=("15MIN", "DAILY"),
+                            help="Requests allowed per 15 minutes and per day (no limit by default).")
+        parser.add_argument("--history-days", type=int, default=30, help="Days of runs of every athlete.")
+        parser.add_argument("--seed", type=int)
+
+    def handle(self, *args, **options):
+        server = FakeStrava(latency=options["latency"], error_rate=options["error_rate"],
+                            rate_limit=options["rate_limit"], history_days=options["history_days"],
+                            seed=options["seed"], host=options["host"], port=options["port"])
+        self.stdout.write(self.style.SUCCESS(f"Fake Strava serving at {server.url}, quit with CONTROL-C"))
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.shutdown()
+            server.server_close()
+            self.stdout.write(f"Served {len(server.requests)} requests")
@@ -0,0 +1,36 @@
+"""
+Management command that runs a worker for the database-backed job queue (see utils/jobs.py).
+
+Usage:
+python3 manage.py run_worker
+python3 manage.py run_worker --once
+"""
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from ...utils import jobs
+
+
+class Command(BaseCommand):
+    help = "Run the background jobs in the job queue."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true", help="Run the jobs that are due, then exit.")
+        parser.add_argument("--sleep", type=float, default=1.0,
+                            help="Seconds to wait before polling again when the queue is empty.")
+
+    def handle(self, *args, **options):
+        self.stdout.write("Worker started")
+        try:
+            while True:
+                count = jobs.run_pending()
+                if count:
+                    self.stdout.write(f"Ran {count} job(s)")
+                if options["once"]:
+                    break
+                if not count:
+                    time.sleep(options["sleep"])
+        except KeyboardInterrupt:
+            self.stdout.write("Worker stopped")
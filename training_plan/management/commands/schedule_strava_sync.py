@@ -0,0 +1,45 @@
+"""
+Management command that enqueues a background sync of the Strava activities of every linked user with a plan.
+Run it on a schedule (e.g. every 15 minutes from cron); the syncs are run by `manage.py run_worker`.
+
+Jobs of a user are enqueued at most once per strava_funcs.SYNC_INTERVAL, so running the command more often is
+harmless. Finished jobs and webhook events older than --purge-days are deleted at the same time.
+
+Usage:
+python3 manage.py schedule_strava_sync
+python3 manage.py schedule_strava_sync --purge-days 7
+
+Example crontab entry:
+*/15 * * * * cd /path/to/MarathonMentor && python3 manage.py schedule_strava_sync
+"""
+
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from ...models import RunnerUser, StravaWebhookEvent
+from ...utils import jobs, strava_funcs
+
+
+class Command(BaseCommand):
+    help = "Enqueue a background sync of the Strava activities of every linked user."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--purge-days", type=int, default=2,
+                            help="Delete the finished jobs and webhook events older than this many days.")
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        users = RunnerUser.objects.filter(stravauserprofile__isnull=False, marathonplan__isnull=False).distinct()
+
+        count = 0
+        for user in users.iterator():
+            strava_funcs.enqueue_sync(user, now)
+            count += 1
+
+        before = now - timedelta(days=options["purge_days"])
+        purged = jobs.purge(before)
+        purged_events = StravaWebhookEvent.objects.filter(received_at__lt=before).delete()[0]
+        self.stdout.write(self.style.SUCCESS(
+            f"Enqueued Strava sync for {count} users, purged {purged} old jobs and {purged_events} old events"))
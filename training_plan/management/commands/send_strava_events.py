@@ -0,0 +1,63 @@
+"""
+Management command that POSTs generated Strava webhook events to a running server, for load runs of the webhook.
+
+The events are generated by utils/strava_events.py for the Strava athletes linked to the app (or the ones given
+with --owner-id), and the latency of every POST is reported.
+
+Usage:
+python3 manage.py send_strava_events --url http://localhost:8000/webhooks/strava
+python3 manage.py send_strava_events --url http://localhost:8000/webhooks/strava --count 5000 --concurrency 16
+"""
+
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.core.management.base import BaseCommand, CommandError
+
+from ...models import StravaUserProfile
+from ...utils import strava_events
+
+
+class Command(BaseCommand):
+    help = "POST generated Strava webhook events to the webhook of a running server."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--url", required=True, help="URL of the webhook.")
+        parser.add_argument("--count", type=int, default=100, help="Number of events.")
+        parser.add_argument("--concurrency", type=int, default=4, help="Number of events sent at once.")
+        parser.add_argument("--duplicate-rate", type=float, default=0.05,
+                            help="Share of events delivered twice.")
+        parser.add_argument("--owner-id", type=int, nargs="+", dest="owner_ids",
+                            help="Strava athlete IDs (defaults to the linked athletes).")
+        parser.add_argument("--seed", type=int)
+
+    def handle(self, *args, **options):
+        owner_ids = options["owner_ids"] or list(
+            StravaUserProfile.objects.exclude(client_id=None).values_list("client_id", flat=True))
+        if not owner_ids:
+            raise CommandError("No Strava athletes to send events for")
+
+        session = requests.Session()
+
+        def send(event):
+            begin = time.perf_counter()
+            response = session.post(options["url"], json=event, timeout=10)
+            return response.status_code, time.perf_counter() - begin
+
+        events = strava_events.generate_events(owner_ids, options["count"], options["duplicate_rate"],
+                                               options["seed"])
+        begin = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options["concurrency"]) as pool:
+            results = list(pool.map(send, events))
+        elapsed = time.perf_counter() - begin
+
+        latencies = sorted(latency for _, latency in results)
+        failed = sum(status != 200 for status, _ in results)
+        self.stdout.write(
+            f"Sent {len(results)} events in {elapsed:.2f} s ({len(results) / elapsed:.1f} events/sec), "
+            f"{failed} failed")
+        self.stdout.write(f"Latency: median {statistics.median(latencies) * 1000:.1f} ms, "
+                          f"p95 {latencies[int(0.95 * (len(latencies) - 1))] * 1000:.1f} ms, "
+                          f"max {latencies[-1] * 1000:.1f} ms")
@@ -0,0 +1,21 @@
+"""
+This module defines the middleware of the training_plan app.
+
+Middleware:
+- RunnerContextMiddleware: Gives every request the lazily loaded plan and Strava profile of its runner.
+"""
+from .utils.runner_context import RunnerContext
+
+
+class RunnerContextMiddleware:
+    """
+    Set request.runner to the RunnerContext of the request's user (see utils/runner_context.py), so views read the
+    runner's plan and Strava profile at most once per request. Must come after AuthenticationMiddleware.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.runner = RunnerContext(request.user)
+        return self.get_response(request)
@@ -0,0 +1,45 @@
+# Generated by Django 4.2.6 on 2026-10-17 10:12
+
+from django.db import migrations, models
+
+
+def copy_fitness_level(apps, schema_editor):
+    """
+    Existing plans were generated for the fitness level their user has now.
+    """
+    MarathonPlan = apps.get_model("training_plan", "MarathonPlan")
+    for plan in MarathonPlan.objects.select_related("user"):
+        plan.fitness_level = plan.user.fitness_level
+        plan.save(update_fields=["fitness_level"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('training_plan', '0006_remove_completedrun_is_completed_and_more'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='completedrun',
+            name='avg_pace',
+            field=models.DurationField(help_text='Please format like mm:ss', verbose_name='Average Pace'),
+        ),
+        migrations.AlterField(
+            model_name='completedrun',
+            name='date',
+            field=models.DateField(help_text='Date when run was completed'),
+        ),
+        migrations.AddField(
+            model_name='marathonplan',
+            name='fitness_level',
+            field=models.CharField(choices=[('beginner', 'Beginner'), ('intermediate', 'Intermediate'), ('advanced', 'Advanced')], default='beginner', max_length=50),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='marathonplan',
+            name='storage',
+            field=models.CharField(choices=[('materialized', 'Materialized'), ('virtual', 'Virtual')], default='materialized', max_length=20),
+        ),
+        migrations.RunPython(copy_fitness_level, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.30 on 2026-10-17 22:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('training_plan', '0009_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='marathonplan',
+            name='adaptive',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='marathonplan',
+            name='distance_scale',
+            field=models.FloatField(default=1.0),
+        ),
+        migrations.AddField(
+            model_name='marathonplan',
+            name='pace_scale',
+            field=models.FloatField(default=1.0),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-17 22:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('training_plan', '0010_marathonplan_adaptive'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stravauserprofile',
+            name='last_synced_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
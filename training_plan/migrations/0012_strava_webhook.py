@@ -0,0 +1,28 @@
+# Generated by Django 4.2.30 on 2026-10-17 23:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('training_plan', '0011_stravauserprofile_last_synced_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StravaWebhookEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event_key', models.CharField(max_length=100, unique=True)),
+                ('owner_id', models.BigIntegerField()),
+                ('payload', models.JSONField()),
+                ('received_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='completedrun',
+            name='strava_activity_id',
+            field=models.BigIntegerField(blank=True, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-17 23:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('training_plan', '0012_strava_webhook'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='stravauserprofile',
+            name='expires_at',
+            field=models.DateTimeField(db_index=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.30 on 2026-10-17 23:11
+
+from django.db import migrations, models
+
+
+def fill_strava_activity_ids(apps, schema_editor):
+    # Runs imported before aggregation came from one activity
+    CompletedRun = apps.get_model("training_plan", "CompletedRun")
+    runs = list(CompletedRun.objects.filter(strava_activity_id__isnull=False))
+    for run in runs:
+        run.strava_activity_ids = [run.strava_activity_id]
+    CompletedRun.objects.bulk_update(runs, ["strava_activity_ids"], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('training_plan', '0013_stravauserprofile_expires_at_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='completedrun',
+            name='strava_activity_ids',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.RunPython(fill_strava_activity_ids, migrations.RunPython.noop),
+    ]
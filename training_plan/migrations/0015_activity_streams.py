@@ -0,0 +1,28 @@
+# Generated by Django 4.2.30 on 2026-10-17 23:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('training_plan', '0014_completedrun_strava_activity_ids'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ActivityStream',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('strava_activity_id', models.BigIntegerField(unique=True)),
+                ('n_samples', models.PositiveIntegerField()),
+                ('data', models.BinaryField()),
+                ('fetched_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='completedrun',
+            name='zone_minutes',
+            field=models.JSONField(blank=True, default=list),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-17 23:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('training_plan', '0015_activity_streams'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='marathonplan',
+            name='version',
+            field=models.PositiveBigIntegerField(default=1),
+        ),
+    ]
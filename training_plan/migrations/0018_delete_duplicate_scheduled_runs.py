@@ -0,0 +1,26 @@
+# Generated by Django 4.2.30 on 2026-10-17 23:51
+
+from django.db import migrations
+from django.db.models import Count
+
+
+def delete_duplicate_runs(apps, schema_editor):
+    # Concurrent writers could store a day twice: the run with a completed run (or else the first one) is kept
+    ScheduledRun = apps.get_model("training_plan", "ScheduledRun")
+    duplicates = ScheduledRun.objects.values("marathon_plan", "date").annotate(n=Count("id")).filter(n__gt=1)
+    for duplicate in duplicates:
+        runs = ScheduledRun.objects.filter(marathon_plan=duplicate["marathon_plan"], date=duplicate["date"])
+        kept = runs.filter(completedrun__isnull=False).order_by("id").first() or runs.order_by("id").first()
+        runs.exclude(pk=kept.pk).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('training_plan', '0016_marathonplan_version'),
+    ]
+
+    operations = [
+        # Only data: the unique constraint is added by the next migration
+        migrations.RunPython(delete_duplicate_runs, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-17 23:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('training_plan', '0018_delete_duplicate_scheduled_runs'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='scheduledrun',
+            constraint=models.UniqueConstraint(fields=('marathon_plan', 'date'), name='unique_scheduled_run_per_day'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.30 on 2026-10-18 00:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('training_plan', '0019_scheduledrun_unique_plan_date'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='marathonplan',
+            name='past_parameters',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name='marathonplan',
+            name='rescheduled_on',
+            field=models.DateField(blank=True, null=True),
+        ),
+    ]
@@ -2,6 +2,7 @@
 This module defines the data models for the training_plan app.
 """
 from django.db import models
+from django.utils import timezone
 from django.contrib.auth.models import AbstractUser, Group, Permission
 from django.contrib.auth.models import UserManager as DefaultUserManager
 
@@ -109,6 +110,7 @@ class StravaUserProfile(models.Model):
     - strava_access_token (CharField): Strava access token.
     - strava_refresh_token (CharField): Strava refresh token.
     - expires_at (DateTimeField): Expiry date and time.
+    - last_synced_at (DateTimeField): Date and time of the last sync of the user's activities.
 
     Example:
     
@@ -121,7 +123,8 @@ class StravaUserProfile(models.Model):
     client_id = models.BigIntegerField(null=True, blank=True)
     strava_access_token = models.CharField(max_length=200)
     strava_refresh_token = models.CharField(max_length=200)
-    expires_at = models.DateTimeField()
+    expires_at = models.DateTimeField(db_index=True)  # Scanned by manage.py refresh_strava_tokens
+    last_synced_at = models.DateTimeField(null=True, blank=True)
 
 
 class MarathonPlan(models.Model):
@@ -129,25 +132,60 @@ class MarathonPlan(models.Model):
     Model representing a training plan for a RunnerUser.
 
     Attributes:
+    - STORAGE_CHOICES (list): Choices for the 'storage' field.
     - id (AutoField): Auto-incremented primary key.
     - user (ForeignKey): Reference to the associated RunnerUser.
-    - start_date (DateField): Start date of the training plan.
+    - start_date (DateField): Start date of the training plan, kept when it is rescheduled.
     - end_date (DateField): End date of the training plan.
+    - fitness_level (CharField): Fitness level the plan was generated for.
+    - storage (CharField): How the scheduled runs of the plan are stored.
+    - adaptive (BooleanField): Whether upcoming runs are adapted to the completed runs (off unless the runner opts
+      in on the settings page).
+    - distance_scale (FloatField): Scale last applied to the distances of the upcoming runs.
+    - pace_scale (FloatField): Scale last applied to the estimated paces of the upcoming runs.
+    - version (PositiveBigIntegerField): Bumped whenever a run of the plan changes (see utils/plan_version.py).
+    - rescheduled_on (DateField): Day the plan was last rescheduled on, which its upcoming runs are generated from.
+    - past_parameters (JSONField): Generation parameters of the runs of a virtual plan before each reschedule.
 
     Example:
     
-    plan = MarathonPlan.objects.create(user=my_runner_user, start_date='2023-01-01', end_date='2023-12-31')
+    plan = MarathonPlan.objects.create(user=my_runner_user, start_date='2023-01-01', end_date='2023-12-31', fitness_level='beginner')
     
 
     Note:
     As of v0.1.0, a user can have only one marathon plan. If you wish to create a new plan for a user, ensure the old one is deleted first
+    - A "materialized" plan has one ScheduledRun row per day.
+    - A "virtual" plan only stores its generation parameters (start_date or rescheduled_on, end_date and
+      fitness_level, and past_parameters once rescheduled); its runs are computed on read by the plan algorithm
+      (see utils/plan_store.py). ScheduledRun rows are only kept for the days that have been overridden, e.g. when
+      a run is completed or linked to Strava.
+    - An "adaptive" plan rescales the next weeks of runs when a run is completed (see utils/plan_adapt.py).
     """
 
+    MATERIALIZED = "materialized"
+    VIRTUAL = "virtual"
+
+    # How the runs are stored
+    STORAGE_CHOICES = [
+        (MATERIALIZED, "Materialized"),
+        (VIRTUAL, "Virtual"),
+    ]
+
     id = models.AutoField(primary_key=True)
     user = models.ForeignKey(
         RunnerUser, on_delete=models.CASCADE)  # The plan for a user
     start_date = models.DateField()  # Start date of plan
     end_date = models.DateField()  # End date of plan - day of the martahon
+    fitness_level = models.CharField(
+        max_length=50, choices=RunnerUser.FITNESS_LEVEL_CHOICES)  # Fitness level the plan was generated for
+    storage = models.CharField(
+        max_length=20, choices=STORAGE_CHOICES, default=MATERIALIZED)
+    adaptive = models.BooleanField(default=False)  # Opted in on the settings page
+    distance_scale = models.FloatField(default=1.0)  # Completed over planned distance
+    pace_scale = models.FloatField(default=1.0)  # Completed over planned pace
+    version = models.PositiveBigIntegerField(default=1)  # ETag of the run APIs
+    rescheduled_on = models.DateField(null=True, blank=True)  # The start_date of the upcoming runs, once rescheduled
+    past_parameters = models.JSONField(default=list, blank=True)  # See utils/plan_reschedule.py
 
     def __str__(self):
         return f"Plan {self.id} for {self.user.username}. (Plan Begins on {self.start_date} and ends on {self.end_date})"
@@ -194,6 +232,7 @@ class ScheduledRun(models.Model):
     - The est_avg_pace field is optional and can be left blank.
     - The date field represents the date of the scheduled run.
     - The est_avg_pace field is the estimated average pace of the run and is expressed as a duration.
+    - Queries should always be scoped to a marathon_plan; (marathon_plan, date) is indexed.
     """
 
     id = models.AutoField(primary_key=True)
@@ -215,6 +254,12 @@ class ScheduledRun(models.Model):
         help_text="Rest time in minutes", default=0)
     sets = models.PositiveIntegerField(help_text="Sets", default=0)
 
+    class Meta:
+        constraints = [
+            # One run per plan and day; runs are always looked up within a single plan by date
+            models.UniqueConstraint(fields=["marathon_plan", "date"], name="unique_scheduled_run_per_day"),
+        ]
+
     def __str__(self):
         formatted_date = self.date.strftime('%d-%m-%Y')
         return f"{self.run} on {formatted_date}"
@@ -230,6 +275,9 @@ class CompletedRun(models.Model):
     - distance (PositiveIntegerField): Distance of the completed run.
     - duration (PositiveIntegerField): Duration of the completed run.
     - avg_pace (DurationField): Average pace of the completed run.
+    - strava_activity_id (BigIntegerField): ID of the (main) Strava activity the run was imported from, if any.
+    - strava_activity_ids (JSONField): IDs of all the Strava activities the run was aggregated from.
+    - zone_minutes (JSONField): Minutes spent in each heart rate zone Z1 to Z5, once computed from the streams.
 
     Example:
     
@@ -245,6 +293,126 @@ class CompletedRun(models.Model):
         help_text="Duration of completed run in minutes")
     avg_pace = models.DurationField(
         verbose_name="Average Pace", help_text="Please format like mm:ss")
+    strava_activity_id = models.BigIntegerField(null=True, blank=True, unique=True)
+    strava_activity_ids = models.JSONField(default=list, blank=True)
+    zone_minutes = models.JSONField(default=list, blank=True)
 
     def __str__(self):
         return f"Completed run on {self.date} with pace {self.avg_pace}"
+
+
+class Job(models.Model):
+    """
+    Model representing a job in the database-backed job queue (see utils/jobs.py).
+
+    Attributes:
+    - STATUS_CHOICES (list): Choices for the 'status' field.
+    - kind (CharField): Name of the handler that runs the job.
+    - user (ForeignKey): Reference to the RunnerUser the job is for, if any.
+    - idempotency_key (CharField): Unique key; enqueueing a job with an existing key returns the existing job.
+    - payload (JSONField): Arguments of the job.
+    - status (CharField): Status of the job.
+    - attempts (PositiveIntegerField): Number of times the job has been started.
+    - max_attempts (PositiveIntegerField): Number of attempts before the job is marked as failed.
+    - run_after (DateTimeField): The job is not started before this time.
+    - last_error (TextField): Error raised by the last failed attempt.
+    - created_at (DateTimeField): Creation date and time.
+    - updated_at (DateTimeField): Last modification date and time.
+
+    Example:
+    
+    job = Job.objects.create(kind='create_plan', user=my_runner_user, idempotency_key='create_plan:1')
+    
+    """
+
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+    # Job status choices
+    STATUS_CHOICES = [
+        (PENDING, "Pending"),
+        (RUNNING, "Running"),
+        (DONE, "Done"),
+        (FAILED, "Failed"),
+    ]
+
+    kind = models.CharField(max_length=50)
+    user = models.ForeignKey(
+        RunnerUser, on_delete=models.CASCADE, null=True, blank=True)
+    idempotency_key = models.CharField(max_length=200, unique=True)
+    payload = models.JSONField(default=dict, blank=True)
+    status = models.CharField(
+        max_length=20, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    run_after = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            # Workers look for the next job to run by status and time
+            models.Index(fields=["status", "run_after"]),
+        ]
+
+    def __str__(self):
+        return f"Job {self.id} ({self.kind}) is {self.status} after {self.attempts} attempt(s)"
+
+
+class StravaWebhookEvent(models.Model):
+    """
+    Model representing an event received from the Strava webhook (push subscription).
+
+    Strava may deliver the same event more than once, so events are stored keyed by their content: an event
+    that is already stored is ignored.
+
+    Attributes:
+    - event_key (CharField): Unique key of the event: object type, object ID, aspect type and event time.
+    - owner_id (BigIntegerField): Strava athlete ID of the owner of the object.
+    - payload (JSONField): The event as sent by Strava.
+    - received_at (DateTimeField): Date and time the event was received.
+
+    Example:
+    
+    event = StravaWebhookEvent.objects.create(event_key='activity:123:create:1700000000', owner_id=42, payload={...})
+    
+    """
+
+    event_key = models.CharField(max_length=100, unique=True)
+    owner_id = models.BigIntegerField()
+    payload = models.JSONField()
+    received_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return f"Strava event {self.event_key}"
+
+
+class ActivityStream(models.Model):
+    """
+    Model representing the streams (time, velocity and heart rate samples) of a Strava activity.
+
+    The streams are stored as one compressed blob of typed arrays rather than as a row per sample
+    (see utils/activity_streams.py).
+
+    Attributes:
+    - strava_activity_id (BigIntegerField): Unique ID of the Strava activity.
+    - n_samples (PositiveIntegerField): Number of samples of each stream.
+    - data (BinaryField): The compressed arrays of the streams.
+    - fetched_at (DateTimeField): Date and time the streams were fetched from Strava.
+
+    Example:
+    
+    stream = ActivityStream.objects.create(strava_activity_id=123, n_samples=3600, data=activity_streams.encode(streams))
+    
+    """
+
+    strava_activity_id = models.BigIntegerField(unique=True)
+    n_samples = models.PositiveIntegerField()
+    data = models.BinaryField()
+    fetched_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Streams of Strava activity {self.strava_activity_id}"
@@ -0,0 +1,98 @@
+"""
+This module defines the signal handlers for the training_plan app.
+
+Handlers:
+- reschedule_plan_on_change: Enqueues the rescheduling of a runner's plan when their date of marathon or fitness
+  level changes.
+- adapt_plan_on_completed_run: Enqueues the adaptation of a runner's adaptive plan when a run is completed.
+- sync_strava_on_login: Syncs a runner's Strava activities in the background when they log in.
+- invalidate_runner_context: Drops the cached plan and Strava profile of a runner when either changes.
+- bump_plan_version: Bumps the version of a plan when one of its scheduled or completed runs changes.
+"""
+from django.contrib.auth.signals import user_logged_in
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import RunnerUser, MarathonPlan, ScheduledRun, CompletedRun, StravaUserProfile
+from .utils import plan_adapt, plan_reschedule, plan_version, runner_context, strava_funcs
+
+
+@receiver(post_save, sender=RunnerUser)
+def reschedule_plan_on_change(sender, instance, created, raw=False, update_fields=None, **kwargs):
+    """
+    Reschedule the future part of a runner's plan in the background when their date of marathon or fitness level
+    changes.
+
+    The plan stores the date of marathon (end_date) and fitness level it was generated for, so a change is
+    detected by comparing them with the saved user.
+    """
+
+    if created or raw:
+        return
+    if update_fields is not None and not {"date_of_marathon", "fitness_level"} & set(update_fields):
+        return
+
+    plan = MarathonPlan.objects.filter(user=instance).first()
+    if plan is None:
+        return
+
+    if plan.end_date != instance.date_of_marathon or plan.fitness_level != instance.fitness_level:
+        plan_reschedule.enqueue_reschedule(plan, instance)
+
+
+@receiver(post_save, sender=CompletedRun)
+def adapt_plan_on_completed_run(sender, instance, raw=False, **kwargs):
+    """
+    Adapt the next weeks of a runner's plan in the background when a run is completed or its stats are edited,
+    whether through update_completed_run or the Strava import.
+
+    Plans are only adaptive if their runner opted in, so the plan is checked in one query before anything is
+    enqueued.
+    """
+
+    if raw or instance.scheduled_run_id is None:
+        return
+
+    plan = ScheduledRun.objects.filter(pk=instance.scheduled_run_id, marathon_plan__adaptive=True).values(
+        "marathon_plan_id", "marathon_plan__version").first()
+    if plan is not None:
+        plan_adapt.enqueue_adapt(plan["marathon_plan_id"], plan["marathon_plan__version"])
+
+
+@receiver(user_logged_in)
+def sync_strava_on_login(sender, request, user, **kwargs):
+    """
+    Enqueue a background sync of a runner's Strava activities when they log in, so their latest runs show up
+    without the page waiting on Strava.
+    """
+
+    if StravaUserProfile.objects.filter(user=user).exists():
+        strava_funcs.enqueue_sync(user)
+
+
+@receiver([post_save, post_delete], sender=MarathonPlan)
+@receiver([post_save, post_delete], sender=StravaUserProfile)
+def invalidate_runner_context(sender, instance, **kwargs):
+    """
+    Drop the cached plan and Strava profile of a runner when either is saved or deleted, so the next request reads
+    them again (see utils/runner_context.py).
+    """
+
+    runner_context.invalidate(instance.user_id)
+
+
+@receiver([post_save, post_delete], sender=ScheduledRun)
+@receiver([post_save, post_delete], sender=CompletedRun)
+def bump_plan_version(sender, instance, raw=False, **kwargs):
+    """
+    Bump the version of a plan when one of its scheduled or completed runs is saved or deleted, so the run APIs
+    stop answering 304 Not Modified to the previous version (see utils/plan_version.py).
+    """
+
+    if raw:
+        return
+    if sender is ScheduledRun:
+        plan_version.bump([instance.marathon_plan_id])
+    elif instance.scheduled_run_id is not None:
+        plan_version.bump(ScheduledRun.objects.filter(pk=instance.scheduled_run_id).values_list(
+            "marathon_plan_id", flat=True))
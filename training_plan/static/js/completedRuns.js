@@ -1,3 +1,6 @@
+// Runs loaded per page
+const COMPLETED_RUNS_PAGE_SIZE = 28;
+
 // Listen to the index page after it is loaded
 document.addEventListener('DOMContentLoaded', () => {
     // Months from numbers
@@ -16,17 +19,35 @@ document.addEventListener('DOMContentLoaded', () => {
         "12": "December",
     }
 
-    const result = apiGetCompletedRuns();
-
     const rootDiv = document.getElementById('completed-runs-container'); // Get the root div for the page
+    const sentinel = document.getElementById('completed-runs-sentinel'); // Reached when scrolling to the end
 
     // Initialize variables to keep track of the current month
     let currentMonth = '';
     let monthHeading = null;
 
-    // Loop through each of the runs and add them to the page
-    result.then(data => {
-        for (run of data.all_completed_runs) {
+    // Runs are loaded a page at a time, the next one when the end of the page is scrolled into view
+    let nextCursor = null;
+    let loading = false;
+    let finished = false;
+
+    const observer = new IntersectionObserver(entries => {
+        if (entries[0].isIntersecting) {
+            loadMoreRuns();
+        }
+    });
+    observer.observe(sentinel);
+
+    async function loadMoreRuns() {
+        if (loading || finished) {
+            return;
+        }
+        loading = true;
+
+        const data = await apiGetCompletedRuns(nextCursor);
+
+        // Loop through each of the runs and add them to the page
+        for (run of data.all_completed_runs || []) {
             const runDate = formatDate(run.completed_run.date);
             const runMonth = runDate.split('/')[1]; 
 
@@ -47,7 +68,17 @@ document.addEventListener('DOMContentLoaded', () => {
                 runDate);
             rootDiv.appendChild(runDiv);
         }
-    });
+
+        nextCursor = data.next_cursor;
+        finished = !nextCursor;
+        loading = false;
+
+        if (finished) {
+            observer.disconnect();
+        } else if (sentinel.getBoundingClientRect().top < window.innerHeight) {
+            loadMoreRuns(); // The page doesn't fill the screen yet
+        }
+    }
 
 
     // Go to top button - (taken from https://www.w3schools.com/howto/howto_js_scroll_to_top.asp)
@@ -100,9 +131,9 @@ function createMonthHeading(month) {
     return heading;
 }
 
-// API to get the completed runs for a user
-async function apiGetCompletedRuns() {
-    const url = "api/get-completed-runs";
+// API to get a page of the completed runs for a user, after the cursor of the previous page
+async function apiGetCompletedRuns(cursor) {
+    const url = `api/get-completed-runs?limit=${COMPLETED_RUNS_PAGE_SIZE}` + (cursor ? `&cursor=${encodeURIComponent(cursor)}` : "");
     const response = await fetch(url);
     const all_completed_runs = await response.json();
     return all_completed_runs;
@@ -3,8 +3,9 @@ document.addEventListener('DOMContentLoaded', () => {
     console.log('Dom Content loaded');
 
     // Get the document values from api
-    const valuesPromise = getTodaysRun();
-    valuesPromise.then(values => {
+    const valuesPromise = getDashboard();
+    valuesPromise.then(dashboard => {
+        const values = dashboard && dashboard.todays_run;
 
         // Render button and label to the DOM (not if a rest day)
         if (values && (values.distance || values.sets)) { // If the plan hasn't started yet
@@ -668,9 +669,9 @@ async function updateStats(payload) {
     }
 }
 
-// API to get the todays run and all of its attributes
-async function getTodaysRun() {
-    const url = '/api/get-todays-run';
+// API to get the dashboard: the plan countdown, todays run with all of its attributes and the next runs
+async function getDashboard() {
+    const url = '/api/dashboard';
     const response = await fetch(url);
     const data = await response.json();
     return data;
@@ -16,17 +16,35 @@ document.addEventListener('DOMContentLoaded', () => {
         "12": "December",
     }
 
-    const result = apiGetScheduledRuns();
-
     const rootDiv = document.getElementById('scheduled-runs-container'); // Get the root div for the page
+    const sentinel = document.getElementById('scheduled-runs-sentinel'); // Reached when scrolling to the end
 
     // Initialize variables to keep track of the current month
     let currentMonth = '';
     let monthHeading = null;
 
-    // Loop through each of the runs and add them to the page
-    result.then(data => {
-        for (run of data.all_scheduled_runs) {
+    // Runs are loaded a page at a time, the next one when the end of the page is scrolled into view
+    let nextCursor = null;
+    let loading = false;
+    let finished = false;
+
+    const observer = new IntersectionObserver(entries => {
+        if (entries[0].isIntersecting) {
+            loadMoreRuns();
+        }
+    });
+    observer.observe(sentinel);
+
+    async function loadMoreRuns() {
+        if (loading || finished) {
+            return;
+        }
+        loading = true;
+
+        const data = await apiGetScheduledRuns(nextCursor);
+
+        // Loop through each of the runs and add them to the page
+        for (run of data.all_scheduled_runs || []) {
             const runDate = formatDate(run.date);
             const runMonth = runDate.split('/')[1]; 
 
@@ -42,7 +60,17 @@ document.addEventListener('DOMContentLoaded', () => {
             const runDiv = displayRun(run.id, run.dict_id, run.run, run.run_feel, runDate);
             rootDiv.appendChild(runDiv);
         }
-    });
+
+        nextCursor = data.next_cursor;
+        finished = !nextCursor;
+        loading = false;
+
+        if (finished) {
+            observer.disconnect();
+        } else if (sentinel.getBoundingClientRect().top < window.innerHeight) {
+            loadMoreRuns(); // The page doesn't fill the screen yet
+        }
+    }
 
 
     // Go to top button - (taken from https://www.w3schools.com/howto/howto_js_scroll_to_top.asp)
@@ -90,9 +118,9 @@ function createMonthHeading(month) {
     return heading;
 }
 
-// API to get the scheduled runs for a user
-async function apiGetScheduledRuns() {
-    const url = "api/get-scheduled-runs";
+// API to get a page of the scheduled runs for a user, after the cursor of the previous page
+async function apiGetScheduledRuns(cursor) {
+    const url = cursor ? `api/get-scheduled-runs?cursor=${encodeURIComponent(cursor)}` : "api/get-scheduled-runs";
     const response = await fetch(url);
     const all_scheduled_runs = await response.json();
     return all_scheduled_runs;
@@ -0,0 +1,155 @@
+"""
+This module defines the handlers of the background jobs run by the job queue (see utils/jobs.py).
+
+Handlers:
+- create_plan: Creates the marathon plan of a newly registered user and schedules its runs.
+- reschedule_plan: Regenerates the future part of a user's plan for their new date of marathon or fitness level.
+- adapt_plan: Adapts the next weeks of an adaptive plan to the runs completed.
+- strava_sync: Completes the scheduled runs of a user with the runs they recorded on Strava.
+- strava_activity: Imports the Strava activity of a webhook event.
+- strava_backfill: Imports the runs a user recorded on Strava since the start of their plan.
+- strava_streams: Imports the streams of a Strava run and computes the minutes it spent in each heart rate zone.
+- strava_deauthorize: Unlinks the Strava account of a user who deauthorized the app on Strava.
+"""
+from datetime import date
+
+from django.db import transaction
+
+from .models import MarathonPlan
+from .utils import activity_streams, jobs, plan_adapt, plan_algo, plan_reschedule, strava_backfill, strava_funcs
+from .utils import strava_ratelimit
+
+
+@jobs.handler("create_plan")
+def create_plan(job):
+    """
+    Create the marathon plan of a newly registered user and schedule its runs, in one transaction.
+
+    Raises:
+    - PermanentJobError: If the date of the marathon is invalid.
+    """
+
+    user = job.user
+    if MarathonPlan.objects.filter(user=user).exists():
+        return
+
+    plan = plan_algo.NewMarathonPlan(user)
+    with transaction.atomic():
+        success, user_plan = plan.create_plan()
+        if not success:
+            raise jobs.PermanentJobError(user_plan)
+        plan.create_runs_in_plan()
+
+
+@jobs.handler("reschedule_plan")
+def reschedule_plan(job):
+    """
+    Regenerate the future part of a user's plan for their current date of marathon and fitness level, unless it
+    already matches them.
+
+    Raises:
+    - PermanentJobError: If the date of the marathon is too close to reschedule the plan.
+    """
+
+    user = job.user
+    plan = MarathonPlan.objects.filter(user=user).first()
+    if plan is None or (plan.end_date == user.date_of_marathon and plan.fitness_level == user.fitness_level):
+        return
+
+    try:
+        plan_reschedule.reschedule_plan(plan, user)
+    except ValueError as e:
+        raise jobs.PermanentJobError(str(e))
+
+
+@jobs.handler("adapt_plan")
+def adapt_plan(job):
+    """
+    Adapt the next weeks of a plan to the runs completed up to the day the job was enqueued on. Plans that were
+    deleted or are no longer adaptive are left alone.
+    """
+
+    plan = MarathonPlan.objects.filter(id=job.payload["plan_id"]).first()
+    if plan is not None:
+        plan_adapt.adapt_plan(plan, date.fromisoformat(job.payload["today"]))
+
+
+@jobs.handler("strava_sync")
+def strava_sync(job):
+    """
+    Complete the scheduled runs of a user with the runs they recorded on Strava since the last sync.
+    Failed calls to Strava raise StravaError, so the job is retried. The calls to Strava made by jobs are background
+    calls (see utils/strava_ratelimit.py).
+
+    Raises:
+    - PermanentJobError: If the user has no Strava profile or no plan.
+    """
+
+    try:
+        with strava_ratelimit.background():
+            completed = strava_funcs.sync_activities(job.user)
+    except LookupError as e:
+        raise jobs.PermanentJobError(str(e))
+
+    if completed:
+        print(f"{completed} run(s) synced from Strava for {job.user.username}")
+
+
+@jobs.handler("strava_activity")
+def strava_activity(job):
+    """
+    Import the Strava activity of a webhook event (see utils/strava_webhook.py).
+
+    Raises:
+    - PermanentJobError: If the user has no Strava profile or no plan.
+    """
+
+    try:
+        with strava_ratelimit.background():
+            strava_funcs.import_activity(job.user, job.payload["activity_id"], job.payload["aspect_type"])
+    except LookupError as e:
+        raise jobs.PermanentJobError(str(e))
+
+
+@jobs.handler("strava_backfill")
+def strava_backfill_job(job):
+    """
+    Import the runs a user recorded on Strava since the start of their plan. The start time of the last imported
+    activity is saved in the payload after every page, so a retried job resumes where it stopped.
+
+    Raises:
+    - PermanentJobError: If the user has no Strava profile or no plan.
+    """
+
+    def checkpoint(after):
+        job.payload["after"] = after
+        job.save(update_fields=["payload", "updated_at"])
+
+    try:
+        with strava_ratelimit.background():
+            counts = strava_backfill.backfill_activities(
+                job.user, job.payload["after"], job.payload["before"], checkpoint=checkpoint)
+    except LookupError as e:
+        raise jobs.PermanentJobError(str(e))
+
+    print(f"Strava backfill for {job.user.username}: {counts}")
+
+
+@jobs.handler("strava_streams")
+def strava_streams(job):
+    """
+    Import the streams of the activities of a completed run imported from Strava, and compute the minutes it spent
+    in each heart rate zone (see utils/activity_streams.py).
+    """
+
+    with strava_ratelimit.background():
+        activity_streams.update_zone_minutes(job.user, job.payload["activity_ids"])
+
+
+@jobs.handler("strava_deauthorize")
+def strava_deauthorize(job):
+    """
+    Unlink the Strava account of a user who deauthorized the app on Strava.
+    """
+
+    strava_funcs.unlink_strava(job.user.username)
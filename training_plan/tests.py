@@ -1,3 +1,1179 @@
-from django.test import TestCase
+import csv
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from io import StringIO
 
-# Create your tests here.
+import numpy as np
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import DatabaseError, IntegrityError, connection, transaction
+from django.utils import timezone
+from unittest import mock
+from django.test import Client, SimpleTestCase, TestCase, TransactionTestCase, override_settings, skipUnlessDBFeature
+from django.test.utils import CaptureQueriesContext
+
+from .models import RunnerUser, MarathonPlan, ScheduledRun, CompletedRun, StravaUserProfile, Job, ActivityStream
+from .utils import activity_streams, dashboard, jobs, metrics, plan_algo, run_matching, strava_backfill, strava_client, strava_events, strava_funcs
+from .utils import plan_compiler, plan_reschedule, plan_store, runner_context, strava_breaker, strava_ratelimit
+from .management.commands import benchmark_plans, generate_plans
+from .utils.fake_strava import FakeStrava
+from .utils import p_a_constants as c
+
+MARATHON_DATE = date.today() + timedelta(days=120)
+
+
+def plan_length(today, date_of_marathon):
+    """
+    Number of runs in a plan: every day from the Monday the plan starts on up to the marathon.
+    """
+    first_monday = today + timedelta(days=(7 - today.weekday()) % 7)
+    return (date_of_marathon - first_monday).days + 1
+
+
+def registration_data(username):
+    return {
+        "first_name": "Test", "last_name": "Runner", "username": username,
+        "email": f"{username}@example.com", "password1": "a-long-Passw0rd", "password2": "a-long-Passw0rd",
+        "dob": "1990-01-01", "fitness_level": "intermediate", "date_of_marathon": MARATHON_DATE.isoformat(),
+    }
+
+
+def legacy_runs(fit_level, today, date_of_marathon):
+    """
+    The runs of a plan as the original loop over every week and day scheduled them, before plans were compiled
+    (see plan_compiler.py): {date: (dict_id, distance, duration, on, off, sets, pace in seconds)}.
+    """
+    interval_pace = {"beginner": 5.5, "intermediate": 4.5, "advanced": 3.5}[fit_level]
+    new_plan = plan_algo.NewMarathonPlan(RunnerUser(fitness_level=fit_level, date_of_marathon=date_of_marathon))
+    new_plan.today = today
+    start, phase_weeks, _ = new_plan._calculate_phases()
+
+    runs = {}
+    for phase, weeks in zip(("phase1", "phase2", "phase3"), phase_weeks):
+        for week in range(weeks):
+            for day_index, day in enumerate(c.WEEK):
+                run_id = c.BASIC_PLANS[fit_level][phase][day]
+                distance = duration = pace = on = off = sets = 0
+                if run_id == 5:
+                    sets_range = c.DEFAULT_RUNS[5]["sets"][fit_level][phase]
+                    on, off, pace = c.DEFAULT_RUNS[5]["on"], c.DEFAULT_RUNS[5]["off"], interval_pace
+                    sets = sets_range["low"] + round((sets_range["high"] - sets_range["low"]) * week / weeks)
+                    duration = (on + off) * sets
+                elif run_id != 0:
+                    distance_range = c.DEFAULT_RUNS[run_id]["distance"][fit_level][phase]
+                    # The original divided by zero for a phase of a single week, which now stays at "low"
+                    step = (distance_range["high"] - distance_range["low"]) / (weeks - 1) if weeks > 1 else 0
+                    distance = distance_range["low"] + step * week
+                    duration = c.DEFAULT_RUNS[run_id]["first_duration"][fit_level]
+                    pace = duration / distance
+                runs[start + timedelta(weeks=week, days=day_index)] = (
+                    run_id, int(distance), duration, on, off, sets, pace * 60)
+        start += timedelta(weeks=weeks)
+
+    taper_start = date_of_marathon - timedelta(days=6)
+    runs = {run_date: run for run_date, run in runs.items() if run_date < taper_start}
+    for day_index, day in enumerate(c.WEEK):
+        last = c.LAST[day]
+        run_id = last["dict_id"]
+        distance = duration = pace = on = off = sets = 0
+        if run_id == 5:
+            on, off, sets, pace = last["on"], last["off"], last["sets"], interval_pace
+            duration = (on + off) * sets
+        elif run_id != 0:
+            source = c.DEFAULT_RUNS[run_id] if run_id == 9 else last
+            distance = source["distance"]
+            duration = (c.DEFAULT_RUNS[run_id]["first_duration"] if run_id == 9 else last["duration"])[fit_level]
+            pace = duration / distance
+        runs[taper_start + timedelta(days=day_index)] = (
+            run_id, int(distance), duration, on, off, sets, pace * 60)
+    return runs
+
+
+def run_tuple(run):
+    return (run.dict_id, run.distance, run.est_duration, run.on, run.off, run.sets,
+            run.est_avg_pace.total_seconds())
+
+
+class PlanCompilerTests(SimpleTestCase):
+
+    def test_compiled_plans_match_the_original_algorithm(self):
+        # Every fitness level, horizon and start weekday
+        for fit_level in ("beginner", "intermediate", "advanced"):
+            for days in range(c.MIN_DAYS, c.MAX_DAYS + 1):
+                for weekday in range(7):
+                    today = date(2024, 1, 1) + timedelta(days=weekday)
+                    user = RunnerUser(fitness_level=fit_level, date_of_marathon=today + timedelta(days=days))
+                    new_plan = plan_algo.NewMarathonPlan(user)
+                    new_plan.today = today
+                    plan_array = new_plan.compile_plan()
+                    runs = {run_date: run for run_date, *run in zip(
+                        plan_array["date"].tolist(), plan_array["dict_id"].tolist(),
+                        plan_array["distance"].astype(int).tolist(), plan_array["est_duration"].tolist(),
+                        plan_array["on"].tolist(), plan_array["off"].tolist(), plan_array["sets"].tolist(),
+                        (plan_array["est_avg_pace"] * 60).tolist())}
+                    legacy = legacy_runs(fit_level, today, user.date_of_marathon)
+                    case = f"{fit_level}, {days} days from weekday {weekday}"
+                    self.assertEqual({run_date: tuple(run[:-1]) for run_date, run in runs.items()},
+                                     {run_date: run[:-1] for run_date, run in legacy.items()}, case)
+                    # Paces only differ by the rounding of floats
+                    self.assertLess(max(abs(run[-1] - legacy[run_date][-1]) for run_date, run in runs.items()),
+                                    0.001, case)
+
+
+class PlanTemplateCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        plan_compiler.compile_template.cache_clear()
+        self.addCleanup(plan_compiler.compile_template.cache_clear)
+
+    def compile(self, today, fit_level="intermediate", days=150):
+        user = RunnerUser(fitness_level=fit_level, date_of_marathon=today + timedelta(days=days))
+        new_plan = plan_algo.NewMarathonPlan(user, storage=MarathonPlan.VIRTUAL)
+        new_plan.today = today
+        return new_plan.compile_plan()
+
+    def test_identical_plans_share_one_compiled_template(self):
+        first = self.compile(date(2024, 1, 1))
+        # Another week, so only the dates differ
+        second = self.compile(date(2024, 1, 8))
+        info = plan_compiler.template_cache_info()
+        self.assertEqual((info.hits, info.misses, info.currsize), (1, 1, 1))
+        self.assertTrue((second["date"] - first["date"] == np.timedelta64(7, "D")).all())
+        self.assertTrue((second["distance"] == first["distance"]).all())
+
+        # The key is (fit_level, phase_weeks, n_days)
+        self.compile(date(2024, 1, 1), fit_level="advanced")
+        self.compile(date(2024, 1, 1), days=151)
+        info = plan_compiler.template_cache_info()
+        self.assertEqual((info.hits, info.misses), (1, 3))
+
+    def test_compiled_plans_are_copies_of_a_read_only_template(self):
+        args = ("beginner", (6, 4, 2), 91)
+        self.assertFalse(plan_compiler.compile_template(*args).flags.writeable)
+        with self.assertRaises(ValueError):
+            plan_compiler.compile_template(*args)["distance"][:] = 0
+
+        plan = plan_compiler.compile_plan(args[0], date(2024, 1, 1), *args[1:])
+        plan["distance"][:] = 0
+        plan["date"][:] = np.datetime64("2000-01-01")
+        again = plan_compiler.compile_plan(args[0], date(2024, 1, 1), *args[1:])
+        self.assertGreater(again["distance"].sum(), 0)
+        self.assertEqual(again["date"][0], np.datetime64("2024-01-01"))
+
+    def test_cache_holds_at_most_plan_template_cache_size_templates(self):
+        info = plan_compiler.template_cache_info()
+        self.assertEqual(info.maxsize, c.PLAN_TEMPLATE_CACHE_SIZE)
+        for n_days in range(c.MIN_DAYS, c.MIN_DAYS + c.PLAN_TEMPLATE_CACHE_SIZE + 10):
+            plan_compiler.compile_template("beginner", (6, 4, 2), n_days)
+        self.assertEqual(plan_compiler.template_cache_info().currsize, c.PLAN_TEMPLATE_CACHE_SIZE)
+
+
+class PlanStoreTests(TestCase):
+
+    def setUp(self):
+        self.plans = {}
+        for storage in (MarathonPlan.VIRTUAL, MarathonPlan.MATERIALIZED):
+            user = RunnerUser.objects.create(username=storage, dob=date(1990, 1, 1), fitness_level="intermediate",
+                                             date_of_marathon=MARATHON_DATE)
+            new_plan = plan_algo.NewMarathonPlan(user, storage=storage)
+            self.plans[storage] = new_plan.create_plan()[1]
+            new_plan.create_runs_in_plan()
+        self.plan = self.plans[MarathonPlan.VIRTUAL]
+        self.day = date.today() + timedelta(days=10)
+
+    def test_virtual_runs_match_the_stored_runs_of_the_same_plan(self):
+        self.assertFalse(ScheduledRun.objects.filter(marathon_plan=self.plan).exists())
+        stored = plan_store.get_runs(self.plans[MarathonPlan.MATERIALIZED])
+        computed = plan_store.get_runs(self.plan)
+        self.assertEqual([run_tuple(run) for run in computed], [run_tuple(run) for run in stored])
+        self.assertEqual([run.date for run in computed], [run.date for run in stored])
+
+        window = plan_store.get_runs(self.plan, start=self.day, end=self.day + timedelta(days=6))
+        self.assertEqual([run.date for run in window], [self.day + timedelta(days=i) for i in range(7)])
+        self.assertEqual(run_tuple(plan_store.get_run(self.plan, self.day)), run_tuple(window[0]))
+        self.assertIsNone(plan_store.get_run(self.plan, MARATHON_DATE + timedelta(days=1)))
+
+    def test_materialized_runs_are_read_back_once_stored(self):
+        run = plan_store.get_run(self.plan, self.day)
+        self.assertIsNone(run.pk)
+        stored_run = plan_store.materialize(run)
+        self.assertEqual(run_tuple(stored_run), run_tuple(run))
+        self.assertEqual(plan_store.get_run(self.plan, self.day).pk, stored_run.pk)
+        self.assertEqual(plan_store.materialize(stored_run), stored_run)
+
+        # A stale computed run of a day stored meanwhile, also when the insert itself conflicts
+        self.assertEqual(plan_store.materialize(run).pk, stored_run.pk)
+        with mock.patch("django.db.models.query.QuerySet.first", return_value=None):
+            self.assertEqual(plan_store.materialize(run).pk, stored_run.pk)
+        self.assertEqual(ScheduledRun.objects.filter(marathon_plan=self.plan).count(), 1)
+
+
+class PlanCreationTests(TestCase):
+
+    def test_taper_only_replaces_runs_of_its_own_plan(self):
+        plans = []
+        for username in ("first", "second"):
+            user = RunnerUser.objects.create(username=username, dob=date(1990, 1, 1),
+                                             fitness_level="beginner", date_of_marathon=MARATHON_DATE)
+            new_plan = plan_algo.NewMarathonPlan(user, storage=MarathonPlan.MATERIALIZED)
+            plans.append(new_plan.create_plan()[1])
+            new_plan.create_runs_in_plan()
+
+        for plan in plans:
+            runs = ScheduledRun.objects.filter(marathon_plan=plan)
+            self.assertEqual(runs.count(), plan_length(date.today(), MARATHON_DATE))
+            self.assertEqual(runs.values("date").distinct().count(), runs.count())
+            self.assertEqual(runs.get(date=MARATHON_DATE).dict_id, 9)
+
+
+class GeneratePlansTests(TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.csv_path = os.path.join(directory.name, "runners.csv")
+        self.checkpoint = os.path.join(directory.name, "runners.ckpt")
+
+    def write_csv(self, usernames):
+        with open(self.csv_path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["username", "first_name", "last_name", "email", "dob", "fitness_level",
+                             "date_of_marathon"])
+            for username in usernames:
+                writer.writerow([username, "Test", "Runner", f"{username}@example.com", "1990-01-01", "beginner",
+                                 MARATHON_DATE.isoformat()])
+
+    def generate_plans(self, *args):
+        stderr = StringIO()
+        call_command("generate_plans", "--csv", self.csv_path, "--checkpoint", self.checkpoint, "--workers", "1",
+                     "--batch-size", "2", "--storage", MarathonPlan.MATERIALIZED, *args,
+                     stdout=StringIO(), stderr=stderr)
+        return stderr.getvalue()
+
+    def test_runners_of_a_csv_get_their_plan_once(self):
+        self.write_csv(["ana", "ben", "ana", "cat"])
+        self.assertIn("Skipping line 4 (ana): already on line 2", self.generate_plans())
+
+        n_runs = plan_length(date.today(), MARATHON_DATE)
+        for username in ("ana", "ben", "cat"):
+            plan = MarathonPlan.objects.get(user__username=username)
+            self.assertEqual(ScheduledRun.objects.filter(marathon_plan=plan).count(), n_runs)
+        with open(self.checkpoint) as f:
+            self.assertEqual(f.read().split(), ["ana", "ben", "cat"])
+
+    def test_resume_after_a_failed_batch(self):
+        self.write_csv(["ana", "ben", "cat", "dan"])
+        bulk_create = ScheduledRun.objects.bulk_create
+        calls = []
+
+        def fail_second_batch(*args, **kwargs):
+            calls.append(args)
+            if len(calls) == 2:
+                raise DatabaseError("The database went away")
+            return bulk_create(*args, **kwargs)
+
+        with mock.patch.object(ScheduledRun.objects, "bulk_create", side_effect=fail_second_batch):
+            with self.assertRaises(DatabaseError):
+                self.generate_plans()
+        self.assertEqual(list(RunnerUser.objects.values_list("username", flat=True).order_by("username")),
+                         ["ana", "ben"])
+
+        self.generate_plans("--resume")
+        self.assertEqual(MarathonPlan.objects.count(), 4)
+        with open(self.checkpoint) as f:
+            self.assertEqual(f.read().split(), ["ana", "ben", "cat", "dan"])
+
+    def test_usernames_taken_before_their_batch_are_skipped(self):
+        self.write_csv(["ana", "ben"])
+        read_csv = generate_plans.Command._read_csv
+
+        def register_ben(command, path):
+            runners = read_csv(command, path)
+            # Someone registers as ben after the CSV was read
+            RunnerUser.objects.create(username="ben", dob=date(1990, 1, 1), fitness_level="beginner",
+                                      date_of_marathon=MARATHON_DATE)
+            return runners
+
+        with mock.patch.object(generate_plans.Command, "_read_csv", register_ben):
+            self.assertIn("Skipping ben: the username has been taken", self.generate_plans())
+        self.assertTrue(MarathonPlan.objects.filter(user__username="ana").exists())
+        self.assertFalse(MarathonPlan.objects.filter(user__username="ben").exists())
+
+    def test_dry_run_writes_nothing(self):
+        self.write_csv(["ana", "ben", "cat"])
+        self.generate_plans("--dry-run")
+
+        self.assertFalse(RunnerUser.objects.exists())
+        self.assertFalse(ScheduledRun.objects.exists())
+        self.assertFalse(os.path.exists(self.checkpoint))
+
+
+class BenchmarkPlansTests(TestCase):
+
+    def benchmark(self, *args):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        output = os.path.join(directory.name, "benchmark.json")
+        call_command("benchmark_plans", "--fitness-level", "beginner", "--min-days", "120", "--max-days", "120",
+                     "--no-memory", "--output", output, *args, stdout=StringIO())
+        with open(output) as f:
+            return json.load(f)["results"]
+
+    def test_only_the_queries_of_plan_generation_are_counted(self):
+        results = self.benchmark("--repeat", "3")
+        self.assertFalse(RunnerUser.objects.exists())
+
+        start = benchmark_plans.FIRST_MONDAY
+        user = RunnerUser.objects.create(username="ana", dob=date(1990, 1, 1), fitness_level="beginner",
+                                         date_of_marathon=start + timedelta(days=120))
+        new_plan = plan_algo.NewMarathonPlan(user, storage=MarathonPlan.MATERIALIZED)
+        new_plan.today = start
+        with CaptureQueriesContext(connection) as queries:
+            new_plan.create_plan()
+            new_plan.create_runs_in_plan()
+        self.assertEqual(results[0]["queries"], len(queries.captured_queries))
+
+    def test_runs_making_different_numbers_of_queries_fail(self):
+        with mock.patch.object(benchmark_plans.Command, "_create_plan", side_effect=[(0.01, 3, 10), (0.01, 4, 10)]):
+            with self.assertRaisesMessage(CommandError, "beginner 120 days (weekday 0): the runs made 3, 4 queries"):
+                self.benchmark("--repeat", "2")
+
+
+class AdaptivePlanTests(TestCase):
+
+    def setUp(self):
+        user = RunnerUser.objects.create(username="adaptive", dob=date(1990, 1, 1),
+                                         fitness_level="intermediate", date_of_marathon=MARATHON_DATE)
+        new_plan = plan_algo.NewMarathonPlan(user, storage=MarathonPlan.MATERIALIZED)
+        new_plan.today = date.today() - timedelta(days=28)
+        self.plan = new_plan.create_plan()[1]
+        self.plan.adaptive = True
+        self.plan.save(update_fields=["adaptive"])
+        self.baseline = {run.date: run for run in new_plan.create_runs_in_plan()}
+
+    def complete(self, run, distance_scale, pace_scale):
+        pace = run.est_avg_pace * pace_scale
+        CompletedRun.objects.create(scheduled_run=run, date=run.date, distance=round(run.distance * distance_scale),
+                                    duration=round(run.est_duration * pace_scale), avg_pace=pace)
+
+    def test_completed_runs_rescale_only_the_next_weeks(self):
+        past_runs = ScheduledRun.objects.filter(
+            marathon_plan=self.plan, date__lt=date.today(), distance__gte=5).order_by("-date")[:4]
+        for run in past_runs:
+            self.complete(run, 0.8, 1.05)
+        jobs.run_pending()
+
+        self.plan.refresh_from_db()
+        self.assertLess(self.plan.distance_scale, 0.9)
+        self.assertGreater(self.plan.pace_scale, 1.0)
+
+        window_end = date.today() + timedelta(weeks=c.ADAPTIVE_WEEKS)
+        for run in ScheduledRun.objects.filter(marathon_plan=self.plan, date__gt=date.today()):
+            baseline = self.baseline[run.date]
+            if run.date > window_end or not baseline.distance:
+                self.assertEqual(run.distance, baseline.distance)
+            else:
+                self.assertLess(run.distance, baseline.distance)
+                self.assertGreater(run.est_avg_pace, baseline.est_avg_pace)
+
+    def test_too_few_completed_runs_leave_the_plan_unchanged(self):
+        run = ScheduledRun.objects.filter(marathon_plan=self.plan, date__lt=date.today(), distance__gte=5).last()
+        self.complete(run, 0.5, 1.1)
+        jobs.run_pending()
+
+        self.plan.refresh_from_db()
+        self.assertEqual((self.plan.distance_scale, self.plan.pace_scale), (1.0, 1.0))
+
+    def test_completed_runs_of_plans_not_adaptive_enqueue_nothing(self):
+        self.plan.adaptive = False
+        self.plan.save(update_fields=["adaptive"])
+        past_runs = ScheduledRun.objects.filter(
+            marathon_plan=self.plan, date__lt=date.today(), distance__gte=5).order_by("-date")[:4]
+        for run in past_runs:
+            self.complete(run, 0.8, 1.05)
+
+        self.assertFalse(Job.objects.filter(kind="adapt_plan").exists())
+        self.plan.refresh_from_db()
+        self.assertEqual((self.plan.distance_scale, self.plan.pace_scale), (1.0, 1.0))
+
+    def test_virtual_plans_keep_the_scales_without_storing_runs(self):
+        self.plan.storage = MarathonPlan.VIRTUAL
+        self.plan.save(update_fields=["storage"])
+        past_runs = ScheduledRun.objects.filter(
+            marathon_plan=self.plan, date__lt=date.today(), distance__gte=5).order_by("-date")[:4]
+        ScheduledRun.objects.filter(marathon_plan=self.plan, date__gte=date.today()).delete()
+        for run in past_runs:
+            self.complete(run, 0.8, 1.05)
+        jobs.run_pending()
+
+        self.plan.refresh_from_db()
+        self.assertLess(self.plan.distance_scale, 0.9)
+        self.assertFalse(ScheduledRun.objects.filter(marathon_plan=self.plan, date__gte=date.today()).exists())
+        tomorrow = date.today() + timedelta(days=1)
+        for run in plan_store.get_runs(self.plan, start=tomorrow, end=tomorrow + timedelta(weeks=2)):
+            if self.baseline[run.date].distance:
+                self.assertLess(run.distance, self.baseline[run.date].distance)
+
+
+class PlanSettingsTests(TestCase):
+
+    def test_runners_opt_in_and_out_of_adaptive_plans(self):
+        user = RunnerUser.objects.create(username="settings", dob=date(1990, 1, 1),
+                                         fitness_level="intermediate", date_of_marathon=MARATHON_DATE)
+        plan = plan_algo.NewMarathonPlan(user).create_plan()[1]
+        self.client.force_login(user)
+        self.assertContains(self.client.get("/settings"), 'name="adaptive"')
+
+        self.client.post("/settings/plan", {"adaptive": "on"})
+        plan.refresh_from_db()
+        self.assertTrue(plan.adaptive)
+
+        self.client.post("/settings/plan", {})
+        plan.refresh_from_db()
+        self.assertFalse(plan.adaptive)
+
+
+class ReschedulePlanTests(TestCase):
+
+    def setUp(self):
+        self.user = RunnerUser.objects.create(username="reschedule", dob=date(1990, 1, 1),
+                                              fitness_level="intermediate", date_of_marathon=MARATHON_DATE)
+        self.today = date.today()
+        self.window_start = self.today + timedelta(days=(7 - self.today.weekday()) % 7)
+
+    def create_plan(self, storage):
+        new_plan = plan_algo.NewMarathonPlan(self.user, storage=storage)
+        new_plan.today = self.today - timedelta(weeks=2)
+        plan = new_plan.create_plan()[1]
+        new_plan.create_runs_in_plan()
+        self.baseline = {run.date: (run.dict_id, run.distance) for run in plan_store.get_runs(plan)}
+        # A run completed ahead of the regenerated part
+        run = plan_store.materialize(plan_store.get_run(plan, self.window_start + timedelta(days=2)))
+        CompletedRun.objects.create(scheduled_run=run, date=run.date, distance=run.distance,
+                                    duration=run.est_duration, avg_pace=timedelta(minutes=6))
+        return plan
+
+    def test_stored_plan_keeps_completed_runs_and_diffs_the_rest(self):
+        plan = self.create_plan(MarathonPlan.MATERIALIZED)
+        plan.distance_scale = 0.8
+        plan.save(update_fields=["distance_scale"])
+
+        self.user.date_of_marathon = MARATHON_DATE - timedelta(weeks=2)
+        self.user.fitness_level = "advanced"
+        counts = plan_reschedule.reschedule_plan(plan, self.user)
+        self.assertEqual((counts["inserted"], counts["deleted"]), (0, 14))
+        self.assertGreater(counts["updated"], 0)
+        plan.refresh_from_db()
+        # The plan still began on the same day, e.g. for the Strava history
+        self.assertEqual((plan.start_date, plan.rescheduled_on), (self.today - timedelta(weeks=2), self.today))
+
+        runs = {run.date: run for run in ScheduledRun.objects.filter(marathon_plan=plan)}
+        self.assertEqual(max(runs), self.user.date_of_marathon)
+        self.assertTrue(all((runs[run_date].dict_id, runs[run_date].distance) == self.baseline[run_date]
+                            for run_date in runs if run_date < self.window_start))
+        completed = CompletedRun.objects.get(scheduled_run__marathon_plan=plan).scheduled_run
+        self.assertEqual((completed.dict_id, completed.distance), self.baseline[completed.date])
+        # The regenerated runs keep the plan's adaptation
+        unscaled = plan_algo.NewMarathonPlan(self.user).build_runs_in_plan(
+            start=self.window_start + timedelta(weeks=1), end=self.user.date_of_marathon - timedelta(weeks=1))
+        self.assertTrue(all(runs[run.date].distance < run.distance for run in unscaled if run.distance >= 5))
+
+        self.user.date_of_marathon = MARATHON_DATE
+        counts = plan_reschedule.reschedule_plan(plan, self.user)
+        self.assertEqual((counts["inserted"], counts["deleted"]), (14, 0))
+
+    def test_virtual_plan_keeps_computing_the_runs_before_the_new_start(self):
+        plan = self.create_plan(MarathonPlan.VIRTUAL)
+        start_date = plan.start_date
+        completed_date = self.window_start + timedelta(days=2)
+
+        self.user.fitness_level = "beginner"
+        plan_reschedule.reschedule_plan(plan, self.user)
+        plan.refresh_from_db()
+        self.assertEqual((plan.start_date, plan.rescheduled_on), (start_date, self.today))
+        # Only the completed run is stored
+        self.assertEqual(list(ScheduledRun.objects.filter(marathon_plan=plan).values_list("date", flat=True)),
+                         [completed_date])
+
+        runs = {run.date: (run.dict_id, run.distance) for run in plan_store.get_runs(plan)}
+        beginner = {run.date: (run.dict_id, run.distance)
+                    for run in plan_algo.NewMarathonPlan(self.user).build_runs_in_plan()}
+        self.assertEqual(runs, {**{run_date: run for run_date, run in self.baseline.items()
+                                   if run_date < self.window_start or run_date == completed_date},
+                                **{run_date: run for run_date, run in beginner.items() if run_date != completed_date}})
+
+        # A week later, the beginner runs of that week are kept too
+        self.user.fitness_level = "advanced"
+        plan_reschedule.reschedule_plan(plan, self.user, today=self.today + timedelta(weeks=1))
+        plan.refresh_from_db()
+        self.assertEqual([parameters["fitness_level"] for parameters in plan.past_parameters],
+                         ["intermediate", "beginner"])
+        week = [self.window_start + timedelta(days=days) for days in range(7)]
+        self.assertEqual([(run.dict_id, run.distance) for run in plan_store.get_runs(plan, week[0], week[-1])],
+                         [runs[run_date] for run_date in week])
+        self.assertEqual(plan_store.get_run(plan, self.window_start - timedelta(days=1)).dict_id,
+                         self.baseline[self.window_start - timedelta(days=1)][0])
+
+    def test_changes_close_to_the_marathon_are_rescheduled_in_the_background(self):
+        plan = self.create_plan(MarathonPlan.MATERIALIZED)
+
+        self.user.date_of_marathon = self.window_start + timedelta(days=30)
+        self.user.save()
+        jobs.run_pending()
+        plan.refresh_from_db()
+        self.assertEqual(plan.end_date, self.user.date_of_marathon)
+
+        self.user.date_of_marathon = self.today - timedelta(days=1)
+        self.user.save()
+        jobs.run_pending()
+        job = Job.objects.get(kind="reschedule_plan", status=Job.FAILED)
+        self.assertIn("before the rescheduled plan would start", job.last_error)
+
+
+class DashboardTests(TestCase):
+
+    def test_dashboard_takes_two_queries_whatever_the_history(self):
+        for storage in (MarathonPlan.MATERIALIZED, MarathonPlan.VIRTUAL):
+            with self.subTest(storage=storage):
+                user = RunnerUser.objects.create(username=storage, dob=date(1990, 1, 1),
+                                                 fitness_level="intermediate", date_of_marathon=MARATHON_DATE)
+                new_plan = plan_algo.NewMarathonPlan(user, storage=storage)
+                new_plan.today = date.today() - timedelta(weeks=8)
+                plan = new_plan.create_plan()[1]
+                new_plan.create_runs_in_plan()
+                past_runs = [plan_store.materialize(run) for run in plan_store.get_runs(plan, end=date.today())]
+                CompletedRun.objects.bulk_create(
+                    CompletedRun(scheduled_run=run, date=run.date, distance=run.distance, duration=run.est_duration,
+                                 avg_pace=run.est_avg_pace or timedelta(minutes=6)) for run in past_runs)
+
+                with self.assertNumQueries(2):
+                    board = dashboard.get_dashboard(runner_context.RunnerContext(user).plan)
+                self.assertEqual(board.todays_run.date, date.today())
+                self.assertEqual(board.completed_run.scheduled_run_id, board.todays_run.id)
+                self.assertEqual([run.date for run in board.next_runs],
+                                 [date.today() + timedelta(days=days) for days in (1, 2, 3)])
+
+                self.client.force_login(user)
+                data = self.client.get("/api/dashboard").json()
+                self.assertEqual(data["plan"]["days_to_go"], (MARATHON_DATE - date.today()).days)
+                self.assertTrue(data["todays_run"]["completed"])
+                self.assertEqual(len(data["next_runs"]), 3)
+
+
+    def test_next_runs_are_shown_before_the_plan_starts(self):
+        # Registered on the Thursday before a Monday, so the first run is 4 days away
+        today = date.today()
+        registered_on = today + timedelta(days=(3 - today.weekday()) % 7)
+        first_run = registered_on + timedelta(days=4)
+        for storage in (MarathonPlan.MATERIALIZED, MarathonPlan.VIRTUAL):
+            with self.subTest(storage=storage):
+                user = RunnerUser.objects.create(username=storage, dob=date(1990, 1, 1),
+                                                 fitness_level="intermediate", date_of_marathon=MARATHON_DATE)
+                new_plan = plan_algo.NewMarathonPlan(user, storage=storage)
+                new_plan.today = registered_on
+                plan = new_plan.create_plan()[1]
+                new_plan.create_runs_in_plan()
+
+                with self.assertNumQueries(1):
+                    board = dashboard.get_dashboard(plan, today=registered_on)
+                self.assertIsNone(board.todays_run)
+                self.assertEqual([run.date for run in board.next_runs],
+                                 [first_run + timedelta(days=days) for days in (0, 1, 2)])
+
+
+class ScheduledRunsPageTests(TestCase):
+
+    def test_pages_follow_each_other_up_to_the_marathon(self):
+        for storage in (MarathonPlan.MATERIALIZED, MarathonPlan.VIRTUAL):
+            with self.subTest(storage=storage):
+                user = RunnerUser.objects.create(username=storage, dob=date(1990, 1, 1),
+                                                 fitness_level="intermediate", date_of_marathon=MARATHON_DATE)
+                new_plan = plan_algo.NewMarathonPlan(user, storage=storage)
+                plan = new_plan.create_plan()[1]
+                new_plan.create_runs_in_plan()
+                plan_store.materialize(plan_store.get_runs(plan, start=MARATHON_DATE - timedelta(days=30))[0])
+                self.client.force_login(user)
+
+                dates, cursor = [], ""
+                while cursor is not None:
+                    data = self.client.get("/api/get-scheduled-runs", {"limit": 25, "cursor": cursor}).json()
+                    self.assertLessEqual(len(data["all_scheduled_runs"]), 25)
+                    dates += [run["date"] for run in data["all_scheduled_runs"]]
+                    cursor = data["next_cursor"]
+
+                expected = [run.date.isoformat() for run in plan_store.get_runs(
+                    plan, start=date.today() + timedelta(days=1))]
+                self.assertEqual(dates, expected)
+                self.assertEqual(dates[-1], MARATHON_DATE.isoformat())
+
+                response = self.client.get("/api/get-scheduled-runs", {"cursor": "yesterday"})
+                self.assertEqual(response.status_code, 400)
+
+
+class CompletedRunsApiTests(TestCase):
+
+    def get_completed_runs(self, **params):
+        response = self.client.get("/api/get-completed-runs", params)
+        return json.loads(b"".join(response.streaming_content))
+
+    def test_history_is_read_in_one_query_and_paginated(self):
+        user = RunnerUser.objects.create(username="history", dob=date(1990, 1, 1),
+                                         fitness_level="intermediate", date_of_marathon=MARATHON_DATE)
+        new_plan = plan_algo.NewMarathonPlan(user, storage=MarathonPlan.MATERIALIZED)
+        new_plan.today = date.today() - timedelta(weeks=12)
+        plan = new_plan.create_plan()[1]
+        new_plan.create_runs_in_plan()
+        self.client.force_login(user)
+
+        past_runs = list(ScheduledRun.objects.filter(marathon_plan=plan, date__lte=date.today()).order_by("date"))
+        for completed in (past_runs[:5], past_runs[5:]):
+            CompletedRun.objects.bulk_create(
+                CompletedRun(scheduled_run=run, date=run.date, distance=run.distance, duration=run.est_duration,
+                             avg_pace=run.est_avg_pace or timedelta(minutes=6)) for run in completed)
+            # The session, the user, the plan and the completed runs, however long the history
+            with self.assertNumQueries(4):
+                data = self.get_completed_runs()
+            self.assertEqual(len(data["all_completed_runs"]), CompletedRun.objects.count())
+            self.assertIsNone(data["next_cursor"])
+
+        dates, cursor = [], ""
+        while cursor is not None:
+            data = self.get_completed_runs(limit=20, cursor=cursor)
+            dates += [run["completed_run"]["date"] for run in data["all_completed_runs"]]
+            cursor = data["next_cursor"]
+        self.assertEqual(dates, [run.date.isoformat() for run in reversed(past_runs)])
+
+        data = self.get_completed_runs(**{"from": past_runs[-7].date.isoformat()})
+        self.assertEqual(len(data["all_completed_runs"]), 7)
+        self.assertEqual(data["all_completed_runs"][0]["scheduled_run"]["run"], past_runs[-1].run)
+
+
+class ConditionalRunsApiTests(TestCase):
+
+    def test_unchanged_runs_are_answered_not_modified(self):
+        user = RunnerUser.objects.create(username="conditional", dob=date(1990, 1, 1),
+                                         fitness_level="intermediate", date_of_marathon=MARATHON_DATE)
+        new_plan = plan_algo.NewMarathonPlan(user, storage=MarathonPlan.MATERIALIZED)
+        new_plan.today = date.today() - timedelta(weeks=1)
+        plan = new_plan.create_plan()[1]
+        new_plan.create_runs_in_plan()
+        self.client.force_login(user)
+
+        response = self.client.get("/api/get-scheduled-runs")
+        etag = response["ETag"]
+        # The session, the user and the plan, without reading the runs
+        with self.assertNumQueries(3):
+            response = self.client.get("/api/get-scheduled-runs", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        run = ScheduledRun.objects.get(marathon_plan=plan, date=date.today() - timedelta(days=1))
+        CompletedRun.objects.create(scheduled_run=run, date=run.date, distance=run.distance,
+                                    duration=run.est_duration, avg_pace=timedelta(minutes=6))
+        plan.refresh_from_db()
+        self.assertGreater(plan.version, 1)
+        for url in ("/api/get-scheduled-runs", "/api/get-completed-runs", "/api/dashboard"):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response["ETag"], etag)
+
+
+@skipUnlessDBFeature("test_db_allows_multiple_connections")
+class ParallelRegistrationTests(TransactionTestCase):
+
+    def register(self, username):
+        try:
+            return Client().post("/accounts/register", registration_data(username)).status_code
+        finally:
+            connection.close()
+
+    def run_worker(self, _):
+        try:
+            return jobs.run_pending()
+        finally:
+            connection.close()
+
+    def test_parallel_registrations_keep_every_plan_complete(self):
+        usernames = [f"runner{i}" for i in range(8)]
+        with ThreadPoolExecutor(max_workers=len(usernames)) as pool:
+            status_codes = list(pool.map(self.register, usernames))
+        self.assertEqual(status_codes, [302] * len(usernames))
+        self.assertFalse(MarathonPlan.objects.exists())
+
+        # Plans are created by workers sharing the queue, each job running exactly once
+        workers = 4 if connection.features.has_select_for_update_skip_locked else 1
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            self.assertEqual(sum(pool.map(self.run_worker, range(workers))), len(usernames))
+        self.assertEqual(Job.objects.filter(status=Job.DONE).count(), len(usernames))
+
+        for username in usernames:
+            plan = MarathonPlan.objects.get(user__username=username)
+            self.assertEqual(ScheduledRun.objects.filter(marathon_plan=plan).count(),
+                             plan_length(plan.start_date, MARATHON_DATE))
+
+
+class ConcurrentWritersTests(TestCase):
+    """
+    The guarantees ParallelRegistrationTests relies on, checked one writer after the other so they also run on
+    databases that can't be shared by several connections in tests (e.g. SQLite in memory).
+    """
+
+    def setUp(self):
+        self.users = [RunnerUser.objects.create(username=f"runner{i}", dob=date(1990, 1, 1),
+                                                fitness_level="intermediate", date_of_marathon=MARATHON_DATE)
+                      for i in range(3)]
+        for user in self.users:
+            jobs.enqueue("create_plan", f"create_plan:{user.id}", user=user)
+
+    def test_a_claimed_job_is_only_claimed_again_once_stale(self):
+        claimed = [jobs.claim_next() for _ in range(len(self.users))]
+        self.assertEqual(len({job.id for job in claimed}), len(self.users))
+        self.assertIsNone(jobs.claim_next())
+
+        # The worker running the first job died
+        Job.objects.filter(id=claimed[0].id).update(updated_at=timezone.now() - jobs.STALE_AFTER)
+        self.assertEqual(jobs.claim_next().id, claimed[0].id)
+
+    def test_a_job_run_twice_creates_one_plan(self):
+        job = jobs.claim_next()
+        jobs.run_job(job)
+        jobs.run_job(job)  # e.g. picked up again after its worker was thought dead
+        self.assertEqual(MarathonPlan.objects.filter(user=job.user).count(), 1)
+
+    def test_a_plan_stores_one_run_per_day(self):
+        jobs.run_pending()
+        run = ScheduledRun.objects.filter(marathon_plan__user=self.users[0]).first()
+        run.pk = None
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            run.save()
+        ScheduledRun.objects.bulk_create([run], ignore_conflicts=True)
+        self.assertEqual(ScheduledRun.objects.filter(marathon_plan=run.marathon_plan, date=run.date).count(), 1)
+
+
+class StravaClientTests(SimpleTestCase):
+
+    def client_for(self, responses, **kwargs):
+        server = FakeStrava(responses)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server, strava_client.StravaClient(api_url=server.url, oauth_url=server.url, backoff_base=0.01, **kwargs)
+
+    def setUp(self):
+        cache.clear()
+        metrics.reset()
+
+    def test_rate_limited_and_failed_calls_are_retried_on_one_connection(self):
+        activities = [{"type": "Run", "distance": 10000}]
+        server, client = self.client_for({"/athlete/activities": [
+            (429, {"message": "Rate Limit Exceeded"}, 0), (503, {}, 0), (200, activities, 0)]})
+
+        self.assertEqual(client.get_activities("token", per_page=5), activities)
+        self.assertEqual(len(server.requests), 3)
+        self.assertEqual(len({port for _, port in server.requests}), 1)
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot["timings"]["strava.request{endpoint=athlete/activities}"]["count"], 3)
+        self.assertEqual(snapshot["counters"]["strava.response{endpoint=athlete/activities,status=429}"], 1)
+
+    def test_client_errors_are_not_retried(self):
+        server, client = self.client_for({"/token": [(401, {"message": "Authorization Error"}, 0)]})
+
+        with self.assertRaises(strava_client.StravaError) as error:
+            client.refresh_token("id", "secret", "refresh")
+        self.assertEqual(error.exception.status, 401)
+        self.assertEqual(len(server.requests), 1)
+
+    def test_slow_responses_time_out(self):
+        server, client = self.client_for({"/athlete/activities": [(200, [], 1), (200, [], 1)]},
+                                         read_timeout=0.2, max_retries=1)
+
+        begin = time.perf_counter()
+        with self.assertRaises(strava_client.StravaError):
+            client.get_activities("token")
+        self.assertLess(time.perf_counter() - begin, 1)
+        self.assertEqual(len(server.requests), 2)
+
+    def test_background_calls_keep_a_share_of_the_rate_limit_for_interactive_calls(self):
+        server, client = self.client_for({"/athlete/activities": [
+            (200, [], 0, {"X-RateLimit-Limit": "10,1000", "X-RateLimit-Usage": "7,100"}), (200, [], 0), (200, [], 0)]})
+
+        client.get_activities("token")
+        with strava_ratelimit.background():
+            client.get_activities("token")
+            with self.assertRaises(strava_client.RateLimitExceeded) as error:
+                client.get_activities("token")
+        self.assertLessEqual(error.exception.retry_after, 15 * 60)
+        self.assertEqual(len(server.requests), 2)
+
+        client.get_activities("token")
+        self.assertEqual(len(server.requests), 3)
+        gauges = metrics.snapshot()["gauges"]
+        self.assertEqual(gauges["strava.ratelimit.used{window=15min}"], 9)
+        self.assertEqual(gauges["strava.ratelimit.limit{window=15min}"], 10)
+
+    @override_settings(STRAVA_RATE_LIMIT_15MIN=10, STRAVA_RATE_LIMIT_DAILY=1000, STRAVA_BACKGROUND_SHARE=0.5)
+    def test_background_share_is_configurable(self):
+        now = time.time()
+        for _ in range(5):
+            self.assertIsNone(strava_ratelimit.acquire(strava_ratelimit.BACKGROUND, now=now))
+        self.assertIsNotNone(strava_ratelimit.acquire(strava_ratelimit.BACKGROUND, now=now))
+        self.assertIsNone(strava_ratelimit.acquire(strava_ratelimit.INTERACTIVE, now=now))
+        self.assertEqual(strava_ratelimit.budget(now)["15min"]["used"], 6)
+
+
+class StravaTestCase(TestCase):
+    """
+    A runner with a virtual plan started two weeks ago and a linked Strava account served by a FakeStrava.
+    """
+
+    responses = {}
+    client_options = {}
+
+    def setUp(self):
+        cache.clear()
+        self.user = RunnerUser.objects.create(username="synced", dob=date(1990, 1, 1),
+                                              fitness_level="beginner", date_of_marathon=MARATHON_DATE)
+        new_plan = plan_algo.NewMarathonPlan(self.user, storage=MarathonPlan.VIRTUAL)
+        new_plan.today = date.today() - timedelta(days=14)
+        self.plan = new_plan.create_plan()[1]
+        StravaUserProfile.objects.create(user=self.user, client_id=1, strava_access_token="token",
+                                         strava_refresh_token="refresh", expires_at=timezone.now() + timedelta(hours=1))
+
+        self.server = FakeStrava({path: list(responses) for path, responses in self.responses.items()})
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        client = strava_client.StravaClient(api_url=self.server.url, oauth_url=self.server.url, **self.client_options)
+        patcher = mock.patch.object(strava_client, "get_client", return_value=client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+def activity(activity_id, run_date, distance=8000, moving_time=2880, activity_type="Run"):
+    return {"id": activity_id, "type": activity_type, "start_date": f"{run_date}T07:00:00Z",
+            "distance": distance, "moving_time": moving_time}
+
+
+YESTERDAY = date.today() - timedelta(days=1)
+
+
+class RunMatchingTests(SimpleTestCase):
+
+    def test_runs_of_a_day_are_aggregated_when_closer_to_the_plan(self):
+        day = date(2024, 5, 1)
+        tempo = ScheduledRun(date=day, dict_id=2, distance=10, est_duration=50, est_avg_pace=timedelta(minutes=5))
+        intervals = ScheduledRun(date=day + timedelta(days=1), dict_id=5, distance=0, est_duration=32,
+                                 est_avg_pace=timedelta(minutes=4.5), on=4, off=4, sets=4)
+        activities = [
+            activity(1, day, 6000, 1800), activity(2, day, 4000, 1200), activity(3, day, 20000, 2400, "Ride"),
+            activity(4, intervals.date, 7000, 1920), activity(5, intervals.date, 2000, 720),
+            activity(6, day + timedelta(days=2), 5000, 1500),
+        ]
+
+        matches = run_matching.match_activities(activities, [tempo, intervals])
+        self.assertEqual([[activity["id"] for activity in match.activities] for match in matches], [[1, 2], [4]])
+        self.assertEqual([match.score for match in matches], [1.0, 1.0])
+
+
+class StravaSyncTests(StravaTestCase):
+
+    responses = {"/athlete/activities": [(200, [
+        activity(1, YESTERDAY), activity(2, YESTERDAY, distance=30000, moving_time=3600, activity_type="Ride"),
+    ], 0)]}
+
+    def test_sync_runs_in_the_background_and_completes_matching_runs(self):
+        job = strava_funcs.enqueue_sync(self.user)
+        self.assertEqual(strava_funcs.enqueue_sync(self.user), job)
+        self.assertFalse(self.server.requests)
+
+        self.assertEqual(jobs.run_pending(), 2)  # The sync, then the streams of the run
+        completed_run = CompletedRun.objects.get(scheduled_run__marathon_plan=self.plan)
+        self.assertEqual((completed_run.distance, completed_run.duration), (8, 48))
+        self.assertEqual(completed_run.scheduled_run.date, YESTERDAY)
+
+        self.assertIn(f"after={strava_funcs.day_start(self.plan.start_date)}", self.server.requests[0][0])
+        self.assertIsNotNone(StravaUserProfile.objects.get(user=self.user).last_synced_at)
+
+    def test_index_renders_without_calling_strava(self):
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get("/").status_code, 200)
+        self.assertFalse(self.server.requests)
+
+
+DAYS = [YESTERDAY - timedelta(days=2), YESTERDAY - timedelta(days=1), YESTERDAY]
+ACTIVITIES = [activity(i * 3 + j + 1, day, distance=2000 * (j + 1), moving_time=600 * (j + 1))
+              for i, day in enumerate(DAYS) for j in range(3)]
+
+
+@mock.patch.object(strava_funcs, "SYNC_PAGE_SIZE", 4)
+class StravaSyncPagingTests(StravaTestCase):
+
+    responses = {"/athlete/activities": [(200, ACTIVITIES[:4], 0), (200, ACTIVITIES[4:8], 0),
+                                         (200, ACTIVITIES[8:], 0)]}
+
+    def test_sync_pages_until_a_short_page_and_completes_whole_days(self):
+        self.assertEqual(strava_funcs.sync_activities(self.user), 3)
+        self.assertEqual([request.split("&page=")[1][0] for request, _ in self.server.requests], ["1", "2", "3"])
+
+        expected = run_matching.match_activities(ACTIVITIES, plan_store.get_runs(self.plan, DAYS[0], DAYS[-1]))
+        completed = {run.date: run.strava_activity_ids for run in CompletedRun.objects.all()}
+        self.assertEqual(completed, {match.scheduled_run.date: [activity["id"] for activity in match.activities]
+                                     for match in expected})
+
+
+@mock.patch.object(strava_funcs, "SYNC_PAGE_SIZE", 4)
+class StravaSyncResumeTests(StravaTestCase):
+
+    responses = {"/athlete/activities": [(200, ACTIVITIES[:4], 0), (503, {}, 0)]}
+    client_options = {"max_retries": 0}
+
+    def test_failed_sync_resumes_from_the_newest_imported_activity(self):
+        with self.assertRaises(strava_client.StravaError):
+            strava_funcs.sync_activities(self.user)
+
+        # Only the first day was complete when Strava failed
+        self.assertEqual(list(CompletedRun.objects.values_list("date", flat=True)), [DAYS[0]])
+        last_synced_at = StravaUserProfile.objects.get(user=self.user).last_synced_at
+        self.assertEqual(last_synced_at, datetime.fromisoformat(f"{DAYS[0]}T07:00:00+00:00"))
+
+
+class RunnerContextTests(StravaTestCase):
+
+    @override_settings(RUNNER_CONTEXT_CACHE_TIMEOUT=60)
+    def test_plan_and_profile_are_read_once_and_cached_until_saved(self):
+        with self.assertNumQueries(1):
+            context = runner_context.RunnerContext(self.user)
+            self.assertEqual((context.plan, context.strava_profile.client_id), (self.plan, 1))
+            self.assertEqual(context.plan, self.plan)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(runner_context.RunnerContext(self.user).strava_profile.client_id, 1)
+
+        StravaUserProfile.objects.filter(user=self.user).get().delete()
+        with self.assertNumQueries(1):
+            self.assertIsNone(runner_context.RunnerContext(self.user).strava_profile)
+
+
+class StravaCircuitBreakerTests(StravaTestCase):
+
+    responses = {"/athlete/activities": [(503, {}, 0)] * strava_breaker.FAILURE_THRESHOLD + [
+        (200, [activity(1, YESTERDAY)], 0)]}
+    client_options = {"max_retries": 0}
+
+    def setUp(self):
+        super().setUp()
+        metrics.reset()
+
+    def test_circuit_opens_on_outages_fails_fast_and_closes_after_a_probe(self):
+        for _ in range(strava_breaker.FAILURE_THRESHOLD):
+            with self.assertRaises(strava_client.StravaError):
+                strava_funcs.sync_activities(self.user)
+        self.assertEqual(strava_breaker.state(), strava_breaker.OPEN)
+        self.assertFalse(strava_funcs.sync_status(self.user)["available"])
+
+        # Jobs fail fast and wait for the circuit, without using up an attempt
+        job = strava_funcs.enqueue_sync(self.user)
+        jobs.run_pending()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.PENDING, 0))
+        self.assertEqual(len(self.server.requests), strava_breaker.FAILURE_THRESHOLD)
+
+        # Once the circuit has been open long enough, a probe goes through and closes it
+        cache.set(strava_breaker.STATE_KEY, time.time() - 1, None)
+        self.assertEqual(strava_funcs.sync_activities(self.user), 1)
+        self.assertEqual(strava_breaker.state(), strava_breaker.CLOSED)
+
+        status = strava_funcs.sync_status(self.user)
+        self.assertTrue(status["available"])
+        self.assertEqual(status["latest_run"]["date"], YESTERDAY)
+        counters = metrics.snapshot()["counters"]
+        for state in (strava_breaker.OPEN, strava_breaker.HALF_OPEN, strava_breaker.CLOSED):
+            self.assertEqual(counters[f"strava.breaker.transition{{state={state}}}"], 1)
+
+
+@override_settings(STRAVA_WEBHOOK_VERIFY_TOKEN="verify-me")
+class StravaWebhookTests(StravaTestCase):
+
+    responses = {"/activities/7": [(200, activity(7, YESTERDAY), 0),
+                                   (200, activity(7, YESTERDAY, distance=12000, moving_time=3600), 0)],
+                 "/athlete/activities": [(200, [activity(7, YESTERDAY)], 0),
+                                         (200, [activity(7, YESTERDAY, distance=12000, moving_time=3600)], 0),
+                                         (200, [], 0)]}
+
+    def post_event(self, event):
+        return self.client.post("/webhooks/strava", event, content_type="application/json")
+
+    def test_subscription_handshake(self):
+        params = {"hub.mode": "subscribe", "hub.challenge": "abc", "hub.verify_token": "verify-me"}
+        self.assertEqual(self.client.get("/webhooks/strava", params).json(), {"hub.challenge": "abc"})
+
+        params["hub.verify_token"] = "wrong"
+        self.assertEqual(self.client.get("/webhooks/strava", params).status_code, 403)
+
+    def test_activity_events_upsert_and_delete_the_completed_run(self):
+        created = strava_events.make_event(owner_id=1, object_id=7, event_time=1000)
+        self.assertIsNotNone(self.post_event(created).json()["job_id"])
+        self.assertIsNone(self.post_event(created).json()["job_id"])  # Delivered twice
+        self.assertEqual(jobs.run_pending(), 2)  # The event, then the streams of the run
+        self.assertEqual(CompletedRun.objects.get(strava_activity_id=7).distance, 8)
+
+        self.post_event(strava_events.make_event(owner_id=1, object_id=7, aspect_type="update", event_time=1001))
+        jobs.run_pending()
+        completed_run = CompletedRun.objects.get(strava_activity_id=7)
+        self.assertEqual((completed_run.distance, completed_run.scheduled_run.date), (12, YESTERDAY))
+
+        self.post_event(strava_events.make_event(owner_id=1, object_id=7, aspect_type="delete", event_time=1002))
+        jobs.run_pending()
+        self.assertFalse(CompletedRun.objects.exists())
+        # Only the affected activity, the activities of its day and its streams (once) were fetched
+        self.assertEqual(len(self.server.requests), 6)
+
+    def test_runs_of_an_activity_are_found_in_one_query(self):
+        for days, activity_ids in ((2, [1]), (3, [2, 3]), (4, [4])):
+            run = plan_store.materialize(plan_store.get_run(self.plan, date.today() - timedelta(days=days)))
+            CompletedRun.objects.create(scheduled_run=run, date=run.date, distance=5, duration=30,
+                                        avg_pace=timedelta(minutes=6), strava_activity_id=activity_ids[0],
+                                        strava_activity_ids=activity_ids)
+
+        with self.assertNumQueries(1):
+            self.assertEqual([run.strava_activity_ids for run in strava_funcs.imported_runs(self.plan, 3)], [[2, 3]])
+        self.assertEqual([run.strava_activity_id for run in strava_funcs.imported_runs(self.plan, 4)], [4])
+        self.assertEqual(strava_funcs.imported_runs(self.plan, 5), [])
+
+    def test_events_of_unknown_athletes_are_ignored(self):
+        self.assertIsNone(self.post_event(strava_events.make_event(owner_id=99, object_id=7)).json()["job_id"])
+        self.assertEqual(self.post_event({"object_type": "activity"}).status_code, 400)
+
+
+class StravaTokenRefreshTests(StravaTestCase):
+
+    token = {"access_token": "new-token", "refresh_token": "new-refresh", "expires_in": 21600}
+    responses = {"/token": [(200, token, 0), (200, token, 0), (401, {"message": "Bad Request"}, 0)]}
+
+    def setUp(self):
+        super().setUp()
+        metrics.reset()
+        StravaUserProfile.objects.filter(user=self.user).update(expires_at=timezone.now() + timedelta(minutes=5))
+        for username, expires_in in (("expired", -10), ("fresh", 120)):
+            user = RunnerUser.objects.create(username=username, dob=date(1990, 1, 1),
+                                             fitness_level="beginner", date_of_marathon=MARATHON_DATE)
+            StravaUserProfile.objects.create(user=user, strava_access_token="token", strava_refresh_token="refresh",
+                                             expires_at=timezone.now() + timedelta(minutes=expires_in))
+
+    def test_expiring_tokens_are_refreshed_ahead_and_read_from_the_cache(self):
+        call_command("refresh_strava_tokens", "--concurrency", "1", stdout=open(os.devnull, "w"))
+
+        tokens = dict(StravaUserProfile.objects.values_list("user__username", "strava_access_token"))
+        self.assertEqual(tokens, {"synced": "new-token", "expired": "new-token", "fresh": "token"})
+        with self.assertNumQueries(0):
+            self.assertEqual(strava_funcs.get_access_token(self.user), "new-token")
+
+        # The next scan only finds the token that failed to refresh
+        StravaUserProfile.objects.filter(user__username="expired").update(expires_at=timezone.now())
+        call_command("refresh_strava_tokens", stdout=open(os.devnull, "w"))
+        self.assertEqual(metrics.snapshot()["counters"]["strava.token_refresh{result=failed}"], 1)
+
+    @override_settings(RUNNER_CONTEXT_CACHE_TIMEOUT=60)
+    def test_cached_runner_contexts_see_the_refreshed_token(self):
+        self.assertEqual(runner_context.RunnerContext(self.user).strava_profile.strava_access_token, "token")
+        call_command("refresh_strava_tokens", "--concurrency", "1", stdout=open(os.devnull, "w"))
+        self.assertEqual(runner_context.RunnerContext(self.user).strava_profile.strava_access_token, "new-token")
+
+    def test_token_is_read_with_one_query_when_not_cached(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(strava_funcs.get_access_token(self.user), "token")
+
+
+class ActivityStreamTests(StravaTestCase):
+
+    # 5 minutes at 100 bpm (Z1) then 5 minutes at 150 bpm (Z4), for a maximum heart rate of 220 - 36
+    streams = {"time": list(range(600)), "heartrate": [100] * 300 + [150] * 300, "velocity_smooth": [3.2] * 600}
+    responses = {"/activities/21/streams": [(200, {name: {"data": data} for name, data in streams.items()}, 0)]}
+
+    def test_streams_are_stored_compressed_and_give_the_minutes_in_each_zone(self):
+        self.user.dob = YESTERDAY.replace(year=YESTERDAY.year - 36)
+        self.user.save()
+        strava_funcs.complete_runs(self.plan, [activity(21, YESTERDAY)])
+        jobs.run_pending()
+
+        completed_run = CompletedRun.objects.get(strava_activity_id=21)
+        self.assertEqual(completed_run.zone_minutes, [5.0, 0.0, 0.0, 5.0, 0.0])
+
+        stream = ActivityStream.objects.get(strava_activity_id=21)
+        self.assertLess(len(stream.data), 600 * 7)
+        arrays = activity_streams.decode(stream.data, stream.n_samples)
+        self.assertEqual(arrays["heartrate"][-1], 150)
+        self.assertEqual(arrays["velocity_smooth"][0], 320)
+        self.assertFalse(arrays["time"].flags.owndata)
+
+
+def days_ago(days):
+    return date.today() - timedelta(days=days)
+
+
+class StravaBackfillTests(StravaTestCase):
+
+    responses = {"/athlete/activities": [
+        (200, [activity(11, days_ago(6)), activity(12, days_ago(6))], 0),
+        (200, [activity(13, days_ago(5), activity_type="Ride"), activity(14, days_ago(4))], 0),
+        (429, {"message": "Rate Limit Exceeded"}, 0),
+        (200, [activity(14, days_ago(4)), activity(15, days_ago(2))], 0),
+        (200, [], 0),
+    ]}
+    client_options = {"max_retries": 0}
+
+    def test_backfill_pages_through_history_and_resumes_from_its_checkpoint(self):
+        job = strava_funcs.enqueue_backfill(StravaUserProfile.objects.get(user=self.user))
+        with mock.patch.object(strava_backfill, "BACKFILL_PAGE_SIZE", 2):
+            jobs.run_pending()
+            job.refresh_from_db()
+            self.assertEqual(job.status, Job.PENDING)  # Rate limited, retried later
+            self.assertEqual(CompletedRun.objects.count(), 1)  # The last day read may go on in the next page
+
+            Job.objects.filter(id=job.id).update(run_after=timezone.now())
+            jobs.run_pending()
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.DONE)
+        checkpoint = datetime.fromisoformat(f"{days_ago(5)}T07:00:00+00:00").timestamp()
+        pages = [path for path, _ in self.server.requests if path.startswith("/athlete/activities")]
+        self.assertIn(f"after={int(checkpoint)}", pages[-1])
+        self.assertEqual(sorted(CompletedRun.objects.values_list("strava_activity_id", flat=True)), [11, 14, 15])
+        self.assertEqual(len(set(CompletedRun.objects.values_list("scheduled_run__date", flat=True))), 3)
+
+
+@mock.patch.object(strava_backfill, "BACKFILL_PAGE_SIZE", 4)
+class StravaBackfillPagingTests(StravaTestCase):
+
+    responses = {"/athlete/activities": [(200, ACTIVITIES[:4], 0), (200, ACTIVITIES[4:8], 0),
+                                         (200, ACTIVITIES[8:], 0)]}
+
+    def test_backfill_matches_days_that_span_two_pages_whole(self):
+        checkpoints = []
+        after = int(datetime.fromisoformat(f"{DAYS[0]}T00:00:00+00:00").timestamp())
+        counts = strava_backfill.backfill_activities(self.user, after, after + 7 * 86400, checkpoints.append)
+        self.assertEqual(counts, {"pages": 3, "activities": len(ACTIVITIES), "completed": 3})
+
+        expected = run_matching.match_activities(ACTIVITIES, plan_store.get_runs(self.plan, DAYS[0], DAYS[-1]))
+        completed = {run.date: run.strava_activity_ids for run in CompletedRun.objects.all()}
+        self.assertEqual(completed, {match.scheduled_run.date: [activity["id"] for activity in match.activities]
+                                     for match in expected})
+        # Every checkpoint is the start of the last activity of a whole day
+        self.assertEqual(checkpoints, [int(datetime.fromisoformat(f"{day}T07:00:00+00:00").timestamp())
+                                       for day in DAYS])
+
+
+class StravaLoadTestTests(TestCase):
+
+    def test_load_test_syncs_simulated_runners_against_the_fake_and_rolls_back(self):
+        out = StringIO()
+        call_command("load_test_strava", "--users", "2", "--syncs-per-day", "2", "--latency", "0", "--seed", "1",
+                     stdout=out)
+
+        report = out.getvalue()
+        self.assertIn("Index: 4 pages", report)
+        self.assertIn("0 failed", report)
+        self.assertRegex(report, r"Strava: \d+ calls, 0 errors")
+        self.assertFalse(RunnerUser.objects.filter(username__startswith="loadtest-").exists())
@@ -8,12 +8,16 @@ URL Patterns:
 - /scheduled-runs: Displays scheduled runs for the user.
 - /completed-runs: Displays completed runs for the user.
 - /settings: Displays user settings.
+- /settings/plan: Saves the settings of the user's plan.
 - /accounts/register: Handles user registration.
 - /social/remove-strava-account: Removes the Strava account linked to the user.
 - /api/get-scheduled-runs: API endpoint to get scheduled runs for the user.
 - /api/get-completed-runs: API endpoint to get completed runs for the user.
 - /api/get-todays-run: API endpoint to get today's scheduled run for the user.
+- /api/dashboard: API endpoint to get today's run, the next runs and the plan countdown for the user.
 - /api/update-completed-run: API endpoint to update a completed run.
+- /api/job-status/<job_id>: API endpoint to get the status of a background job of the user.
+- /webhooks/strava: Strava webhook (push subscription) receiver.
 
 Usage:
 1. Include these URL patterns in your Django project's main urls.py using the include function:
@@ -50,6 +54,7 @@ urlpatterns = [
     path("scheduled-runs", views.scheduled_runs, name="scheduled-runs"),
     path("completed-runs", views.completed_runs, name="completed-runs"),
     path("settings", views.settings, name="settings"),
+    path("settings/plan", views.update_plan_settings, name="update-plan-settings"),
     path("accounts/register", views.register, name="register"),
     path("social/remove-strava-account",
          views.remove_strava_account, name="remove-strava-account"),
@@ -58,6 +63,9 @@ urlpatterns = [
     path("api/get-completed-runs", views.get_completed_runs,
          name="get-completed-runs"),
     path("api/get-todays-run", views.get_todays_run, name="get-todays-run"),
+    path("api/dashboard", views.get_dashboard, name="dashboard"),
     path("api/update-completed-run", views.update_completed_run,
-         name="update-completed-run")
+         name="update-completed-run"),
+    path("api/job-status/<int:job_id>", views.get_job_status, name="job-status"),
+    path("webhooks/strava", views.strava_webhook_view, name="strava-webhook")
 ]
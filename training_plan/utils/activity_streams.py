@@ -0,0 +1,182 @@
+"""
+Module implementing the store of Strava activity streams and the time spent in each heart rate zone.
+
+The streams of an activity (one sample per second or so: time, heart rate and velocity) are far too large to store
+as rows, so each activity's streams are stored as one compressed blob in ActivityStream: the typed arrays are laid
+out one after the other, largest items first so every array stays aligned, and the whole buffer is compressed with
+zlib. Reading an activity decompresses the blob once and returns NumPy views over that buffer, without copying.
+
+Only the minutes spent in each of the zones Z1 to Z5 (see plan_algo.py) are kept on the CompletedRun, so pages
+never load the streams. The zones are fractions of the runner's maximum heart rate, estimated from their date of
+birth (220 minus their age on the day of the run).
+
+Functions:
+- encode(streams): Encodes the streams of an activity into a compressed blob.
+- decode(blob, n_samples): Decodes a blob into NumPy views, without copying.
+- max_heart_rate(dob, day): Estimates the maximum heart rate of a runner.
+- zone_minutes(time, heartrate, max_hr): Computes the minutes spent in each heart rate zone.
+- store_streams(activity_id, streams): Stores the streams of an activity.
+- update_zone_minutes(user, activity_ids): Fetches the missing streams of a completed run and sets its zone minutes.
+
+Example:
+python
+stream = ActivityStream.objects.get(strava_activity_id=activity_id)
+arrays = decode(stream.data, stream.n_samples)
+minutes = zone_minutes(arrays["time"], arrays["heartrate"], max_heart_rate(user.dob, stream_date))
+
+"""
+
+import zlib
+
+import numpy as np
+
+from ..models import ActivityStream, CompletedRun, ScheduledRun
+from . import p_a_constants as c
+from . import plan_version, strava_breaker, strava_client, strava_funcs
+
+# Name, stored type and scale of each stream, largest items first so that every array stays aligned
+STREAMS = (
+    ("time", np.dtype("<u4"), 1),  # Seconds since the start
+    ("velocity_smooth", np.dtype("<u2"), 100),  # Centimetres per second
+    ("heartrate", np.dtype("u1"), 1),  # Beats per minute, 0 where missing
+)
+MAX_SAMPLE_GAP = 10  # Longest time a sample counts for, in seconds, so pauses aren't counted
+
+
+def encode(streams) -> bytes:
+    """
+    Encode the streams of an activity into a compressed blob.
+
+    Args:
+    - streams (dict): The data of each stream by name, as returned by Strava (e.g. velocity in metres per second).
+      Missing streams are stored as zeros.
+
+    Returns:
+    - bytes: The compressed blob.
+    """
+
+    n_samples = len(streams["time"])
+    buffer = b"".join(
+        np.round(np.asarray(streams.get(name, np.zeros(n_samples)), dtype=float) * scale).clip(
+            0, np.iinfo(dtype).max).astype(dtype).tobytes()
+        for name, dtype, scale in STREAMS)
+    return zlib.compress(buffer)
+
+
+def decode(blob, n_samples) -> dict:
+    """
+    Decode a blob into read-only NumPy views over the decompressed buffer, without copying.
+
+    Args:
+    - blob (bytes): The compressed blob.
+    - n_samples (int): The number of samples of each stream.
+
+    Returns:
+    - dict: The stored array of each stream by name (velocities are in centimetres per second).
+    """
+
+    buffer = zlib.decompress(blob)
+    arrays, offset = {}, 0
+    for name, dtype, _ in STREAMS:
+        arrays[name] = np.frombuffer(buffer, dtype=dtype, count=n_samples, offset=offset)
+        offset += dtype.itemsize * n_samples
+    return arrays
+
+
+def max_heart_rate(dob, day) -> int:
+    """
+    Estimate the maximum heart rate of a runner as 220 minus their age on a given day.
+    """
+
+    age = day.year - dob.year - ((day.month, day.day) < (dob.month, dob.day))
+    return 220 - age
+
+
+def zone_minutes(time, heartrate, max_hr) -> list:
+    """
+    Compute the minutes spent in each of the heart rate zones Z1 to Z5.
+
+    Args:
+    - time (ndarray): Seconds since the start of each sample.
+    - heartrate (ndarray): Heart rate of each sample, 0 where missing.
+    - max_hr (int): The maximum heart rate of the runner.
+
+    Returns:
+    - list: The minutes spent in each zone, rounded to 1 decimal.
+    """
+
+    if len(time) == 0:
+        return [0.0] * len(c.HEART_RATE_ZONES)
+
+    # Each sample counts until the next one
+    seconds = np.minimum(np.diff(time.astype(np.int64), append=time[-1]), MAX_SAMPLE_GAP)
+    zones = np.searchsorted(np.array(c.HEART_RATE_ZONES) * max_hr, heartrate, side="right")
+    seconds_in_zone = np.bincount(zones, weights=seconds, minlength=len(c.HEART_RATE_ZONES) + 1)[1:]
+    return np.round(seconds_in_zone / 60, 1).tolist()
+
+
+def store_streams(activity_id, streams):
+    """
+    Store the streams of an activity, replacing any stored before.
+
+    Args:
+    - activity_id (int): The ID of the Strava activity.
+    - streams (dict): The data of each stream by name, as returned by Strava.
+
+    Returns:
+    - ActivityStream: The stored streams.
+    """
+
+    stream, _ = ActivityStream.objects.update_or_create(
+        strava_activity_id=activity_id, defaults={"n_samples": len(streams["time"]), "data": encode(streams)})
+    return stream
+
+
+def update_zone_minutes(user, activity_ids):
+    """
+    Fetch the streams of the activities of a completed run that aren't stored yet, and set the minutes the run
+    spent in each heart rate zone.
+
+    Args:
+    - user: The runner.
+    - activity_ids (list): The IDs of the Strava activities the completed run was aggregated from.
+
+    Raises:
+    - StravaError: If Strava can't be reached or the circuit is open (the job is then retried).
+
+    Returns:
+    - list or None: The minutes spent in each zone, or None if the run no longer exists.
+    """
+
+    completed_run = CompletedRun.objects.filter(strava_activity_id=activity_ids[0]).first()
+    if completed_run is None:
+        return None
+
+    streams = {stream.strava_activity_id: stream
+               for stream in ActivityStream.objects.filter(strava_activity_id__in=activity_ids)}
+    missing = [activity_id for activity_id in activity_ids if activity_id not in streams]
+    if missing:
+        access_token = strava_funcs.get_access_token(user)
+        for activity_id in missing:
+            try:
+                with strava_breaker.guard():
+                    data = strava_client.get_client().get_streams(access_token, activity_id)
+            except strava_client.StravaError as e:
+                if e.status != 404:
+                    raise
+                continue  # Manual activities have no streams
+            if "time" in data:
+                streams[activity_id] = store_streams(activity_id, data)
+
+    max_hr = max_heart_rate(user.dob, completed_run.date)
+    minutes = np.zeros(len(c.HEART_RATE_ZONES))
+    for stream in streams.values():
+        arrays = decode(stream.data, stream.n_samples)
+        minutes += zone_minutes(arrays["time"], arrays["heartrate"], max_hr)
+
+    # Updated without saving the run, so the plan isn't adapted again
+    zones = np.round(minutes, 1).tolist()
+    CompletedRun.objects.filter(pk=completed_run.pk).update(zone_minutes=zones)
+    plan_ids = ScheduledRun.objects.filter(pk=completed_run.scheduled_run_id).values_list("marathon_plan_id", flat=True)
+    plan_version.bump(plan_ids)
+    return zones
@@ -0,0 +1,115 @@
+"""
+Module implementing the dashboard of a runner: today's run, whether it has been completed, the next runs and the
+countdown to the marathon.
+
+The index page and its JavaScript (through the api/dashboard endpoint) are both served from get_dashboard(), in
+at most two queries whatever the length of the plan's history: one for the plan (read once per request, see
+runner_context.py), and one for the first stored runs from today, each joined with its completed run. The runs of
+virtual plans that aren't stored are computed without a query (see plan_store.py).
+
+Classes:
+- Dashboard: The plan, today's run and its completed run, and the next runs.
+
+Functions:
+- get_dashboard(plan, today=None, next_count=NEXT_RUNS): Gets the dashboard of a runner.
+- todays_run_values(dashboard): Converts today's run (or its completed run) to a dictionary for the API.
+- dashboard_values(dashboard): Converts a dashboard to a dictionary for the API.
+
+Example:
+python
+dashboard = get_dashboard(request.runner.plan)
+if dashboard is not None:
+    print(dashboard.days_to_go, dashboard.todays_run, dashboard.completed_run)
+
+"""
+
+from collections import namedtuple
+from datetime import date
+
+from django.core import serializers
+
+from ..models import CompletedRun
+from . import plan_store
+
+NEXT_RUNS = 3  # Number of upcoming runs shown after today's run
+
+Dashboard = namedtuple("Dashboard", ["plan", "today", "days_to_go", "todays_run", "completed_run", "next_runs"])
+
+
+def get_dashboard(plan, today=None, next_count=NEXT_RUNS):
+    """
+    Get the dashboard of a runner in one query.
+
+    Args:
+    - plan (MarathonPlan or None): The plan of the runner.
+    - today (date, optional): The current day (defaults to today).
+    - next_count (int, optional): The number of upcoming runs.
+
+    Returns:
+    - Dashboard or None: The dashboard, or None if the runner has no plan yet.
+    """
+
+    if plan is None:
+        return None
+
+    today = today or date.today()
+    # Today's run (if there is one) and the next runs
+    runs = plan_store.get_next_runs(plan, today, next_count + 1, with_completed=True)
+
+    todays_run = completed_run = None
+    if len(runs) and runs[0].date == today:
+        todays_run = runs[0]
+        if todays_run.pk is not None:
+            try:
+                completed_run = todays_run.completedrun
+            except CompletedRun.DoesNotExist:
+                pass
+
+    next_runs = [run for run in runs if run.date > today][:next_count]
+    return Dashboard(plan, today, (plan.end_date - today).days, todays_run, completed_run, next_runs)
+
+
+def todays_run_values(dashboard):
+    """
+    Convert today's run to a dictionary: the fields of its completed run if there is one, or of the scheduled run
+    otherwise, with its "run_id" and whether it is "completed".
+
+    Args:
+    - dashboard (Dashboard): The dashboard.
+
+    Returns:
+    - dict or None: The fields of the run, or None if there is no run today.
+    """
+
+    if dashboard.todays_run is None:
+        return None
+
+    run = dashboard.completed_run or dashboard.todays_run
+    serialized_data = serializers.serialize("python", [run])
+    values = serialized_data[0]["fields"]
+    values["run_id"] = serialized_data[0]["pk"]
+    values["completed"] = dashboard.completed_run is not None
+    return values
+
+
+def dashboard_values(dashboard):
+    """
+    Convert a dashboard to a dictionary for the api/dashboard endpoint.
+
+    Args:
+    - dashboard (Dashboard): The dashboard.
+
+    Returns:
+    - dict: The "plan" countdown, "todays_run" (see todays_run_values) and the "next_runs".
+    """
+
+    return {
+        "plan": {
+            "start_date": dashboard.plan.start_date,
+            "end_date": dashboard.plan.end_date,
+            "today": dashboard.today,
+            "days_to_go": dashboard.days_to_go,
+        },
+        "todays_run": todays_run_values(dashboard),
+        "next_runs": [plan_store.run_values(run) for run in dashboard.next_runs],
+    }
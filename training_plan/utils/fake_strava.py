@@ -0,0 +1,294 @@
+"""
+Module implementing a local fake of the Strava API, to test and load test the Strava integration offline.
+
+The fake serves the endpoints the app uses, under the same paths as Strava, so the app only has to be pointed at
+it with settings.STRAVA_API_BASE_URL:
+- POST /oauth/token: Exchanges a refresh token for a new access token.
+- GET /api/v3/athlete/activities: Lists the activities of the athlete, paginated, filtered by after and before.
+- GET /api/v3/activities/<id>: Gets one activity.
+- GET /api/v3/activities/<id>/streams: Gets the streams of one activity.
+- POST, GET and DELETE /api/v3/push_subscriptions: Manages the webhook subscription, with the validation handshake.
+  Events are then pushed to the callback with push_event().
+
+Every athlete of the fake has a history of generated runs, the same for a given seed. Access tokens are
+"fake-<athlete id>" and refresh tokens "refresh-<athlete id>". Latency, a share of 503 errors and the 15-minute and
+daily rate limits (with their X-RateLimit-* headers) are configurable.
+
+For tests, the responses can be scripted instead, per path (with the /api/v3 or /oauth prefix removed): each one is
+a (status, body, delay) tuple, optionally followed by a dict of headers, served in order. Other paths, and scripted
+paths that have run out of responses, are then answered with a 404.
+
+Classes:
+- FakeStrava: The fake Strava API server, served from a background thread.
+
+Example:
+python
+server = FakeStrava(latency=0.05, error_rate=0.01, rate_limit=(600, 30000))
+with override_settings(STRAVA_API_BASE_URL=server.url):
+    ...
+server.shutdown()
+
+"""
+
+import json
+import random
+import threading
+import time
+from datetime import date, datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+import requests
+
+PREFIXES = ("/api/v3", "/oauth")
+TOKEN_LIFETIME = 6 * 60 * 60  # Seconds an access token is valid for, like Strava's
+WINDOWS = (15 * 60, 24 * 60 * 60)  # Rate limit windows, in seconds
+
+
+class FakeStrava(ThreadingHTTPServer):
+    """
+    Local fake of the Strava API, served from a background thread as soon as it is created.
+
+    Args:
+    - responses (dict, optional): Scripted responses by path; every path is simulated if None.
+    - latency (float, optional): Seconds added to every simulated response.
+    - error_rate (float, optional): Share of simulated requests answered with a 503.
+    - rate_limit (tuple, optional): Requests allowed per 15 minutes and per day; no limit if None.
+    - history_days (int, optional): Days of runs in the history of every athlete.
+    - seed (int, optional): Seed of the generated histories and errors.
+    - host (str, optional): Interface to listen on.
+    - port (int, optional): Port to listen on (defaults to a free port).
+
+    Attributes:
+    - url (str): Base URL of the fake, to use as settings.STRAVA_API_BASE_URL.
+    - requests (list): The path (with its query string) and client port of every request received.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # Keeps connections alive
+
+        def do_GET(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))  # Keeps the connection usable
+            path, _, query = self.path.partition("?")
+            for prefix in PREFIXES:
+                if path.startswith(prefix + "/"):
+                    path = path[len(prefix):]
+            self.server.requests.append((path + ("?" + query if query else ""), self.client_address[1]))
+
+            if self.server.responses is not None:
+                responses = self.server.responses.get(path) or [(404, {"message": "Not Found"}, 0)]
+                status, payload, delay, headers = (*responses.pop(0), {})[:4]
+            else:
+                params = dict(parse_qsl(query))
+                if self.headers.get("Content-Type", "").startswith("application/x-www-form-urlencoded"):
+                    params.update(parse_qsl(body.decode()))
+                status, payload, headers = self.server.simulate(self.command, path, params,
+                                                                self.headers.get("Authorization", ""))
+                delay = self.server.latency
+            time.sleep(delay)
+
+            data = b"" if status == 204 else json.dumps(payload).encode()
+            try:
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+            except ConnectionError:
+                pass  # The client timed out
+
+        do_POST = do_DELETE = do_GET
+
+        def log_message(self, *args):
+            pass
+
+    def __init__(self, responses=None, latency=0.0, error_rate=0.0, rate_limit=None, history_days=30, seed=None,
+                 host="127.0.0.1", port=0):
+        super().__init__((host, port), self.Handler)
+        self.responses = responses
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.history_days = history_days
+        self.seed = seed
+        self.requests = []
+        self.subscription = None
+        self.url = f"http://{host}:{self.server_address[1]}"
+
+        self._random = random.Random(seed)
+        self._usage = {}
+        self._histories = {}
+        self._lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def simulate(self, method, path, params, authorization):
+        """
+        Answer a request from the generated histories.
+
+        Returns:
+        - tuple: The status, the body and the headers of the response.
+        """
+
+        with self._lock:
+            headers = self._count_request()
+            if headers.pop("exceeded", False):
+                return 429, {"message": "Rate Limit Exceeded"}, headers
+            if self._random.random() < self.error_rate:
+                return 503, {"message": "Service Unavailable"}, headers
+
+        parts = path.strip("/").split("/")
+        if method == "POST" and parts == ["token"]:
+            return (*self._token(params), headers)
+        if parts[0] == "push_subscriptions":
+            return (*self._subscription(method, parts, params), headers)
+
+        athlete_id = _athlete(authorization.removeprefix("Bearer "), "fake-")
+        if athlete_id is None:
+            return 401, {"message": "Authorization Error"}, headers
+        activities = self._history(athlete_id)
+
+        if parts == ["athlete", "activities"]:
+            return 200, _page(activities, params), headers
+        if parts[0] == "activities" and len(parts) in (2, 3):
+            activity = next((activity for activity in activities if str(activity["id"]) == parts[1]), None)
+            if activity is None:
+                return 404, {"message": "Record Not Found"}, headers
+            if len(parts) == 2:
+                return 200, activity, headers
+            if parts[2] == "streams":
+                return 200, _streams(activity), headers
+        return 404, {"message": "Not Found"}, headers
+
+    def push_event(self, event):
+        """
+        Push a webhook event (see strava_events.py) to the callback of the subscription.
+
+        Returns:
+        - int: The status the callback answered with.
+        """
+
+        if self.subscription is None:
+            raise RuntimeError("No push subscription")
+        return requests.post(self.subscription["callback_url"], json=event, timeout=10).status_code
+
+    def _count_request(self):
+        """
+        Count the request in the rate limit windows and get the rate limit headers of the response.
+        """
+
+        if self.rate_limit is None:
+            return {}
+        now = time.time()
+        usage = []
+        for seconds in WINDOWS:
+            key = (seconds, int(now // seconds))
+            self._usage[key] = self._usage.get(key, 0) + 1
+            usage.append(self._usage[key])
+        headers = {"X-RateLimit-Limit": ",".join(map(str, self.rate_limit)),
+                   "X-RateLimit-Usage": ",".join(map(str, usage))}
+        if any(used > limit for used, limit in zip(usage, self.rate_limit)):
+            headers["exceeded"] = True
+        return headers
+
+    def _token(self, params):
+        athlete_id = _athlete(params.get("refresh_token", ""), "refresh-")
+        if params.get("grant_type") != "refresh_token" or athlete_id is None:
+            return 400, {"message": "Bad Request"}
+        return 200, {"token_type": "Bearer", "access_token": f"fake-{athlete_id}",
+                     "refresh_token": f"refresh-{athlete_id}", "expires_at": int(time.time()) + TOKEN_LIFETIME,
+                     "expires_in": TOKEN_LIFETIME}
+
+    def _subscription(self, method, parts, params):
+        if method == "GET":
+            return 200, [self.subscription] if self.subscription else []
+        if method == "DELETE":
+            self.subscription = None
+            return 204, None
+        if self.subscription is not None:
+            return 400, {"message": "Subscription already exists"}
+
+        # The validation handshake: the callback must echo the challenge
+        challenge = str(self._random.getrandbits(32))
+        try:
+            response = requests.get(params.get("callback_url", ""), timeout=10, params={
+                "hub.mode": "subscribe", "hub.challenge": challenge, "hub.verify_token": params.get("verify_token")})
+            echoed = response.ok and response.json().get("hub.challenge") == challenge
+        except (requests.RequestException, ValueError):
+            echoed = False
+        if not echoed:
+            return 400, {"message": "Callback validation failed"}
+        self.subscription = {"id": 1, "callback_url": params["callback_url"]}
+        return 201, {"id": 1}
+
+    def _history(self, athlete_id):
+        """
+        Get the runs of an athlete over the last history_days, oldest first: most days a run at 7am, some days
+        followed by a short second run at 6pm.
+        """
+
+        with self._lock:
+            if athlete_id not in self._histories:
+                rng = random.Random(f"{self.seed}:{athlete_id}")
+                today = date.today()
+                activities = []
+                for days_ago in range(self.history_days, 0, -1):
+                    day = today - timedelta(days=days_ago)
+                    if rng.random() < 0.2:
+                        continue  # Rest day
+                    for run, (hour, distance) in enumerate([(7, rng.uniform(4000, 16000)), (18, 3000)]):
+                        if run and rng.random() > 0.15:
+                            break
+                        pace = rng.uniform(4.5, 6.5) * 60  # Seconds per km
+                        activities.append({
+                            "id": athlete_id * 1_000_000 + (today - day).days * 10 + run,
+                            "type": "Run",
+                            "start_date": datetime.combine(day, datetime.min.time(), tzinfo=timezone.utc).replace(
+                                hour=hour).strftime("%Y-%m-%dT%H:%M:%SZ"),
+                            "distance": round(distance, 1),
+                            "moving_time": int(distance / 1000 * pace),
+                        })
+                self._histories[athlete_id] = activities
+            return self._histories[athlete_id]
+
+
+def _athlete(token, prefix):
+    try:
+        return int(token.removeprefix(prefix)) if token.startswith(prefix) else None
+    except ValueError:
+        return None
+
+
+def _timestamp(activity):
+    return datetime.strptime(activity["start_date"], "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc).timestamp()
+
+
+def _page(activities, params):
+    """
+    Get a page of activities like Strava: filtered by after and before, oldest first when after is given and most
+    recent first otherwise.
+    """
+
+    after, before = float(params.get("after", 0)), float(params.get("before", "inf"))
+    selected = [activity for activity in activities if after < _timestamp(activity) < before]
+    if "after" not in params:
+        selected.reverse()
+    per_page, page = int(params.get("per_page", 30)), int(params.get("page", 1))
+    return selected[(page - 1) * per_page:page * per_page]
+
+
+def _streams(activity):
+    """
+    Generate the streams of an activity: a sample per second, at an even pace and a heart rate drifting up.
+    """
+
+    rng = random.Random(activity["id"])
+    samples = activity["moving_time"]
+    base = rng.randint(120, 150)
+    heartrate = [base + 30 * second // max(samples, 1) + rng.randint(-3, 3) for second in range(samples)]
+    return {
+        "time": {"data": list(range(samples))},
+        "heartrate": {"data": heartrate},
+        "velocity_smooth": {"data": [round(activity["distance"] / samples, 2)] * samples},
+    }
@@ -0,0 +1,196 @@
+"""
+Module implementing a lightweight job queue backed by the database (no external broker).
+
+Jobs are rows of the Job model. Handlers are registered by kind with the handler decorator (see ../tasks.py) and
+run by workers started with `python3 manage.py run_worker`. A worker claims the next due job with
+SELECT ... FOR UPDATE SKIP LOCKED, so several workers can share the queue.
+
+A job that raises is retried with exponential backoff until it reaches its max_attempts, unless it raises
+PermanentJobError. A handler raising an exception with a retry_after attribute (in seconds), e.g. a Strava call
+refused by the rate limit governor, is retried after that delay without using up an attempt. A job left running
+by a worker that died is picked up again once it is stale.
+
+When settings.JOB_QUEUE_EAGER is True, jobs are run as soon as they are enqueued (useful in development).
+
+Functions:
+- handler(kind): Decorator registering the handler for a kind of job.
+- enqueue(kind, idempotency_key, user=None, payload=None, run_after=None): Adds a job to the queue, once per key.
+- claim_next(): Claims the next job that is due.
+- run_job(job): Runs a claimed job and records the outcome.
+- run_pending(max_jobs=None): Runs the jobs that are due, one after the other.
+- purge(before): Deletes the finished jobs last updated before a date and time.
+
+Example:
+python
+@jobs.handler("create_plan")
+def create_plan(job):
+    ...
+
+jobs.enqueue("create_plan", f"create_plan:{user.id}", user=user)
+jobs.run_pending()
+
+"""
+
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from ..models import Job
+
+RETRY_DELAY = timedelta(seconds=10)  # Delay before the first retry, doubled after every attempt
+STALE_AFTER = timedelta(minutes=10)  # Running jobs not updated for this long are claimed again
+
+HANDLERS = {}
+
+
+class PermanentJobError(Exception):
+    """
+    Raised by a handler when retrying the job can't help.
+    """
+
+
+def handler(kind):
+    """
+    Register the decorated function as the handler for a kind of job.
+
+    Args:
+    - kind (str): The kind of job.
+
+    Returns:
+    - function: The decorator.
+    """
+
+    def register(func):
+        HANDLERS[kind] = func
+        return func
+    return register
+
+
+def enqueue(kind, idempotency_key, user=None, payload=None, run_after=None) -> Job:
+    """
+    Add a job to the queue, unless a job with the same idempotency key already exists.
+
+    Args:
+    - kind (str): The kind of job.
+    - idempotency_key (str): The unique key of the job.
+    - user (RunnerUser, optional): The user the job is for.
+    - payload (dict, optional): The arguments of the job.
+    - run_after (datetime, optional): The job is not started before this time.
+
+    Returns:
+    - Job: The new or existing job.
+    """
+
+    job, created = Job.objects.get_or_create(idempotency_key=idempotency_key, defaults={
+        "kind": kind,
+        "user": user,
+        "payload": payload or {},
+        "run_after": run_after or timezone.now(),
+    })
+
+    if created and getattr(settings, "JOB_QUEUE_EAGER", False):
+        run_job(_claim(job))
+        job.refresh_from_db()
+
+    return job
+
+
+def claim_next():
+    """
+    Claim the next job that is due, skipping the jobs locked by other workers.
+
+    Returns:
+    - Job or None: The claimed job, now running, or None if no job is due.
+    """
+
+    now = timezone.now()
+    with transaction.atomic():
+        job = Job.objects.select_for_update(skip_locked=True).filter(
+            Q(status=Job.PENDING, run_after__lte=now) |
+            Q(status=Job.RUNNING, updated_at__lte=now - STALE_AFTER)
+        ).order_by("run_after", "id").first()
+
+        if job is not None:
+            _claim(job)
+
+    return job
+
+
+def run_job(job) -> None:
+    """
+    Run a claimed job and record whether it is done, will be retried, or failed.
+
+    Args:
+    - job (Job): The claimed job.
+    """
+
+    try:
+        func = HANDLERS.get(job.kind)
+        if func is None:
+            raise PermanentJobError(f"No handler for jobs of kind '{job.kind}'")
+        func(job)
+    except Exception as e:
+        job.last_error = "".join(traceback.format_exception_only(e)).strip()
+        retry_after = getattr(e, "retry_after", None)
+        if retry_after is not None:
+            # Rate limited: wait until the limit resets, without using up an attempt
+            job.attempts -= 1
+            job.status = Job.PENDING
+            job.run_after = timezone.now() + timedelta(seconds=retry_after)
+        elif isinstance(e, PermanentJobError) or job.attempts >= job.max_attempts:
+            job.status = Job.FAILED
+        else:
+            job.status = Job.PENDING
+            job.run_after = timezone.now() + RETRY_DELAY * 2 ** (job.attempts - 1)
+        print(f"{job}: {job.last_error}")
+    else:
+        job.status = Job.DONE
+        job.last_error = ""
+
+    job.save(update_fields=["status", "attempts", "run_after", "last_error", "updated_at"])
+
+
+def run_pending(max_jobs=None) -> int:
+    """
+    Run the jobs that are due, one after the other, until there are none left.
+
+    Args:
+    - max_jobs (int, optional): The maximum number of jobs to run.
+
+    Returns:
+    - int: The number of jobs run.
+    """
+
+    count = 0
+    while max_jobs is None or count < max_jobs:
+        job = claim_next()
+        if job is None:
+            break
+        run_job(job)
+        count += 1
+    return count
+
+
+def purge(before) -> int:
+    """
+    Delete the jobs that are done or failed and were last updated before a date and time.
+
+    Args:
+    - before (datetime): The jobs updated before this are deleted.
+
+    Returns:
+    - int: The number of jobs deleted.
+    """
+
+    return Job.objects.filter(status__in=[Job.DONE, Job.FAILED], updated_at__lt=before).delete()[0]
+
+
+def _claim(job) -> Job:
+    job.status = Job.RUNNING
+    job.attempts += 1
+    job.save(update_fields=["status", "attempts", "updated_at"])
+    return job
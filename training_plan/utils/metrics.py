@@ -0,0 +1,136 @@
+"""
+Module implementing small in-process metrics: counters, gauges and timings (e.g. the latency of Strava API calls).
+
+Metrics are kept per process, in memory, under a name and optional labels. Only the latest SAMPLE_SIZE timings of
+each metric are kept to compute percentiles, so memory stays bounded however long the process runs.
+
+Functions:
+- increment(name, value=1, **labels): Adds to a counter.
+- gauge(name, value, **labels): Sets a gauge to its current value.
+- observe(name, seconds, **labels): Records a timing.
+- timer(name, **labels): Context manager recording how long its block took.
+- snapshot(): Gets the current counters and timing summaries.
+- reset(): Clears every metric.
+
+Example:
+python
+with metrics.timer("strava.request", endpoint="athlete/activities"):
+    response = session.get(url)
+metrics.snapshot()["timings"]["strava.request{endpoint=athlete/activities}"]["p95"]
+
+"""
+
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+SAMPLE_SIZE = 1000  # Timings kept per metric to compute percentiles
+
+_lock = threading.Lock()
+_counters = defaultdict(int)
+_gauges = {}
+_timings = defaultdict(lambda: {"count": 0, "total": 0.0, "max": 0.0, "samples": deque(maxlen=SAMPLE_SIZE)})
+
+
+def increment(name, value=1, **labels) -> None:
+    """
+    Add to a counter.
+
+    Args:
+    - name (str): The name of the counter.
+    - value (int, optional): The amount to add.
+    - **labels: Labels of the counter, e.g. status=429.
+    """
+
+    with _lock:
+        _counters[_key(name, labels)] += value
+
+
+def gauge(name, value, **labels) -> None:
+    """
+    Set a gauge to its current value.
+
+    Args:
+    - name (str): The name of the gauge.
+    - value (float): The current value.
+    - **labels: Labels of the gauge, e.g. window="15min".
+    """
+
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def observe(name, seconds, **labels) -> None:
+    """
+    Record a timing.
+
+    Args:
+    - name (str): The name of the timing.
+    - seconds (float): The duration, in seconds.
+    - **labels: Labels of the timing, e.g. endpoint="athlete/activities".
+    """
+
+    with _lock:
+        timing = _timings[_key(name, labels)]
+        timing["count"] += 1
+        timing["total"] += seconds
+        timing["max"] = max(timing["max"], seconds)
+        timing["samples"].append(seconds)
+
+
+@contextmanager
+def timer(name, **labels):
+    """
+    Record how long the block took, whether it raised or not.
+
+    Args:
+    - name (str): The name of the timing.
+    - **labels: Labels of the timing.
+    """
+
+    begin = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - begin, **labels)
+
+
+def snapshot() -> dict:
+    """
+    Get the current counters and a summary of every timing.
+
+    Returns:
+    - dict: The "counters" and "gauges" by key, and the "timings" by key with their count, mean, p50, p95 and max
+      in seconds.
+    """
+
+    with _lock:
+        timings = {}
+        for key, timing in _timings.items():
+            samples = sorted(timing["samples"])
+            timings[key] = {
+                "count": timing["count"],
+                "mean": timing["total"] / timing["count"],
+                "p50": samples[int(0.5 * (len(samples) - 1))],
+                "p95": samples[int(0.95 * (len(samples) - 1))],
+                "max": timing["max"],
+            }
+        return {"counters": dict(_counters), "gauges": dict(_gauges), "timings": timings}
+
+
+def reset() -> None:
+    """
+    Clear every metric.
+    """
+
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _timings.clear()
+
+
+def _key(name, labels) -> str:
+    if not labels:
+        return name
+    return name + "{" + ",".join(f"{label}={value}" for label, value in sorted(labels.items())) + "}"
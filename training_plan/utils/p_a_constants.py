@@ -10,6 +10,19 @@ WEEK = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
 """ Plan constants """
 MIN_DAYS = 90
 MAX_DAYS = 365
+BULK_CREATE_BATCH_SIZE = 100  # Runs written per INSERT when a plan is saved
+PLAN_TEMPLATE_CACHE_SIZE = 512  # Compiled run sequences kept in memory
+GENERATE_PLANS_BATCH_SIZE = 50  # Plans written per transaction by manage.py generate_plans
+
+""" Adaptive plan constants """
+ADAPTIVE_WINDOW_DAYS = 21  # Completed runs compared against the plan over this many past days
+ADAPTIVE_MIN_RUNS = 3  # Completed runs needed in the window before the plan is adapted
+ADAPTIVE_WEEKS = 2  # Weeks of upcoming runs recomputed when a run is completed
+ADAPTIVE_DISTANCE_SCALE = (0.7, 1.15)  # Bounds of the scale applied to the distance ramp
+ADAPTIVE_PACE_SCALE = (0.9, 1.1)  # Bounds of the scale applied to the estimated paces
+
+""" Heart rate zones """
+HEART_RATE_ZONES = (0.5, 0.6, 0.7, 0.8, 0.9)  # Lower bound of Z1 to Z5, as a fraction of the maximum heart rate
 
 """ Basic plans """
 BASIC_PLANS = {
@@ -102,6 +115,13 @@ BASIC_PLANS = {
     },
 }
 
+""" Interval pace (minutes per km) """
+INTERVAL_PACE = {
+    "beginner": 5.5,
+    "intermediate": 4.5,
+    "advanced": 3.5
+}
+
 """ Default runs """
 DEFAULT_RUNS = {
     0: {
@@ -0,0 +1,149 @@
+"""
+Module implementing the adaptive mode of a marathon plan.
+
+When a run is completed, the completed runs of the last ADAPTIVE_WINDOW_DAYS are compared against what the plan
+algorithm scheduled for those days: the total distance gives a distance scale and the total pace a pace scale,
+both clamped to their bounds in p_a_constants.py. The scales are always measured against the generated plan rather
+than against the stored runs, so adapting a plan twice doesn't compound.
+
+Only the next ADAPTIVE_WEEKS of runs are then recomputed with the scaled distance ramp and paces, and only the
+rows that changed are written. The work per completed run is bounded by the window and the number of weeks,
+whatever the length of the plan. Runs further ahead are adapted as they come into the window.
+
+Virtual plans only keep the scales: their runs are computed with them on read (see plan_store.py), so adapting a
+virtual plan writes no runs, except for the rows it already stores.
+
+Plans are adapted in the background (see the adapt_plan job in ../tasks.py), so saving a completed run doesn't wait
+on the adaptation, and a failed adaptation leaves its error on the job.
+
+Functions:
+- enqueue_adapt(plan_id, version, today=None): Enqueues the adaptation of a plan.
+- calculate_scales(plan, today=None): Compares the recently completed runs against the plan.
+- adapt_plan(plan, today=None): Recomputes the next weeks of an adaptive plan from its completed runs.
+
+Example:
+python
+enqueue_adapt(plan.id, plan.version)
+counts = adapt_plan(completed_run.scheduled_run.marathon_plan)
+
+"""
+
+from datetime import date, timedelta
+
+import numpy as np
+from django.db import transaction
+
+from ..models import CompletedRun, MarathonPlan, ScheduledRun
+from . import jobs, plan_algo, plan_version
+from . import p_a_constants as c
+from .plan_reschedule import RUN_FIELDS
+
+
+def enqueue_adapt(plan_id, version, today=None):
+    """
+    Enqueue the adaptation of a plan to the runs completed up to a day, once per version of the plan.
+
+    Args:
+    - plan_id (int): The ID of the plan.
+    - version (int): The version of the plan when the run was completed.
+    - today (date, optional): The day the run was completed on (defaults to today).
+
+    Returns:
+    - Job: The new or existing job.
+    """
+
+    today = today or date.today()
+    return jobs.enqueue("adapt_plan", f"adapt_plan:{plan_id}:{version}",
+                        payload={"plan_id": plan_id, "today": today.isoformat()})
+
+
+def calculate_scales(plan, today=None):
+    """
+    Compare the distance and pace of the runs completed in the window against the runs the plan generated.
+
+    Args:
+    - plan (MarathonPlan): The plan.
+    - today (date, optional): The last day of the window (defaults to today).
+
+    Returns:
+    - tuple or None: The distance scale and pace scale, rounded to 2 decimals, or None if too few distance runs
+      were completed in the window.
+    """
+
+    today = today or date.today()
+    completed_runs = CompletedRun.objects.filter(
+        scheduled_run__marathon_plan=plan, scheduled_run__date__gt=today - timedelta(days=c.ADAPTIVE_WINDOW_DAYS),
+        scheduled_run__date__lte=today, distance__gt=0).values_list("scheduled_run__date", "distance", "avg_pace")
+
+    # What the plan algorithm scheduled, whatever the stored runs were adapted to
+    plan_array = plan_algo.NewMarathonPlan.from_plan(plan).compile_plan()
+    planned = {run_date: (distance, pace) for run_date, distance, pace in zip(
+        plan_array["date"].tolist(), plan_array["distance"].tolist(), plan_array["est_avg_pace"].tolist())
+        if distance > 0}
+
+    deltas = np.array([(distance, avg_pace.total_seconds() / 60, *planned[run_date])
+                       for run_date, distance, avg_pace in completed_runs if run_date in planned])
+    if len(deltas) < c.ADAPTIVE_MIN_RUNS:
+        return None
+
+    distance_scale = np.clip(deltas[:, 0].sum() / deltas[:, 2].sum(), *c.ADAPTIVE_DISTANCE_SCALE)
+    pace_scale = np.clip(deltas[:, 1].sum() / deltas[:, 3].sum(), *c.ADAPTIVE_PACE_SCALE)
+
+    return round(float(distance_scale), 2), round(float(pace_scale), 2)
+
+
+def adapt_plan(plan, today=None):
+    """
+    Recompute the next ADAPTIVE_WEEKS of an adaptive plan from the runs completed in the window.
+
+    Args:
+    - plan (MarathonPlan): The plan.
+    - today (date, optional): The day the run was completed on (defaults to today).
+
+    Returns:
+    - dict or None: The number of runs "inserted" and "updated", or None if the plan was not adapted.
+    """
+
+    if not plan.adaptive:
+        return None
+
+    today = today or date.today()
+    scales = calculate_scales(plan, today)
+    if scales is None:
+        return None
+
+    start = today + timedelta(days=1)
+    end = today + timedelta(weeks=c.ADAPTIVE_WEEKS)
+    runs = plan_algo.NewMarathonPlan.from_plan(plan).build_runs_in_plan(start, end, *scales)
+    scales_changed = scales != (plan.distance_scale, plan.pace_scale)
+
+    with transaction.atomic():
+        stored_runs = {run.date: run for run in ScheduledRun.objects.filter(
+            marathon_plan=plan, date__gte=start, date__lte=end, completedrun__isnull=True)}
+        completed_dates = set(ScheduledRun.objects.filter(
+            marathon_plan=plan, date__gte=start, date__lte=end, completedrun__isnull=False).values_list("date", flat=True))
+
+        to_insert, to_update = [], []
+        for run in runs:
+            if run.date in completed_dates:
+                continue
+            stored_run = stored_runs.get(run.date)
+            if stored_run is None:
+                # Virtual plans compute the missing runs with the scales
+                if plan.storage != MarathonPlan.VIRTUAL:
+                    to_insert.append(run)
+            elif any(getattr(stored_run, field) != getattr(run, field) for field in RUN_FIELDS):
+                for field in RUN_FIELDS:
+                    setattr(stored_run, field, getattr(run, field))
+                to_update.append(stored_run)
+
+        ScheduledRun.objects.bulk_create(to_insert, batch_size=c.BULK_CREATE_BATCH_SIZE)
+        ScheduledRun.objects.bulk_update(to_update, RUN_FIELDS, batch_size=c.BULK_CREATE_BATCH_SIZE)
+
+        if scales_changed:
+            plan.distance_scale, plan.pace_scale = scales
+            plan.save(update_fields=["distance_scale", "pace_scale"])
+        if to_insert or to_update or (scales_changed and plan.storage == MarathonPlan.VIRTUAL):
+            plan_version.bump([plan.id])
+
+    return {"inserted": len(to_insert), "updated": len(to_update)}
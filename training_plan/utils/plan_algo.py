@@ -38,20 +38,24 @@ Classes:
 
 Attributes:
 - user (object): The user for whom the plan is created.
+- fitness_level (str): The user's fitness level.
 - date_of_marathon (date): The date of the user's marathon.
 - today (date): The current date.
+- storage (str): How the runs of the plan are stored, "materialized" or "virtual" (defaults to settings.PLAN_STORAGE).
 - plan (object): The generated marathon training plan.
 
 Methods:
+- from_plan: Rebuilds the generator of an existing plan from its stored generation parameters.
+- from_past_parameters: Rebuilds the generator of the runs of a virtual plan before one of its reschedules.
 - _validate_marathon_date: Performs final validation for the date of the marathon.
 - create_plan: Creates the marathon training plan and saves it.
-- create_runs_in_plan: Creates the scheduled runs within the plan.
-- _schedule_runs_for_phase: Schedules runs for a specific phase of the plan.
-- _schedule_runs_for_taper: Schedules taper runs at the end of the plan.
-- _calculate_distance: Calculates the distance for a run based on user's fitness level and phase.
-- _calculate_interval_progression: Calculates the progression of interval values (on, off, sets) during a phase.
-- _calculate_duration: Not implemented. Placeholder for calculating run duration.
-- _calculate_run_date: Calculates the date for a scheduled run based on the start date, day of the week, and week of the phase.
+- create_runs_in_plan: Creates the scheduled runs within the plan in one transaction with batched inserts.
+- build_runs_in_plan: Builds the scheduled runs within the plan in memory, without writing them.
+- build_runs_from_array: Builds the scheduled runs of a compiled plan array.
+- compile_plan: Compiles the whole plan into one NumPy structured array (see plan_compiler.py).
+- compile_args: Gets the arguments of plan_compiler.compile_plan for the plan.
+- adapt_plan_array: Rescales the distance ramp and estimated paces of a compiled plan (see plan_adapt.py).
+- _calculate_phases: Splits the days until the marathon into the phases of the plan.
 
 Example:
 python
@@ -70,18 +74,75 @@ else:
 
 from datetime import date, timedelta
 import numpy as np
+from django.conf import settings
+from django.db import transaction
 
 from ..models import MarathonPlan, ScheduledRun
 from . import p_a_constants as c
+from . import plan_compiler, plan_version
 
 
 class NewMarathonPlan:
-    def __init__(self, user) -> None:
+    def __init__(self, user, storage=None) -> None:
         self.user = user
+        self.fitness_level = user.fitness_level
         self.date_of_marathon = user.date_of_marathon
         self.today = date.today()
+        self.storage = storage or settings.PLAN_STORAGE
         self.plan = None
 
+    # Rebuild the generator of an existing plan
+    @classmethod
+    def from_plan(cls, plan) -> "NewMarathonPlan":
+        """
+        Rebuild the generator of an existing plan from its stored generation parameters.
+
+        Args:
+        - plan (MarathonPlan): The existing plan.
+
+        Returns:
+        - NewMarathonPlan: A generator producing the same runs as when the plan was created.
+
+        Example:
+        python
+        runs = NewMarathonPlan.from_plan(plan).build_runs_in_plan(start, end)
+        
+        """
+
+        new_plan = cls.__new__(cls)
+        new_plan.user = None  # Not needed to build the runs, avoids a query
+        new_plan.fitness_level = plan.fitness_level
+        new_plan.date_of_marathon = plan.end_date
+        new_plan.today = plan.rescheduled_on or plan.start_date  # Rescheduled plans are generated from that day
+        new_plan.storage = plan.storage
+        new_plan.plan = plan
+        return new_plan
+
+    # Rebuild the generator of the runs of a virtual plan before a reschedule
+    @classmethod
+    def from_past_parameters(cls, plan, parameters) -> "NewMarathonPlan":
+        """
+        Rebuild the generator of the runs a virtual plan had before one of its reschedules.
+
+        Args:
+        - plan (MarathonPlan): The existing plan.
+        - parameters (dict): One of the plan's past_parameters (see plan_reschedule.py).
+
+        Returns:
+        - NewMarathonPlan: A generator producing the runs of the plan as they were before the reschedule.
+
+        Example:
+        python
+        runs = NewMarathonPlan.from_past_parameters(plan, plan.past_parameters[0]).build_runs_in_plan(start, end)
+        
+        """
+
+        new_plan = cls.from_plan(plan)
+        new_plan.fitness_level = parameters["fitness_level"]
+        new_plan.date_of_marathon = date.fromisoformat(parameters["end_date"])
+        new_plan.today = date.fromisoformat(parameters["today"])
+        return new_plan
+
     # Final validation for the date of the marathon
     def _validate_marathon_date(self) -> None:
         """
@@ -123,316 +184,236 @@ class NewMarathonPlan:
             return False, f"The marathon date is invalid: {i}"
 
         self.plan = MarathonPlan(user=self.user, start_date=self.today,
-                                 end_date=self.date_of_marathon)  # TODO - no weeks!!
+                                 end_date=self.date_of_marathon, fitness_level=self.fitness_level,
+                                 storage=self.storage)  # TODO - no weeks!!
         self.plan.save()
         return True, self.plan
 
     # Creates the runs given the time frame of dates
-    def create_runs_in_plan(self) -> None:
+    def create_runs_in_plan(self, batch_size=c.BULK_CREATE_BATCH_SIZE) -> list:
         """
         Create the scheduled runs within the plan.
 
+        Every run is built in memory first (including the taper week) and the whole plan is then written
+        in one transaction with batched inserts, so the number of INSERTs is O(days / batch_size).
+        Virtual plans compute their runs on read, so nothing is written for them.
+
+        Args:
+        - batch_size (int): The number of runs written per INSERT statement.
+
+        Returns:
+        - list: The ScheduledRun objects that were written.
+
         Example:
         python
         self.create_runs_in_plan()
         
         """
 
-        # Calculate total days between start and marathon date
-        total_days = (self.date_of_marathon - self.today).days
+        if self.storage == MarathonPlan.VIRTUAL:
+            return []
 
-        # Split total days into 3:2:1 ratio
-        phase1_days = (3/6) * total_days
-        phase2_days = (2/6) * total_days
-        # phase3_days = (1/6) * total_days # Not used
-
-        # Adjust phase 1 start date to next Monday
-        phase1_start = self.today
-        while phase1_start.weekday() != 0:  # 0 represents Monday
-            phase1_start += timedelta(days=1)
-
-        # Adjust phase 1 end date to a Sunday
-        phase1_end = phase1_start + timedelta(days=phase1_days-1)
-        while phase1_end.weekday() != 6:  # 6 represents Sunday
-            phase1_end += timedelta(days=1)
-
-        # Adjust phase 2 start date to next Monday
-        phase2_start = phase1_end + timedelta(days=1)
+        runs = self.build_runs_in_plan()
 
-        # Adjust phase 2 end date to a Sunday
-        phase2_end = phase2_start + timedelta(days=phase2_days-1)
-        while phase2_end.weekday() != 6:  # 6 represents Sunday
-            phase2_end += timedelta(days=1)
+        with transaction.atomic():
+            ScheduledRun.objects.bulk_create(runs, batch_size=batch_size)
+            if self.plan is not None:
+                plan_version.bump([self.plan.id])
 
-        # Adjust phase 3 start date to next Monday
-        phase3_start = phase2_end + timedelta(days=1)
-        # End phase 3 a week before marathon date for week of taper
-        phase3_end = self.date_of_marathon - timedelta(days=7)
+        return runs
 
-        # Calculate weeks in each phase
-        phase1_weeks = (phase1_end - phase1_start).days // 7
-        phase2_weeks = (phase2_end - phase2_start).days // 7
-        phase3_weeks = (phase3_end - phase3_start).days // 7
-
-        # There is a whole week missing when the runs are scheduleds at the end of phase 1 and 2 due to the // division - need to + 1 to the total weeks
-        # Schedule runs for each phase
-        self._schedule_runs_for_phase("phase1", phase1_start, phase1_weeks + 1)
-        self._schedule_runs_for_phase("phase2", phase2_start, phase2_weeks + 1)
-        self._schedule_runs_for_phase("phase3", phase3_start, phase3_weeks + 1)
-        self._schedule_runs_for_taper(phase3_end, self.user.fitness_level)
-
-    # Schedule the runs for a given phase
-    def _schedule_runs_for_phase(self, phase, phase_start_date, weeks_in_phase) -> None:
+    # Builds the runs given the time frame of dates
+    def build_runs_in_plan(self, start=None, end=None, distance_scale=1.0, pace_scale=1.0) -> list:
         """
-        Schedule runs for a specific phase of the plan.
+        Build the (unsaved) scheduled runs within the plan from the compiled plan array.
 
         Args:
-        - phase (str): The phase for which runs are to be scheduled.
-        - phase_start_date (date): The start date of the phase.
-        - weeks_in_phase (int): The number of weeks in the phase.
+        - start (date, optional): Only build the runs on or after this date.
+        - end (date, optional): Only build the runs on or before this date.
+        - distance_scale (float, optional): Scale applied to the distance ramp (see adapt_plan_array).
+        - pace_scale (float, optional): Scale applied to the estimated paces (see adapt_plan_array).
+
+        Returns:
+        - list: The ScheduledRun objects of the plan, ordered by date.
 
         Example:
         python
-        self._schedule_runs_for_phase("phase1", phase1_start, phase1_weeks + 1)
+        runs = self.build_runs_in_plan()
         
         """
 
-        # Data required for getting workouts from DEFAULT_RUNS dictonary
-        fit_level = self.user.fitness_level
-        phase = phase
-
-        # Loop
-        for i in range(weeks_in_phase):
-            for day in c.WEEK:
-                # Create the run attributes
-                run_id = c.BASIC_PLANS[fit_level][phase][day]
-
-                if run_id == 0:
-                    distance = 0
-                    duration = 0
-                    est_avg_pace = timedelta(minutes=0)
-                    on = off = sets = 0
-                elif run_id != 5:
-                    distance = self._calculate_distance(
-                        run_id, fit_level, phase, weeks_in_phase, i)
-                    duration = c.DEFAULT_RUNS[run_id]["first_duration"][fit_level]
-                    pace = 1 / (distance / duration)
-                    est_avg_pace = timedelta(minutes=pace)
-
-                    on = off = sets = 0
-                else:
-                    if fit_level == "beginner":
-                        est_avg_pace = timedelta(minutes=5, seconds=30)
-                    elif fit_level == "intermediate":
-                        est_avg_pace = timedelta(minutes=4, seconds=30)
-                    else:
-                        est_avg_pace = timedelta(minutes=3, seconds=30)
-
-                    on, off, sets = self._calculate_interval_progression(
-                        fit_level, phase, weeks_in_phase, i)
-                    distance = 0
-                    duration = (on + off) * sets
-
-                scheduled_run = ScheduledRun(
-                    dict_id=run_id,
-                    run=c.DEFAULT_RUNS[run_id]["name"],
-                    marathon_plan=self.plan,
-                    run_feel=c.DEFAULT_RUNS[run_id]["feel"],
-                    date=self._calculate_run_date(phase_start_date, day, i),
-                    distance=distance,
-                    est_duration=duration,
-                    est_avg_pace=est_avg_pace,
-                    on=on,
-                    off=off,
-                    sets=sets
-                )
-                scheduled_run.save()
-
-    def _schedule_runs_for_taper(self, phase3_end, fit_level) -> None:
+        plan_array = self.compile_plan()
+        if start is not None:
+            plan_array = plan_array[plan_array["date"] >= np.datetime64(start, "D")]
+        if end is not None:
+            plan_array = plan_array[plan_array["date"] <= np.datetime64(end, "D")]
+        if distance_scale != 1.0 or pace_scale != 1.0:
+            plan_array = self.adapt_plan_array(plan_array, distance_scale, pace_scale)
+
+        return self.build_runs_from_array(plan_array)
+
+    # Builds the runs of a compiled plan
+    def build_runs_from_array(self, plan_array) -> list:
         """
-        Schedule taper runs at the end of the plan.
+        Build the (unsaved) scheduled runs of the plan from a compiled plan array.
 
         Args:
-        - phase3_end (date): The end date of phase 3.
-        - fit_level (str): The user's fitness level.
+        - plan_array (np.ndarray): The compiled plan (or a slice of it), e.g. compiled in another process.
+
+        Returns:
+        - list: The ScheduledRun objects, ordered by date.
 
         Example:
         python
-        self._schedule_runs_for_taper(phase3_end, self.user.fitness_level)
+        runs = self.build_runs_from_array(self.compile_plan())
         
         """
 
-        phase3_end_weekday = phase3_end.weekday()
-
-        # We always know the current last scheduled day in phase 3 is a sunday, so a weekday of 6
-        amount_to_delete = 6 - phase3_end_weekday
-        current_phase3_end_date = phase3_end + timedelta(days=amount_to_delete)
-
-        # Query for scheduled_runs to be removed for taper
-        # Query the ScheduledRun model for runs between the two dates
-        taper_start_date = phase3_end + timedelta(days=1)
-        runs_to_delete = ScheduledRun.objects.filter(
-            date__range=(taper_start_date, current_phase3_end_date))
-
-        # Delete the retrieved runs
-        runs_to_delete.delete()
-
-        # Add the scheduled taper runs
-        for i, day in enumerate(c.WEEK):
-            # Create the run attributes
-            # I know that it techincally isn't the correct day of the week in the loop to the actual day of the week but it works
-            run_id = c.LAST[day]["dict_id"]
-
-            if run_id == 0:
-                distance = 0
-                duration = 0
-                est_avg_pace = timedelta(minutes=0)
-                on = off = sets = 0
-
-            elif run_id == 5:
-                if fit_level == "beginner":
-                    est_avg_pace = timedelta(minutes=5, seconds=30)
-                elif fit_level == "intermediate":
-                    est_avg_pace = timedelta(minutes=4, seconds=30)
-                else:
-                    est_avg_pace = timedelta(minutes=3, seconds=30)
-
-                on, off, sets = c.LAST[day]["on"], c.LAST[day]["off"], c.LAST[day]["sets"]
-                distance = 0
-                duration = (on + off) * sets
-
-            elif run_id == 9:
-                distance = c.DEFAULT_RUNS[run_id]["distance"]
-                duration = c.DEFAULT_RUNS[run_id]["first_duration"][fit_level]
-                pace = 1 / (distance / duration)
-                est_avg_pace = timedelta(minutes=pace)
-
-                on = off = sets = 0
-
-            else:
-                distance = c.LAST[day]["distance"]
-                duration = c.LAST[day]["duration"][fit_level]
-                pace = 1 / (distance / duration)
-                est_avg_pace = timedelta(minutes=pace)
-
-                on = off = sets = 0
-
-            scheduled_run = ScheduledRun(
+        runs = []
+        for run_date, run_id, distance, duration, pace, on, off, sets in zip(
+                plan_array["date"].tolist(), plan_array["dict_id"].tolist(), plan_array["distance"].tolist(),
+                plan_array["est_duration"].tolist(), plan_array["est_avg_pace"].tolist(),
+                plan_array["on"].tolist(), plan_array["off"].tolist(), plan_array["sets"].tolist()):
+            runs.append(ScheduledRun(
                 dict_id=run_id,
                 run=c.DEFAULT_RUNS[run_id]["name"],
                 marathon_plan=self.plan,
                 run_feel=c.DEFAULT_RUNS[run_id]["feel"],
-                date=taper_start_date + timedelta(days=i),
-                distance=distance,
+                date=run_date,
+                distance=int(distance),
                 est_duration=duration,
-                est_avg_pace=est_avg_pace,
+                est_avg_pace=timedelta(minutes=pace),
                 on=on,
                 off=off,
                 sets=sets
-            )
-            scheduled_run.save()
+            ))
 
-    def _calculate_distance(self, run_id, fit_level, phase, weeks_in_phase, i) -> float:
-        """
-        Calculate the distance for a run based on user's fitness level and phase.
+        return runs
 
-        Args:
-        - run_id (int): The ID of the run.
-        - fit_level (str): The user's fitness level.
-        - phase (str): The phase of the plan.
-        - weeks_in_phase (int): The number of weeks in the phase.
-        - i (int): The current week within the phase.
+    # Compiles the whole plan into one structured array
+    def compile_plan(self) -> np.ndarray:
+        """
+        Compile the whole plan into one structured array, with a row per day (see plan_compiler.py).
 
         Returns:
-        - float: The calculated distance for the run.
+        - np.ndarray: The plan as an array of dtype plan_compiler.PLAN_DTYPE.
 
         Example:
         python
-        distance = self._calculate_distance(run_id, fit_level, phase, weeks_in_phase, i)
+        plan_array = self.compile_plan()
         
         """
 
-        low = c.DEFAULT_RUNS[run_id]["distance"][fit_level][phase]["low"]
-        high = c.DEFAULT_RUNS[run_id]["distance"][fit_level][phase]["high"]
-        diff = high - low
+        return plan_compiler.compile_plan(*self.compile_args())
 
-        addition = diff / (weeks_in_phase - 1)
+    # The arguments of plan_compiler.compile_plan for this plan
+    def compile_args(self) -> tuple:
+        """
+        Get the arguments of plan_compiler.compile_plan for this plan, e.g. to compile it in another process.
 
-        return low + (addition * i)
+        Returns:
+        - tuple: The fitness level, the start date of phase 1, the weeks in each phase and the number of days.
 
-    def _calculate_interval_progression(self, fit_level, phase, weeks_in_phase, i, run_id=5):
+        Example:
+        python
+        plan_array = plan_compiler.compile_plan(*self.compile_args())
+        
         """
-        Calculate the progression of interval values (on, off, sets) during a phase.
+
+        phase1_start, phase_weeks, n_days = self._calculate_phases()
+        return self.fitness_level, phase1_start, phase_weeks, n_days
+
+    # Rescale the progression of a compiled plan
+    @staticmethod
+    def adapt_plan_array(plan_array, distance_scale, pace_scale) -> np.ndarray:
+        """
+        Rescale the distance ramp and the estimated paces of a compiled plan.
+
+        Distance runs have their distance and pace scaled and their estimated duration recomputed from both.
+        Intervals keep their sets and times and only have their pace scaled. The taper week is left as it is,
+        so the plan still ends with the marathon.
 
         Args:
-        - fit_level (str): The user's fitness level.
-        - phase (str): The phase of the plan.
-        - weeks_in_phase (int): The number of weeks in the phase.
-        - i (int): The current week within the phase.
-        - run_id (int): The ID of the run.
+        - plan_array (np.ndarray): The compiled plan (or a slice of it).
+        - distance_scale (float): Scale applied to the distances.
+        - pace_scale (float): Scale applied to the estimated paces.
 
         Returns:
-        - tuple: A tuple containing the calculated values for on, off, and sets.
+        - np.ndarray: A rescaled copy of the plan.
 
         Example:
         python
-        on, off, sets = self._calculate_interval_progression(fit_level, phase, weeks_in_phase, i)
+        plan_array = self.adapt_plan_array(self.compile_plan(), 0.9, 1.05)
         
         """
-        def calculate_weekly_value(low, high, weeks, current_week):
-            diff = high - low
-
-            # Calculate the ideal change, considering total weeks
-            ideal_change = round(diff * current_week / weeks)
-
-            # Calculate the weekly value based on the ideal change
-            weekly_value = low + ideal_change
 
-            return weekly_value
+        plan_array = plan_array.copy()
+        adapted = plan_array["phase"] != plan_compiler.TAPER
+        is_distance = adapted & (plan_array["distance"] > 0)
 
-        on_low = c.DEFAULT_RUNS[run_id]["on"]
-        on_high = c.DEFAULT_RUNS[run_id]["on"]
-        off_low = c.DEFAULT_RUNS[run_id]["off"]
-        off_high = c.DEFAULT_RUNS[run_id]["off"]
-        sets_low = c.DEFAULT_RUNS[run_id]["sets"][fit_level][phase]["low"]
-        sets_high = c.DEFAULT_RUNS[run_id]["sets"][fit_level][phase]["high"]
+        plan_array["distance"][is_distance] *= distance_scale
+        plan_array["est_avg_pace"][adapted] *= pace_scale
+        plan_array["est_duration"][is_distance] = np.rint(
+            plan_array["distance"][is_distance] * plan_array["est_avg_pace"][is_distance])
 
-        on_value = calculate_weekly_value(on_low, on_high, weeks_in_phase, i)
-        off_value = calculate_weekly_value(
-            off_low, off_high, weeks_in_phase, i)
-        sets_value = calculate_weekly_value(
-            sets_low, sets_high, weeks_in_phase, i)
+        return plan_array
 
-        return (on_value, off_value, sets_value)
-
-    # Calculate the run date
-    def _calculate_run_date(self, start_date, day_of_week, week_of_phase) -> date:
+    # Split the time frame of dates into the phases of the plan
+    def _calculate_phases(self) -> tuple:
         """
-        Calculate the run date.
+        Split the days between today and the marathon into phases.
 
-        Args:
-        - start_date (date): The start date of the phase.
-        - day_of_week (str): The day of the week for the scheduled run.
-        - week_of_phase (int): The week within the phase.
+        Phase 1 starts on the next Monday and the phases are split in a 3:2:1 ratio, each ending on a Sunday.
+        Phase 3 is cut short by the taper week before the marathon.
 
         Returns:
-        - date: The calculated date for the scheduled run.
+        - tuple: The start date of phase 1, the number of weeks scheduled in each phase, and the number of days
+          from the start of phase 1 up to and including the day of the marathon.
 
         Example:
         python
-        run_date = self._calculate_run_date(phase_start_date, day, i)
+        phase1_start, phase_weeks, n_days = self._calculate_phases()
         
         """
-        days_mapping = {
-            "mon": 0,
-            "tue": 1,
-            "wed": 2,
-            "thu": 3,
-            "fri": 4,
-            "sat": 5,
-            "sun": 6
-        }
-        delta_days = days_mapping[day_of_week] - start_date.weekday()
-        if delta_days < 0:
-            delta_days += 7
-        return timedelta(days=(week_of_phase * 7)) + start_date + timedelta(days=delta_days)
+
+        # Calculate total days between start and marathon date
+        total_days = (self.date_of_marathon - self.today).days
+
+        # Split total days into 3:2:1 ratio
+        phase1_days = (3/6) * total_days
+        phase2_days = (2/6) * total_days
+        # phase3_days = (1/6) * total_days # Not used
+
+        # Adjust phase 1 start date to next Monday
+        phase1_start = self.today
+        while phase1_start.weekday() != 0:  # 0 represents Monday
+            phase1_start += timedelta(days=1)
+
+        # Adjust phase 1 end date to a Sunday
+        phase1_end = phase1_start + timedelta(days=phase1_days-1)
+        while phase1_end.weekday() != 6:  # 6 represents Sunday
+            phase1_end += timedelta(days=1)
+
+        # Adjust phase 2 start date to next Monday
+        phase2_start = phase1_end + timedelta(days=1)
+
+        # Adjust phase 2 end date to a Sunday
+        phase2_end = phase2_start + timedelta(days=phase2_days-1)
+        while phase2_end.weekday() != 6:  # 6 represents Sunday
+            phase2_end += timedelta(days=1)
+
+        # Adjust phase 3 start date to next Monday
+        phase3_start = phase2_end + timedelta(days=1)
+        # End phase 3 a week before marathon date for week of taper
+        phase3_end = self.date_of_marathon - timedelta(days=7)
+
+        # Calculate weeks in each phase
+        phase1_weeks = (phase1_end - phase1_start).days // 7
+        phase2_weeks = (phase2_end - phase2_start).days // 7
+        phase3_weeks = (phase3_end - phase3_start).days // 7
+
+        # There is a whole week missing when the runs are scheduleds at the end of phase 1 and 2 due to the // division - need to + 1 to the total weeks
+        phase_weeks = (phase1_weeks + 1, phase2_weeks + 1, phase3_weeks + 1)
+        n_days = (self.date_of_marathon - phase1_start).days + 1
+
+        return phase1_start, phase_weeks, n_days
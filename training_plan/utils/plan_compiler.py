@@ -0,0 +1,226 @@
+"""
+Module compiling the plan templates in p_a_constants.py into dense NumPy arrays.
+
+The BASIC_PLANS, DEFAULT_RUNS and LAST dictionaries are turned once, at import time, into arrays indexed by
+(fitness level, phase, weekday). A whole plan is then generated in a single vectorized pass as one structured
+array with a row per day, instead of looping over every week and day in Python.
+
+The taper week is stored as a fourth phase. Its "weekday" axis is the day of the taper (0-6) rather than the
+day of the week, which matches how the LAST dictionary has always been applied.
+
+Constants:
+- FITNESS_LEVELS (tuple): The fitness levels, in the order of the first axis of the templates.
+- PHASES (tuple): The phases, in the order of the second axis of the templates.
+- EPOCH (np.datetime64): The date cached run sequences are counted from.
+- PLAN_DTYPE (np.dtype): The dtype of a compiled plan.
+- TEMPLATES (dict): The compiled template arrays, each of shape (fitness levels, phases, 7).
+
+Functions:
+- compile_templates(): Compiles the constant tables into the dense template arrays.
+- compile_plan(fit_level, start_date, phase_weeks, n_days): Generates a whole plan as a structured array.
+- compile_template(fit_level, phase_weeks, n_days): Generates (and caches) the run sequence of a plan.
+- template_cache_info(): Reports the hits, misses and size of the template cache.
+
+Example:
+python
+plan = compile_plan("beginner", date(2024, 1, 1), (12, 8, 4), 180)
+plan["date"], plan["dict_id"], plan["distance"]
+
+"""
+
+import functools
+
+import numpy as np
+
+from . import p_a_constants as c
+
+FITNESS_LEVELS = ("beginner", "intermediate", "advanced")
+PHASES = ("phase1", "phase2", "phase3", "taper")
+TAPER = PHASES.index("taper")
+EPOCH = np.datetime64(0, "D")
+
+PLAN_DTYPE = np.dtype([
+    ("date", "datetime64[D]"),
+    ("phase", np.uint8),  # Index into PHASES
+    ("week", np.int16),  # Week within the phase
+    ("dict_id", np.uint8),  # Key of the run in DEFAULT_RUNS
+    ("distance", np.float64),  # km
+    ("est_duration", np.int32),  # minutes
+    ("est_avg_pace", np.float64),  # minutes per km
+    ("on", np.int32),
+    ("off", np.int32),
+    ("sets", np.int32),
+])
+
+
+def compile_templates() -> dict:
+    """
+    Compile the constant tables into dense arrays indexed by (fitness level, phase, weekday).
+
+    Returns:
+    - dict: Arrays for the run ids, the low/high distance and sets, the on/off times, the duration of the
+      run and the fixed interval pace.
+    """
+
+    shape = (len(FITNESS_LEVELS), len(PHASES), len(c.WEEK))
+    templates = {
+        "dict_id": np.zeros(shape, dtype=np.uint8),
+        "distance_low": np.zeros(shape),
+        "distance_high": np.zeros(shape),
+        "duration": np.zeros(shape, dtype=np.int32),
+        "on": np.zeros(shape, dtype=np.int32),
+        "off": np.zeros(shape, dtype=np.int32),
+        "sets_low": np.zeros(shape, dtype=np.int32),
+        "sets_high": np.zeros(shape, dtype=np.int32),
+        "interval_pace": np.array([c.INTERVAL_PACE[fit_level] for fit_level in FITNESS_LEVELS]),
+    }
+
+    for f, fit_level in enumerate(FITNESS_LEVELS):
+        for p, phase in enumerate(PHASES):
+            for d, day in enumerate(c.WEEK):
+                if phase == "taper":
+                    run_id = c.LAST[day]["dict_id"]
+                else:
+                    run_id = c.BASIC_PLANS[fit_level][phase][day]
+                templates["dict_id"][f, p, d] = run_id
+
+                if run_id == 0:
+                    continue
+
+                run = c.DEFAULT_RUNS[run_id]
+                if run_id == 5:
+                    if phase == "taper":
+                        on, off = c.LAST[day]["on"], c.LAST[day]["off"]
+                        sets_low = sets_high = c.LAST[day]["sets"]
+                    else:
+                        on, off = run["on"], run["off"]
+                        sets_low = run["sets"][fit_level][phase]["low"]
+                        sets_high = run["sets"][fit_level][phase]["high"]
+                    templates["on"][f, p, d] = on
+                    templates["off"][f, p, d] = off
+                    templates["sets_low"][f, p, d] = sets_low
+                    templates["sets_high"][f, p, d] = sets_high
+                elif run_id == 9:
+                    templates["distance_low"][f, p, d] = run["distance"]
+                    templates["distance_high"][f, p, d] = run["distance"]
+                    templates["duration"][f, p, d] = run["first_duration"][fit_level]
+                elif phase == "taper":
+                    templates["distance_low"][f, p, d] = c.LAST[day]["distance"]
+                    templates["distance_high"][f, p, d] = c.LAST[day]["distance"]
+                    templates["duration"][f, p, d] = c.LAST[day]["duration"][fit_level]
+                else:
+                    templates["distance_low"][f, p, d] = run["distance"][fit_level][phase]["low"]
+                    templates["distance_high"][f, p, d] = run["distance"][fit_level][phase]["high"]
+                    templates["duration"][f, p, d] = run["first_duration"][fit_level]
+
+    return templates
+
+
+TEMPLATES = compile_templates()
+
+
+def compile_plan(fit_level, start_date, phase_weeks, n_days) -> np.ndarray:
+    """
+    Generate a whole plan as one structured array, with a row per day.
+
+    Plans with the same fitness level, phase weeks and length only differ by their start date, so the run
+    sequence is looked up in an LRU cache (see compile_template) and shifted to start_date.
+
+    Args:
+    - fit_level (str): The user's fitness level.
+    - start_date (date): The first day of the plan, the Monday phase 1 starts on.
+    - phase_weeks (tuple): The number of weeks scheduled in phases 1, 2 and 3.
+    - n_days (int): The number of days in the plan, including the day of the marathon.
+
+    Returns:
+    - np.ndarray: An array of dtype PLAN_DTYPE, ordered by date.
+
+    Example:
+    python
+    plan = compile_plan("beginner", date(2024, 1, 1), (12, 8, 4), 180)
+
+    """
+
+    plan = compile_template(fit_level, tuple(phase_weeks), n_days).copy()
+    plan["date"] += np.datetime64(start_date, "D") - EPOCH
+    return plan
+
+
+def template_cache_info():
+    """
+    Report the hits, misses, size cap and current size of the plan template cache.
+
+    Returns:
+    - functools._CacheInfo: The cache statistics.
+    """
+
+    return compile_template.cache_info()
+
+
+@functools.lru_cache(maxsize=c.PLAN_TEMPLATE_CACHE_SIZE)
+def compile_template(fit_level, phase_weeks, n_days) -> np.ndarray:
+    """
+    Generate the run sequence of a plan in a single vectorized pass, with dates counted from EPOCH.
+
+    The phases follow each other back to back, each lasting the given number of weeks. The last 7 days are
+    always the taper week, which replaces the end of phase 3.
+
+    Distances progress linearly from "low" to "high" over the weeks of a phase, and the number of interval
+    sets is rounded (half to even) along the same ramp. A phase lasting a single week stays at "low".
+
+    The result is cached and shared, so it is read-only; use compile_plan to get a plan with real dates.
+
+    Args:
+    - fit_level (str): The user's fitness level.
+    - phase_weeks (tuple): The number of weeks scheduled in phases 1, 2 and 3.
+    - n_days (int): The number of days in the plan, including the day of the marathon.
+
+    Returns:
+    - np.ndarray: A read-only array of dtype PLAN_DTYPE, ordered by date.
+    """
+
+    offsets = np.arange(n_days)
+    n_body = n_days - len(c.WEEK)
+    taper = offsets >= n_body
+
+    # Phase, week within the phase and column in the templates for every day
+    phase_starts = np.array([0, phase_weeks[0], phase_weeks[0] + phase_weeks[1]]) * 7
+    phase = np.searchsorted(phase_starts, offsets, side="right") - 1
+    phase[taper] = TAPER
+    week = np.where(taper, 0, (offsets - phase_starts[np.minimum(phase, 2)]) // 7)
+    column = np.where(taper, offsets - n_body, offsets % 7)
+    weeks_in_phase = np.append(np.asarray(phase_weeks), 1)[phase]
+
+    f = FITNESS_LEVELS.index(fit_level)
+    t = {name: values[f, phase, column] for name, values in TEMPLATES.items() if name != "interval_pace"}
+    dict_id = t["dict_id"]
+    is_interval = dict_id == 5
+    is_distance = (dict_id != 0) & ~is_interval
+
+    # Distance progression over the weeks of the phase
+    addition = np.divide(t["distance_high"] - t["distance_low"], weeks_in_phase - 1,
+                         out=np.zeros(n_days), where=weeks_in_phase > 1)
+    distance = t["distance_low"] + (addition * week)
+
+    # Interval progression over the weeks of the phase (the on and off times don't progress)
+    sets = t["sets_low"] + np.rint((t["sets_high"] - t["sets_low"]) * week / weeks_in_phase).astype(np.int32)
+    interval_duration = (t["on"] + t["off"]) * sets
+
+    plan = np.zeros(n_days, dtype=PLAN_DTYPE)
+    plan["date"] = EPOCH + offsets
+    plan["phase"] = phase
+    plan["week"] = week
+    plan["dict_id"] = dict_id
+    plan["distance"] = np.where(is_distance, distance, 0)
+    plan["est_duration"] = np.where(is_interval, interval_duration, t["duration"])
+    plan["on"] = t["on"]
+    plan["off"] = t["off"]
+    plan["sets"] = sets
+
+    # Pace is the estimated duration over the distance, or the fixed interval pace for the fitness level
+    pace = np.divide(1, np.divide(distance, t["duration"], out=np.ones(n_days), where=is_distance),
+                     out=np.zeros(n_days), where=is_distance)
+    plan["est_avg_pace"] = np.where(is_interval, TEMPLATES["interval_pace"][f], pace)
+
+    plan.flags.writeable = False
+    return plan
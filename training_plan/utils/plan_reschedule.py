@@ -0,0 +1,149 @@
+"""
+Module implementing the incremental rescheduling of a marathon plan.
+
+When a runner's date of marathon or fitness level changes, only the future part of their plan is regenerated.
+The new plan starts on the next Monday, like a plan created at registration. Its runs are diffed by date against
+the ScheduledRun rows already stored from that Monday onwards, and only the inserts, updates and deletes are
+applied, in bulk and in one transaction. Runs before that Monday, and any run with a CompletedRun, are left
+untouched. The distance and pace scales of an adaptive plan (see plan_adapt.py) are applied to the regenerated part.
+The plan keeps its start_date, so its Strava history is still imported from the day it began; the day it was
+rescheduled on is stored in rescheduled_on.
+
+Virtual plans (see plan_store.py) compute their runs from the plan's generation parameters. Their current
+parameters are appended to past_parameters, with the new start as the day they stop applying from, so the runs
+before it are still computed rather than stored. Override rows in the regenerated part are removed, since the new
+parameters now compute those runs.
+
+Plans are rescheduled in the background (see the reschedule_plan job in ../tasks.py), so a change that can't be
+rescheduled leaves its error on the failed job.
+
+Functions:
+- enqueue_reschedule(plan, user): Enqueues the rescheduling of a plan for the user's new details.
+- reschedule_plan(plan, user, today=None): Regenerates the future part of a plan for the user's new details.
+
+Example:
+python
+user.date_of_marathon = date(2024, 10, 6)
+user.save()
+counts = reschedule_plan(MarathonPlan.objects.get(user=user), user)
+
+"""
+
+from datetime import date, timedelta
+
+from django.db import transaction
+
+from ..models import MarathonPlan, ScheduledRun
+from . import jobs, plan_algo, plan_version
+from . import p_a_constants as c
+
+# Fields compared to decide whether a stored run needs updating
+RUN_FIELDS = ["dict_id", "run", "run_feel", "distance", "est_duration", "est_avg_pace", "on", "off", "sets"]
+
+
+def enqueue_reschedule(plan, user):
+    """
+    Enqueue the rescheduling of a plan for the user's current date of marathon and fitness level, once per
+    version of the plan and new details.
+
+    Args:
+    - plan (MarathonPlan): The plan to reschedule.
+    - user (RunnerUser): The owner of the plan, with the new date of marathon and/or fitness level.
+
+    Returns:
+    - Job: The new or existing job.
+    """
+
+    key = f"reschedule_plan:{plan.id}:{plan.version}:{user.date_of_marathon}:{user.fitness_level}"
+    return jobs.enqueue("reschedule_plan", key, user=user)
+
+
+def reschedule_plan(plan, user, today=None) -> dict:
+    """
+    Regenerate the future part of a plan for the user's current date of marathon and fitness level.
+
+    Args:
+    - plan (MarathonPlan): The plan to reschedule.
+    - user (RunnerUser): The owner of the plan, with the new date of marathon and/or fitness level.
+    - today (date, optional): The day the plan is rescheduled on (defaults to today).
+
+    Raises:
+    - ValueError: If the new date of marathon is too close to regenerate the plan up to it.
+
+    Returns:
+    - dict: The number of runs "inserted", "updated" and "deleted".
+    """
+
+    new_plan = plan_algo.NewMarathonPlan(user, storage=plan.storage)
+    new_plan.today = today or date.today()
+    new_plan.plan = plan
+
+    # Unlike a new plan, a rescheduled one may be short: it only needs a run on the next Monday at least
+    window_start = new_plan.today + timedelta(days=(7 - new_plan.today.weekday()) % 7)
+    if new_plan.date_of_marathon < window_start:
+        raise ValueError(f"The marathon ({new_plan.date_of_marathon}) is before the rescheduled plan would start "
+                         f"({window_start})")
+
+    # The adaptation of the plan (see plan_adapt.py) carries over to the regenerated part
+    runs = new_plan.build_runs_in_plan(distance_scale=plan.distance_scale, pace_scale=plan.pace_scale)
+    with transaction.atomic():
+        stored_runs = ScheduledRun.objects.filter(marathon_plan=plan, date__gte=window_start)
+
+        # Completed runs are kept as they are, along with the date they were scheduled on
+        kept_dates = set(stored_runs.filter(completedrun__isnull=False).values_list("date", flat=True))
+        stored_runs = {run.date: run for run in stored_runs.filter(completedrun__isnull=True)}
+
+        to_insert, to_update = [], []
+        if plan.storage == MarathonPlan.VIRTUAL:
+            # The new parameters compute the regenerated part, so its overrides are no longer needed
+            _keep_past_parameters(plan, window_start)
+        else:
+            for run in runs:
+                if run.date in kept_dates:
+                    continue
+                stored_run = stored_runs.pop(run.date, None)
+                if stored_run is None:
+                    to_insert.append(run)
+                elif any(getattr(stored_run, field) != getattr(run, field) for field in RUN_FIELDS):
+                    for field in RUN_FIELDS:
+                        setattr(stored_run, field, getattr(run, field))
+                    to_update.append(stored_run)
+
+        # Whatever is left is no longer part of the plan
+        to_delete = [run.id for run in stored_runs.values()]
+
+        ScheduledRun.objects.bulk_create(to_insert, batch_size=c.BULK_CREATE_BATCH_SIZE)
+        ScheduledRun.objects.bulk_update(to_update, RUN_FIELDS, batch_size=c.BULK_CREATE_BATCH_SIZE)
+        ScheduledRun.objects.filter(id__in=to_delete).delete()
+        plan_version.bump([plan.id])  # The runs computed from the plan's parameters change too
+
+        plan.rescheduled_on = new_plan.today
+        plan.end_date = new_plan.date_of_marathon
+        plan.fitness_level = new_plan.fitness_level
+        plan.save(update_fields=["rescheduled_on", "end_date", "fitness_level", "past_parameters"])
+
+    return {"inserted": len(to_insert), "updated": len(to_update), "deleted": len(to_delete)}
+
+
+def _keep_past_parameters(plan, window_start) -> None:
+    """
+    Append the current generation parameters of a virtual plan to its past_parameters, so its runs before
+    window_start are still computed from them once the parameters change (see plan_store.py).
+
+    Args:
+    - plan (MarathonPlan): The virtual plan, still holding its old generation parameters.
+    - window_start (date): The first day of the regenerated part of the plan.
+    """
+
+    if plan.past_parameters and date.fromisoformat(plan.past_parameters[-1]["until"]) >= window_start:
+        # Rescheduled again before its last new start: the current parameters haven't computed any run yet
+        return
+
+    plan.past_parameters = plan.past_parameters + [{
+        "until": window_start.isoformat(),
+        "today": (plan.rescheduled_on or plan.start_date).isoformat(),
+        "end_date": plan.end_date.isoformat(),
+        "fitness_level": plan.fitness_level,
+        "distance_scale": plan.distance_scale,
+        "pace_scale": plan.pace_scale,
+    }]
@@ -0,0 +1,232 @@
+"""
+Module implementing the read-through layer for the scheduled runs of a marathon plan.
+
+Materialized plans store one ScheduledRun row per day, so runs are simply read from the database. Virtual plans
+only store their generation parameters: their runs are computed on read by the plan algorithm, and ScheduledRun
+rows only exist for the days that have been overridden (e.g. a run that has been completed or linked to Strava).
+Stored rows always win over computed runs. Computed runs are scaled by the plan's distance_scale and pace_scale,
+so adapting a virtual plan (see plan_adapt.py) doesn't store its runs. The runs of a rescheduled virtual plan before
+each reschedule are computed from the parameters it had then (see plan_reschedule.py).
+
+Runs computed on read are unsaved ScheduledRun objects (their id is None). Use materialize() to store one before
+linking anything to it. A plan stores at most one run per day (a unique constraint), so concurrent writers can't
+store a day twice.
+
+Long ranges of runs are read a page at a time with get_runs_page(), using keyset pagination on (date, id): each
+page starts after the last run of the previous one (its cursor), so reading a page costs the same wherever it is in
+the plan, and only the runs of the page are computed for virtual plans.
+
+Functions:
+- get_runs(plan, start=None, end=None, with_completed=False): Gets the runs of a plan, ordered by date.
+- get_runs_page(plan, start=None, end=None, after=None, limit=PAGE_SIZE): Gets a page of the runs of a plan.
+- get_next_runs(plan, start, count, with_completed=False): Gets the first runs of a plan from a date.
+- get_run(plan, day): Gets the run of a plan on a given day.
+- materialize(run): Stores a computed run so that other rows can reference it.
+- run_values(run): Converts a run to a dictionary, like QuerySet.values().
+
+Example:
+python
+todays_run = plan_store.get_run(marathon_plan, date.today())
+next_runs = plan_store.get_runs(marathon_plan, start=date.today())[1:4]
+
+"""
+
+from datetime import date, timedelta
+
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.forms.models import model_to_dict
+
+from ..models import MarathonPlan, ScheduledRun
+from . import plan_algo
+
+PAGE_SIZE = 28  # Runs per page by default, four weeks
+MAX_PAGE_SIZE = 100  # Most runs a page may hold
+
+
+def get_runs(plan, start=None, end=None, with_completed=False):
+    """
+    Get the runs of a plan between two dates, ordered by date.
+
+    Args:
+    - plan (MarathonPlan): The plan.
+    - start (date, optional): The first date to include.
+    - end (date, optional): The last date to include.
+    - with_completed (bool, optional): Join the completed run of each stored run in the same query.
+
+    Returns:
+    - QuerySet or list: The runs of a materialized plan as a QuerySet, or the stored and computed runs of a
+      virtual plan as a list.
+    """
+
+    stored_runs = ScheduledRun.objects.filter(marathon_plan=plan)
+    if start is not None:
+        stored_runs = stored_runs.filter(date__gte=start)
+    if end is not None:
+        stored_runs = stored_runs.filter(date__lte=end)
+    stored_runs = stored_runs.order_by("date")
+    if with_completed:
+        stored_runs = stored_runs.select_related("completedrun")
+
+    if plan.storage != MarathonPlan.VIRTUAL:
+        return stored_runs
+
+    runs = {run.date: run for run in _computed_runs(plan, start, end)}
+    runs.update({run.date: run for run in stored_runs})
+
+    return [runs[run_date] for run_date in sorted(runs)]
+
+
+def _computed_runs(plan, start, end):
+    """
+    Compute the runs of a virtual plan between two dates (either may be None). The runs before each reschedule are
+    computed from the parameters the plan had then, with the scales it had then, and the others from its current
+    parameters.
+    """
+
+    generations = [(plan_algo.NewMarathonPlan.from_past_parameters(plan, parameters), parameters["distance_scale"],
+                    parameters["pace_scale"], date.fromisoformat(parameters["until"]))
+                   for parameters in plan.past_parameters]
+    generations.append((plan_algo.NewMarathonPlan.from_plan(plan), plan.distance_scale, plan.pace_scale, None))
+
+    runs = []
+    first = start
+    for new_plan, distance_scale, pace_scale, until in generations:
+        last = end
+        if until is not None:
+            last = min(end, until - timedelta(days=1)) if end is not None else until - timedelta(days=1)
+        if first is None or last is None or first <= last:
+            runs += new_plan.build_runs_in_plan(first, last, distance_scale, pace_scale)
+        if until is not None:
+            first = max(first, until) if first is not None else until
+    return runs
+
+
+def get_runs_page(plan, start=None, end=None, after=None, limit=PAGE_SIZE):
+    """
+    Get a page of the runs of a plan between two dates, ordered by date and id.
+
+    Args:
+    - plan (MarathonPlan): The plan.
+    - start (date, optional): The first date to include.
+    - end (date, optional): The last date to include.
+    - after (tuple, optional): The (date, id) of the last run of the previous page; the id is None for a run
+      computed on read.
+    - limit (int, optional): The number of runs in the page, at most MAX_PAGE_SIZE.
+
+    Returns:
+    - tuple: The runs of the page as a list, and the (date, id) to pass as after for the next page, or None if
+      this is the last page.
+    """
+
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+    if plan.storage == MarathonPlan.VIRTUAL:
+        # Virtual plans have a run every day from the Monday they start on, so the page (and the run after it) is
+        # within limit days of the cursor, plus the days before that first Monday
+        if after is not None:
+            start = max(start, after[0] + timedelta(days=1)) if start else after[0] + timedelta(days=1)
+        start = start or plan.start_date
+        window_end = start + timedelta(days=limit + 7)
+        runs = get_runs(plan, start=start, end=min(end, window_end) if end else window_end)[:limit + 1]
+    else:
+        stored_runs = ScheduledRun.objects.filter(marathon_plan=plan)
+        if start is not None:
+            stored_runs = stored_runs.filter(date__gte=start)
+        if end is not None:
+            stored_runs = stored_runs.filter(date__lte=end)
+        if after is not None:
+            stored_runs = stored_runs.filter(Q(date__gt=after[0]) | Q(date=after[0], id__gt=after[1] or 0))
+        runs = list(stored_runs.order_by("date", "id")[:limit + 1])
+
+    # One run more than the page is read to know whether there is a next page
+    if len(runs) <= limit:
+        return list(runs), None
+    runs = list(runs[:limit])
+    return runs, (runs[-1].date, runs[-1].id)
+
+
+def get_next_runs(plan, start, count, with_completed=False):
+    """
+    Get the first runs of a plan on or after a date, however far away the first of them is (e.g. before phase 1
+    starts on the next Monday).
+
+    Args:
+    - plan (MarathonPlan): The plan.
+    - start (date): The first date to include.
+    - count (int): The number of runs.
+    - with_completed (bool, optional): Join the completed run of each stored run in the same query.
+
+    Returns:
+    - list: At most count runs, ordered by date.
+    """
+
+    if plan.storage != MarathonPlan.VIRTUAL:
+        return list(get_runs(plan, start=start, with_completed=with_completed)[:count])
+
+    # Virtual plans have a run every day from the Monday they start on, so the runs are almost always within the
+    # first window; it only grows for plans with gaps (e.g. runs deleted from the admin)
+    days = count + 7
+    while True:
+        end = start + timedelta(days=days)
+        runs = get_runs(plan, start=start, end=end, with_completed=with_completed)
+        if len(runs) >= count or end >= plan.end_date:
+            return runs[:count]
+        days *= 2
+
+
+def get_run(plan, day):
+    """
+    Get the run of a plan on a given day.
+
+    Args:
+    - plan (MarathonPlan): The plan.
+    - day (date): The day of the run.
+
+    Returns:
+    - ScheduledRun or None: The run, or None if there is no run on that day.
+    """
+
+    runs = get_runs(plan, start=day, end=day)
+    return runs[0] if len(runs) else None
+
+
+def materialize(run):
+    """
+    Store a run computed on read, so that other rows (e.g. a CompletedRun) can reference it.
+
+    Args:
+    - run (ScheduledRun): The run, saved or not.
+
+    Returns:
+    - ScheduledRun: The stored run.
+    """
+
+    if run.pk is not None:
+        return run
+
+    lookup = {"marathon_plan": run.marathon_plan, "date": run.date}
+    stored_run = ScheduledRun.objects.filter(**lookup).first()
+    if stored_run is not None:
+        return stored_run
+
+    try:
+        with transaction.atomic():  # A savepoint, so a conflict leaves the caller's transaction usable
+            return ScheduledRun.objects.create(**lookup, **model_to_dict(run, exclude=["id", "marathon_plan", "date"]))
+    except IntegrityError:
+        # Another writer (e.g. a sync or an adaptation) stored the run of that day first
+        return ScheduledRun.objects.get(**lookup)
+
+
+def run_values(run):
+    """
+    Convert a run to a dictionary with the same keys as ScheduledRun.objects.values().
+
+    Args:
+    - run (ScheduledRun): The run, saved or not.
+
+    Returns:
+    - dict: The field values of the run.
+    """
+
+    return {field.attname: getattr(run, field.attname) for field in ScheduledRun._meta.concrete_fields}
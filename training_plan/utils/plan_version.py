@@ -0,0 +1,63 @@
+"""
+Module implementing the version of a marathon plan, used to answer conditional requests to the run APIs.
+
+Every MarathonPlan has a version that only ever goes up: it is bumped whenever one of its ScheduledRuns or
+CompletedRuns is saved or deleted. Single saves and deletes are caught by the signal handlers (see signals.py);
+code that writes runs in bulk (bulk_create, bulk_update, QuerySet.update) must call bump() itself.
+
+The run APIs send the version as their ETag, so a client that already has the current version gets a 304 Not
+Modified from the version check alone, without the runs being read (see views.py). The day is part of the ETag, as
+the runs the APIs return (e.g. today's run) also depend on it.
+
+Functions:
+- bump(plan_ids): Bumps the version of plans.
+- etag(plan, today=None): Gets the ETag of the runs of a plan.
+
+Example:
+python
+ScheduledRun.objects.bulk_update(runs, ["distance"])
+plan_version.bump([plan.id])
+
+"""
+
+from datetime import date
+
+from django.conf import settings
+from django.db.models import F
+
+from ..models import MarathonPlan
+from . import runner_context
+
+
+def bump(plan_ids) -> None:
+    """
+    Bump the version of plans, in one query.
+
+    Args:
+    - plan_ids (list or QuerySet): The IDs of the plans.
+    """
+
+    plans = MarathonPlan.objects.filter(pk__in=plan_ids)
+    plans.update(version=F("version") + 1)
+
+    # Cached runner contexts hold the old version
+    if settings.RUNNER_CONTEXT_CACHE_TIMEOUT:
+        for user_id in plans.values_list("user_id", flat=True):
+            runner_context.invalidate(user_id)
+
+
+def etag(plan, today=None):
+    """
+    Get the ETag of the runs of a plan.
+
+    Args:
+    - plan (MarathonPlan or None): The plan.
+    - today (date, optional): The current day (defaults to today).
+
+    Returns:
+    - str or None: The ETag, or None if there is no plan.
+    """
+
+    if plan is None:
+        return None
+    return f"{plan.id}-{plan.version}-{(today or date.today()).isoformat()}"
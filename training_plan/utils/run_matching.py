@@ -0,0 +1,136 @@
+"""
+Module implementing the matching of Strava activities to the scheduled runs of a plan.
+
+Runners record doubles, warm-ups and cool-downs as separate activities, so the runs of a day are scored against
+the scheduled run of that day, alone and together: the runs of each day are sorted longest first, and each
+prefix (the longest run, the two longest runs together, ...) is scored. The best scoring prefix becomes the
+completed run of the day, so a warm-up is only added to the main run when it brings the total closer to the plan.
+
+The score is a weighted mean of the similarity of the distance, duration and pace to the plan, each the ratio of
+the smaller value to the larger one (1 is a perfect match). Interval runs (dict_id 5) are scored on their duration
+only, against their sets of on and off minutes. Days with nothing to compare against (e.g. rest days) score 0, and
+their longest run is used.
+
+Scoring is vectorized with NumPy over a whole batch of activities and scheduled runs at once, so backfills, syncs
+and webhooks share one engine, whatever the size of the batch.
+
+Classes:
+- Match: The activities matched to a scheduled run, with their score.
+
+Functions:
+- is_run(activity): Checks whether an activity is a run that can complete a scheduled run.
+- activity_date(activity): Gets the day an activity was started on.
+- match_activities(activities, scheduled_runs): Matches a batch of activities to the scheduled runs of their days.
+
+Example:
+python
+for match in match_activities(activities, plan_store.get_runs(marathon_plan, start, end)):
+    print(match.scheduled_run.date, [activity["id"] for activity in match.activities], match.score)
+
+"""
+
+from collections import namedtuple
+from datetime import date
+
+import numpy as np
+
+INTERVAL_RUN = 5  # dict_id of interval runs
+WEIGHTS = np.array([0.4, 0.3, 0.3])  # Weights of the distance, duration and pace similarities
+
+Match = namedtuple("Match", ["scheduled_run", "activities", "score"])
+
+
+def is_run(activity) -> bool:
+    """
+    Check whether an activity is a run that can complete a scheduled run.
+    """
+
+    return activity.get("type") == "Run" and bool(activity.get("distance"))
+
+
+def activity_date(activity) -> date:
+    """
+    Get the day an activity was started on, from its start_date (e.g. "2024-05-01T07:00:00Z").
+    """
+
+    return date.fromisoformat(activity["start_date"][:10])
+
+
+def match_activities(activities, scheduled_runs) -> list:
+    """
+    Match a batch of activities to the scheduled runs of their days.
+
+    Args:
+    - activities (list): Strava activities, as returned by the API. Activities that aren't runs are ignored.
+    - scheduled_runs (iterable): Scheduled runs (stored or computed), at most one per day.
+
+    Returns:
+    - list: A Match per scheduled run with runs on its day, ordered by date. Its activities are those that make up
+      the completed run, longest first.
+    """
+
+    runs_by_date = {run.date: run for run in scheduled_runs}
+    activities = [activity for activity in activities if is_run(activity) and activity_date(activity) in runs_by_date]
+    if not activities:
+        return []
+
+    days = np.array([activity_date(activity).toordinal() for activity in activities])
+    distances = np.array([activity["distance"] / 1000 for activity in activities], dtype=float)
+    durations = np.array([activity["moving_time"] / 60 for activity in activities], dtype=float)
+
+    # Group the activities by day, longest first
+    order = np.lexsort((-distances, days))
+    days, distances, durations = days[order], distances[order], durations[order]
+    unique_days, starts, counts = np.unique(days, return_index=True, return_counts=True)
+    group = np.repeat(np.arange(len(unique_days)), counts)
+
+    # Totals of each prefix of the day: the longest run, the two longest together, ...
+    cum_distances = np.cumsum(distances)
+    cum_durations = np.cumsum(durations)
+    cum_distances -= np.repeat(cum_distances[starts] - distances[starts], counts)
+    cum_durations -= np.repeat(cum_durations[starts] - durations[starts], counts)
+
+    targets = _targets([runs_by_date[date.fromordinal(int(day))] for day in unique_days])[group]
+    actuals = np.column_stack([cum_distances, cum_durations, cum_durations / cum_distances])
+    scores = _score(actuals, targets)
+
+    # Best prefix of each day; the shortest one wins a tie
+    position = np.arange(len(days)) - np.repeat(starts, counts)
+    best = np.lexsort((position, -scores, group))
+    best = best[starts]
+
+    return [Match(runs_by_date[date.fromordinal(int(unique_days[i]))],
+                  [activities[k] for k in order[starts[i]:index + 1]], round(float(scores[index]), 3))
+            for i, index in enumerate(best)]
+
+
+def _targets(scheduled_runs) -> np.ndarray:
+    """
+    Get the distance (km), duration (min) and pace (min/km) each scheduled run targets, 0 when there is none.
+    """
+
+    targets = np.array([(run.distance or 0, run.est_duration or 0,
+                         run.est_avg_pace.total_seconds() / 60 if run.est_avg_pace else 0,
+                         run.dict_id == INTERVAL_RUN, (run.on + run.off) * run.sets)
+                        for run in scheduled_runs], dtype=float).reshape(-1, 5)
+
+    # Intervals are scored on their duration only: the pace of their on minutes isn't the pace of the activity
+    intervals = targets[:, 3] == 1
+    targets[intervals, 0] = 0
+    targets[intervals, 1] = np.where(targets[intervals, 4] > 0, targets[intervals, 4], targets[intervals, 1])
+    targets[intervals, 2] = 0
+
+    return targets[:, :3]
+
+
+def _score(actuals, targets) -> np.ndarray:
+    """
+    Get the weighted mean of the similarities of the actual values to their targets, ignoring missing targets.
+    """
+
+    valid = targets > 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        similarity = np.where(valid, np.minimum(actuals, targets) / np.maximum(actuals, targets), 0)
+    weights = valid * WEIGHTS
+    total = weights.sum(axis=1)
+    return np.divide((similarity * weights).sum(axis=1), total, out=np.zeros(len(total)), where=total > 0)
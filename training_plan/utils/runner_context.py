@@ -0,0 +1,98 @@
+"""
+Module implementing the runner context of a request: the runner's plan and Strava profile, loaded at most once
+per request.
+
+request.user is already loaded by the authentication middleware, so views read the runner's plan and Strava
+profile from request.runner (set by RunnerContextMiddleware, see middleware.py) instead of looking the user up
+again. Nothing is queried until a view reads them; the plan is then read with the Strava profile joined in one
+query (and the profile alone, in a second query, for runners without a plan).
+
+With settings.RUNNER_CONTEXT_CACHE_TIMEOUT above 0, the plan and profile are also kept in the Django cache per
+runner, and the signal handlers (see signals.py) invalidate the entry whenever either is saved or deleted. Code
+that updates them in bulk (QuerySet.update) must call invalidate() itself.
+
+Classes:
+- RunnerContext: The plan and Strava profile of a runner, loaded lazily.
+
+Functions:
+- cache_key(user_id): Gets the cache key of a runner's context.
+- invalidate(user_id): Deletes the cached context of a runner.
+
+Example:
+python
+plan = request.runner.plan  # One query, on the first read only
+if request.runner.strava_profile is not None:
+    print(request.runner.strava_profile.last_synced_at)
+
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.functional import cached_property
+
+from ..models import MarathonPlan, StravaUserProfile
+
+
+class RunnerContext:
+    """
+    The plan and Strava profile of a runner, loaded at most once.
+
+    Args:
+    - user: The runner, possibly anonymous (they then have neither).
+    """
+
+    def __init__(self, user):
+        self.user = user
+
+    @property
+    def plan(self):
+        """
+        MarathonPlan or None: The plan of the runner.
+        """
+
+        return self._loaded[0]
+
+    @property
+    def strava_profile(self):
+        """
+        StravaUserProfile or None: The Strava profile of the runner, if they linked Strava.
+        """
+
+        return self._loaded[1]
+
+    @cached_property
+    def _loaded(self):
+        if not self.user.is_authenticated:
+            return None, None
+
+        timeout = settings.RUNNER_CONTEXT_CACHE_TIMEOUT
+        if timeout:
+            loaded = cache.get(cache_key(self.user.pk))
+            if loaded is not None:
+                return loaded
+
+        plan = MarathonPlan.objects.select_related("user__stravauserprofile").filter(user=self.user).first()
+        if plan is not None:
+            profile = getattr(plan.user, "stravauserprofile", None)
+        else:
+            profile = StravaUserProfile.objects.filter(user=self.user).first()
+
+        if timeout:
+            cache.set(cache_key(self.user.pk), (plan, profile), timeout)
+        return plan, profile
+
+
+def cache_key(user_id) -> str:
+    """
+    Get the cache key of a runner's context.
+    """
+
+    return f"runner_context:{user_id}"
+
+
+def invalidate(user_id) -> None:
+    """
+    Delete the cached context of a runner, so the next request reads their plan and Strava profile again.
+    """
+
+    cache.delete(cache_key(user_id))
@@ -0,0 +1,172 @@
+"""
+Module implementing the historical backfill of a user's Strava activities into CompletedRun.
+
+When a runner links Strava part way through their plan, every run they recorded since the start of the plan is
+imported. The activities are paged through /athlete/activities between an after and a before timestamp, as a
+stream of pages, and the whole days of each page are matched at once to the scheduled runs of an in-memory index of
+the plan built once (see run_matching.py). The last day of a full page may go on in the next one, so it is carried
+over and matched with it. The completed runs of each page are bulk created, so the number of queries per page
+stays constant however long the history is.
+
+Strava returns the activities after a timestamp oldest first, so the start time of the last imported activity is a
+checkpoint: the backfill job saves it after every page, and a job interrupted by rate limiting resumes from there
+when it is retried (see jobs.py).
+
+Functions:
+- iter_activity_pages(access_token, after, before, per_page=BACKFILL_PAGE_SIZE): Streams the pages of activities.
+- backfill_activities(user, after, before, checkpoint=None): Imports the runs recorded between two timestamps.
+
+Example:
+python
+counts = backfill_activities(user, after=1704067200, before=1719792000, checkpoint=save_checkpoint)
+
+"""
+
+from datetime import datetime, timezone
+
+from django.core.cache import cache
+from django.db import transaction
+
+from ..models import CompletedRun, MarathonPlan, ScheduledRun, StravaUserProfile
+from . import plan_adapt, plan_store, plan_version, run_matching, runner_context, strava_breaker, strava_client
+from . import strava_funcs
+from . import p_a_constants as c
+
+BACKFILL_PAGE_SIZE = 100  # Activities per page (Strava allows up to 200)
+
+
+def iter_activity_pages(access_token, after, before, per_page=BACKFILL_PAGE_SIZE):
+    """
+    Stream the pages of activities started between two timestamps, oldest first.
+
+    Args:
+    - access_token (str): The athlete's access token.
+    - after (int): Epoch timestamp; only the activities started after it.
+    - before (int): Epoch timestamp; only the activities started before it.
+    - per_page (int, optional): The number of activities per page.
+
+    Yields:
+    - list: The activities of each page.
+    """
+
+    client = strava_client.get_client()
+    page = 1
+    while True:
+        with strava_breaker.guard():
+            activities = client.get_activities(access_token, per_page=per_page, page=page, after=after, before=before)
+        if activities:
+            yield activities
+        if len(activities) < per_page:
+            return
+        page += 1
+
+
+def backfill_activities(user, after, before, checkpoint=None) -> dict:
+    """
+    Import the runs a user recorded on Strava between two timestamps into their plan.
+
+    The runs of each day are matched to its scheduled run, alone or aggregated (see run_matching.py), unless that
+    run has already been completed (by hand or by an earlier import). A day is only matched once all of its
+    activities have been read, even if they span two pages. Runs of virtual plans are stored first.
+
+    Args:
+    - user: The user whose activities to import.
+    - after (int): Epoch timestamp; only the activities started after it.
+    - before (int): Epoch timestamp; only the activities started before it.
+    - checkpoint (function, optional): Called with the start timestamp of the last imported activity, every time
+      the whole days of a page are imported.
+
+    Raises:
+    - LookupError: If the Strava profile or the marathon plan is not found.
+    - StravaError: If Strava can't be reached or the circuit is open.
+
+    Returns:
+    - dict: The number of "pages" and "activities" read and the number of runs "completed".
+    """
+
+    try:
+        marathon_plan = MarathonPlan.objects.get(user=user)
+    except MarathonPlan.DoesNotExist:
+        raise LookupError("Marathon plan not found")
+    access_token = strava_funcs.get_access_token(user)
+
+    # In-memory index of the plan, built once; runs of virtual plans computed on read have no id yet
+    plan_runs = {run.date: run for run in plan_store.get_runs(marathon_plan)}
+    completed = CompletedRun.objects.filter(scheduled_run__marathon_plan=marathon_plan).values_list(
+        "scheduled_run__date", "strava_activity_ids")
+    completed_dates = {run_date for run_date, _ in completed}
+    imported = {activity_id for _, activity_ids in completed for activity_id in activity_ids}
+
+    counts = {"pages": 0, "activities": 0, "completed": 0}
+    pending = []
+    for activities in iter_activity_pages(access_token, after, before, BACKFILL_PAGE_SIZE):
+        counts["pages"] += 1
+        counts["activities"] += len(activities)
+        pending += activities
+        if len(activities) < BACKFILL_PAGE_SIZE:
+            break  # The last page, imported below
+
+        # The last day of the page may go on in the next one, so it is imported with it
+        last_day = run_matching.activity_date(pending[-1])
+        ready = [activity for activity in pending if run_matching.activity_date(activity) < last_day]
+        pending = [activity for activity in pending if run_matching.activity_date(activity) >= last_day]
+        if ready:
+            counts["completed"] += _import_activities(user, marathon_plan, ready, plan_runs, completed_dates, imported)
+            if checkpoint is not None:
+                checkpoint(int(_start(ready[-1]).timestamp()))
+
+    if pending:
+        counts["completed"] += _import_activities(user, marathon_plan, pending, plan_runs, completed_dates, imported)
+        if checkpoint is not None:
+            checkpoint(int(_start(pending[-1]).timestamp()))
+
+    StravaUserProfile.objects.filter(user=user, last_synced_at__isnull=True).update(
+        last_synced_at=datetime.fromtimestamp(before, tz=timezone.utc))
+    cache.delete(strava_funcs.sync_status_key(user.id))
+    runner_context.invalidate(user.id)  # The update doesn't send post_save
+    if counts["completed"]:
+        # Bulk created runs don't send post_save, so the plan is adapted once at the end
+        plan_adapt.adapt_plan(marathon_plan)
+
+    return counts
+
+
+def _import_activities(user, marathon_plan, activities, plan_runs, completed_dates, imported) -> int:
+    """
+    Match the activities of whole days to the runs of the plan not completed yet, and bulk create the completed
+    runs, in one transaction. The completed dates and imported activity ids are updated in place.
+
+    Returns:
+    - int: The number of runs completed.
+    """
+
+    pending = [activity for activity in activities if activity.get("id") not in imported]
+    matches = run_matching.match_activities(pending, [run for run_date, run in plan_runs.items()
+                                                      if run_date not in completed_dates])
+
+    with transaction.atomic():
+        # Runs of virtual plans computed on read are stored before they are completed
+        missing = [match.scheduled_run for match in matches if match.scheduled_run.pk is None]
+        if missing:
+            # The days another writer stored meanwhile are skipped, their ids are read back below
+            ScheduledRun.objects.bulk_create(missing, batch_size=c.BULK_CREATE_BATCH_SIZE, ignore_conflicts=True)
+            stored_ids = dict(ScheduledRun.objects.filter(
+                marathon_plan=marathon_plan, date__in=[run.date for run in missing]).values_list("date", "id"))
+            for run in missing:
+                run.pk = stored_ids[run.date]
+
+        new_runs = [strava_funcs.completed_run_from_activities(match.activities, match.scheduled_run)
+                    for match in matches]
+        CompletedRun.objects.bulk_create(new_runs, batch_size=c.BULK_CREATE_BATCH_SIZE)
+        if new_runs:
+            plan_version.bump([marathon_plan.id])
+        for completed_run in new_runs:
+            strava_funcs.enqueue_streams(user, completed_run)
+
+    completed_dates.update(run.date for run in new_runs)
+    imported.update(activity_id for run in new_runs for activity_id in run.strava_activity_ids)
+    return len(new_runs)
+
+
+def _start(activity) -> datetime:
+    return datetime.fromisoformat(activity["start_date"].replace("Z", "+00:00"))
@@ -0,0 +1,138 @@
+"""
+Module implementing the circuit breaker around the calls to Strava, shared by every process of the app.
+
+When Strava is down or too slow, every call would otherwise wait for its timeouts and retries and tie up a
+worker. The breaker counts the outages (connection errors, timeouts and 5xx responses, once the client's retries
+are used up) of every process in the Django cache:
+- Closed: calls go through. FAILURE_THRESHOLD outages within FAILURE_WINDOW seconds open the circuit.
+- Open: calls fail fast with CircuitOpen, for OPEN_SECONDS.
+- Half-open: one probe call is let through. If it reaches Strava the circuit closes, otherwise it opens again.
+
+CircuitOpen carries a retry_after, so the job queue retries the jobs it stops once the circuit may close (see
+jobs.py), without using up an attempt. Pages keep showing the last known sync state (see
+strava_funcs.sync_status). State changes are printed and exported as the strava.breaker.transition counter and
+the strava.breaker.open gauge (see metrics.py), so they can be alerted on.
+
+Classes:
+- CircuitOpen: Raised instead of calling Strava while the circuit is open.
+
+Functions:
+- guard(): Context manager wrapping a call to Strava.
+- state(now=None): Gets the state of the circuit.
+
+Example:
+python
+with strava_breaker.guard():
+    activities = strava_client.get_client().get_activities(access_token)
+
+"""
+
+import time
+from contextlib import contextmanager
+
+from django.core.cache import cache
+
+from . import metrics, strava_client
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+FAILURE_THRESHOLD = 5  # Outages within the window that open the circuit
+FAILURE_WINDOW = 60  # Seconds over which outages are counted
+OPEN_SECONDS = 30  # Seconds the circuit stays open before a probe call is let through
+PROBE_TIMEOUT = 30  # Seconds after which another probe is let through if the first one never finished
+
+STATE_KEY = "strava_breaker:open_until"
+FAILURES_KEY = "strava_breaker:failures"
+PROBE_KEY = "strava_breaker:probe"
+
+
+class CircuitOpen(strava_client.StravaError):
+    """
+    Raised instead of calling Strava while the circuit is open.
+
+    Attributes:
+    - retry_after (float): The seconds until a call may go through again.
+    """
+
+    def __init__(self, retry_after):
+        super().__init__(f"Strava circuit is open for {retry_after:.0f} s")
+        self.retry_after = retry_after
+
+
+def state(now=None) -> str:
+    """
+    Get the state of the circuit.
+
+    Args:
+    - now (float, optional): Epoch timestamp (defaults to now).
+
+    Returns:
+    - str: CLOSED, OPEN or HALF_OPEN.
+    """
+
+    open_until = cache.get(STATE_KEY)
+    if open_until is None:
+        return CLOSED
+    return OPEN if (now or time.time()) < open_until else HALF_OPEN
+
+
+@contextmanager
+def guard():
+    """
+    Wrap a call to Strava: fail fast while the circuit is open, and record whether Strava could be reached.
+
+    Raises:
+    - CircuitOpen: If the circuit is open, or half-open with a probe already in flight.
+    """
+
+    now = time.time()
+    current = state(now)
+    if current == OPEN:
+        raise CircuitOpen(cache.get(STATE_KEY, now) - now)
+    if current == HALF_OPEN:
+        if not cache.add(PROBE_KEY, 1, PROBE_TIMEOUT):
+            raise CircuitOpen(PROBE_TIMEOUT)  # Another call is probing
+        _transition(HALF_OPEN)
+
+    try:
+        yield
+    except strava_client.StravaError as e:
+        if e.status is None or e.status >= 500:
+            _failure(current, time.time())
+        elif current == HALF_OPEN and not isinstance(e, strava_client.RateLimitExceeded):
+            _close()  # Strava answered, even if it was to refuse the call
+        raise
+    else:
+        if current == HALF_OPEN:
+            _close()
+    finally:
+        if current == HALF_OPEN:
+            cache.delete(PROBE_KEY)
+
+
+def _failure(current, now) -> None:
+    if current == HALF_OPEN:
+        _open(now)
+        return
+    cache.add(FAILURES_KEY, 0, FAILURE_WINDOW)
+    if cache.incr(FAILURES_KEY) >= FAILURE_THRESHOLD:
+        _open(now)
+
+
+def _open(now) -> None:
+    cache.set(STATE_KEY, now + OPEN_SECONDS, None)
+    cache.delete(FAILURES_KEY)
+    _transition(OPEN)
+
+
+def _close() -> None:
+    cache.delete_many([STATE_KEY, FAILURES_KEY])
+    _transition(CLOSED)
+
+
+def _transition(new_state) -> None:
+    print(f"Strava circuit breaker is {new_state}")
+    metrics.increment("strava.breaker.transition", state=new_state)
+    metrics.gauge("strava.breaker.open", int(new_state != CLOSED))
@@ -0,0 +1,252 @@
+"""
+Module implementing the shared HTTP client for the Strava API.
+
+Every call to Strava goes through one StravaClient, so that:
+- Connections are pooled and kept alive by a requests Session, instead of a new TLS handshake per call.
+- Every call has a connect timeout and a read timeout, so a slow Strava API can't hang a worker.
+- Rate limited (429) and server error (5xx) responses, connection errors and timeouts are retried with jittered
+  exponential backoff ("full jitter"), honouring the Retry-After header when Strava sends one.
+- The latency of every call, and the number of calls by status, are recorded with the metrics module.
+- The API is called at settings.STRAVA_API_BASE_URL, so the app can be pointed at a fake Strava (see
+  fake_strava.py).
+- Every attempt first takes a token from the rate limit governor shared by the processes, and the rate limit
+  headers of every response are fed back to it (see strava_ratelimit.py).
+
+Errors are raised as StravaError once the retries are used up, or straight away for the other 4xx responses. A call
+refused by the governor raises RateLimitExceeded without reaching Strava.
+
+Classes:
+- StravaError: Raised when a call to Strava fails.
+- RateLimitExceeded: Raised when the rate limit budget is used up.
+- StravaClient: HTTP client for the Strava API.
+
+Functions:
+- get_client(): Gets the client shared by the process.
+
+Example:
+python
+client = strava_client.get_client()
+activities = client.get_activities(access_token, per_page=5)
+
+"""
+
+import functools
+import random
+import time
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+from . import metrics, strava_ratelimit
+
+API_URL = "https://www.strava.com/api/v3"
+OAUTH_URL = "https://www.strava.com/oauth"
+
+CONNECT_TIMEOUT = 3.05  # Seconds to establish a connection
+READ_TIMEOUT = 10  # Seconds to wait for the response
+MAX_RETRIES = 3  # Retries after the first attempt
+BACKOFF_BASE = 0.5  # Seconds, doubled after every attempt
+BACKOFF_CAP = 8  # Longest wait between two attempts, in seconds
+POOL_SIZE = 10  # Connections kept alive per host
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class StravaError(Exception):
+    """
+    Raised when a call to Strava fails.
+
+    Attributes:
+    - status (int or None): The HTTP status of the last response, or None if there was no response.
+    """
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class RateLimitExceeded(StravaError):
+    """
+    Raised when the rate limit budget for the priority of a call is used up.
+
+    Attributes:
+    - retry_after (float): The seconds until the exhausted window starts again.
+    """
+
+    def __init__(self, message, retry_after):
+        super().__init__(message, 429)
+        self.retry_after = retry_after
+
+
+class StravaClient:
+    """
+    HTTP client for the Strava API, with pooled connections, timeouts, retries and latency metrics.
+
+    Args:
+    - api_url (str, optional): Base URL of the API.
+    - oauth_url (str, optional): Base URL of the OAuth endpoints.
+    - connect_timeout (float, optional): Seconds to establish a connection.
+    - read_timeout (float, optional): Seconds to wait for the response.
+    - max_retries (int, optional): Retries after the first attempt.
+    - backoff_base (float, optional): Seconds before the first retry, doubled after every attempt.
+    - backoff_cap (float, optional): Longest wait between two attempts, in seconds.
+    - pool_size (int, optional): Connections kept alive per host.
+    """
+
+    def __init__(self, api_url=API_URL, oauth_url=OAUTH_URL, connect_timeout=CONNECT_TIMEOUT,
+                 read_timeout=READ_TIMEOUT, max_retries=MAX_RETRIES, backoff_base=BACKOFF_BASE,
+                 backoff_cap=BACKOFF_CAP, pool_size=POOL_SIZE) -> None:
+        self.api_url = api_url.rstrip("/")
+        self.oauth_url = oauth_url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+
+        # Retries are handled by request() so that they are jittered and measured
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def get_activities(self, access_token, per_page=30, page=1, **params) -> list:
+        """
+        Get the activities of the athlete the access token belongs to, most recent first.
+
+        Args:
+        - access_token (str): The athlete's access token.
+        - per_page (int, optional): The number of activities per page.
+        - page (int, optional): The page to get.
+        - **params: Other query parameters, e.g. after or before (epoch timestamps).
+
+        Returns:
+        - list: The activities, as dictionaries.
+        """
+
+        return self.request("GET", f"{self.api_url}/athlete/activities", endpoint="athlete/activities",
+                            headers={"Authorization": f"Bearer {access_token}"},
+                            params={"per_page": per_page, "page": page, **params}).json()
+
+    def get_activity(self, access_token, activity_id) -> dict:
+        """
+        Get one activity of the athlete the access token belongs to.
+
+        Args:
+        - access_token (str): The athlete's access token.
+        - activity_id (int): The ID of the activity.
+
+        Returns:
+        - dict: The activity.
+        """
+
+        return self.request("GET", f"{self.api_url}/activities/{activity_id}", endpoint="activities",
+                            headers={"Authorization": f"Bearer {access_token}"}).json()
+
+    def get_streams(self, access_token, activity_id, keys=("time", "heartrate", "velocity_smooth")) -> dict:
+        """
+        Get the streams (per-second samples) of one activity of the athlete the access token belongs to.
+
+        Args:
+        - access_token (str): The athlete's access token.
+        - activity_id (int): The ID of the activity.
+        - keys (tuple, optional): The streams to get.
+
+        Returns:
+        - dict: The samples of each stream the activity has, by name.
+        """
+
+        streams = self.request("GET", f"{self.api_url}/activities/{activity_id}/streams", endpoint="activities/streams",
+                               headers={"Authorization": f"Bearer {access_token}"},
+                               params={"keys": ",".join(keys), "key_by_type": "true"}).json()
+        return {name: stream["data"] for name, stream in streams.items()}
+
+    def refresh_token(self, client_id, client_secret, refresh_token) -> dict:
+        """
+        Exchange a refresh token for a new access token.
+
+        Args:
+        - client_id (str): The app's Strava client id.
+        - client_secret (str): The app's Strava client secret.
+        - refresh_token (str): The athlete's refresh token.
+
+        Returns:
+        - dict: The token data, with access_token, refresh_token, expires_at and expires_in.
+        """
+
+        return self.request("POST", f"{self.oauth_url}/token", endpoint="oauth/token", data={
+            "client_id": client_id,
+            "client_secret": client_secret,
+            "grant_type": "refresh_token",
+            "refresh_token": refresh_token,
+        }).json()
+
+    def request(self, method, url, endpoint, **kwargs) -> requests.Response:
+        """
+        Make a call to Strava, retrying rate limited and failed calls with jittered exponential backoff.
+
+        Args:
+        - method (str): The HTTP method.
+        - url (str): The full URL.
+        - endpoint (str): The name of the endpoint, used to label the metrics.
+        - **kwargs: Passed on to requests.Session.request.
+
+        Raises:
+        - RateLimitExceeded: If the rate limit budget is used up.
+        - StravaError: If the call still fails after the retries, or fails with a status that isn't retried.
+
+        Returns:
+        - requests.Response: The successful response.
+        """
+
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            wait = strava_ratelimit.acquire()
+            if wait is not None:
+                raise RateLimitExceeded(f"{method} {endpoint} rate limited for {wait:.0f} s", wait)
+            try:
+                with metrics.timer("strava.request", endpoint=endpoint):
+                    response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                metrics.increment("strava.response", endpoint=endpoint, status=type(e).__name__)
+                error = StravaError(f"{method} {endpoint} failed: {e}")
+            else:
+                metrics.increment("strava.response", endpoint=endpoint, status=response.status_code)
+                strava_ratelimit.record(response.headers)
+                if response.ok:
+                    return response
+                error = StravaError(f"{method} {endpoint} returned {response.status_code}", response.status_code)
+                if response.status_code not in RETRY_STATUSES:
+                    raise error
+                retry_after = response.headers.get("Retry-After")
+
+            if attempt < self.max_retries:
+                time.sleep(self._backoff(attempt, retry_after))
+
+        raise error
+
+    def _backoff(self, attempt, retry_after=None) -> float:
+        """
+        Get how long to wait before the next attempt: a random time up to the exponential backoff ("full
+        jitter"), or the time Strava asked for in a Retry-After header.
+        """
+
+        if retry_after is not None and retry_after.isdigit():
+            return min(float(retry_after), self.backoff_cap)
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+
+
+def get_client() -> StravaClient:
+    """
+    Get the client shared by the process, so that every call to Strava uses the same connection pool.
+
+    Returns:
+    - StravaClient: The shared client, for settings.STRAVA_API_BASE_URL.
+    """
+
+    return _client(settings.STRAVA_API_BASE_URL.rstrip("/"))
+
+
+@functools.lru_cache(maxsize=None)
+def _client(base_url) -> StravaClient:
+    return StravaClient(api_url=f"{base_url}/api/v3", oauth_url=f"{base_url}/oauth")
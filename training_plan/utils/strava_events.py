@@ -0,0 +1,90 @@
+"""
+Module generating Strava webhook events locally, standing in for Strava in tests and load runs.
+
+The events have the same shape as the ones Strava POSTs to the webhook (see strava_webhook.py).
+
+Functions:
+- make_event(owner_id, object_id, aspect_type="create", object_type="activity", event_time=None, updates=None):
+  Builds one event.
+- generate_events(owner_ids, count, duplicate_rate=0.0, seed=None): Generates a stream of random activity events.
+
+Example:
+python
+client.post("/webhooks/strava", make_event(owner_id=42, object_id=1234), content_type="application/json")
+
+"""
+
+import itertools
+import random
+import time
+
+ASPECT_TYPES = ("create", "update", "delete")
+SUBSCRIPTION_ID = 1  # Strava sends the ID of the subscription with every event
+
+
+def make_event(owner_id, object_id, aspect_type="create", object_type="activity", event_time=None, updates=None):
+    """
+    Build one webhook event.
+
+    Args:
+    - owner_id (int): The Strava athlete ID of the owner of the object.
+    - object_id (int): The ID of the activity, or of the athlete for athlete events.
+    - aspect_type (str, optional): "create", "update" or "delete".
+    - object_type (str, optional): "activity" or "athlete".
+    - event_time (int, optional): Epoch timestamp of the event (defaults to now).
+    - updates (dict, optional): The fields that changed, e.g. {"title": "Morning Run"} or {"authorized": "false"}.
+
+    Returns:
+    - dict: The event.
+    """
+
+    return {
+        "aspect_type": aspect_type,
+        "event_time": event_time or int(time.time()),
+        "object_id": object_id,
+        "object_type": object_type,
+        "owner_id": owner_id,
+        "subscription_id": SUBSCRIPTION_ID,
+        "updates": updates or {},
+    }
+
+
+def generate_events(owner_ids, count, duplicate_rate=0.0, seed=None):
+    """
+    Generate a stream of random activity events: activities are created, then sometimes updated or deleted, and
+    some events are delivered twice like Strava occasionally does.
+
+    Args:
+    - owner_ids (list): The Strava athlete IDs to generate events for.
+    - count (int): The number of events.
+    - duplicate_rate (float, optional): The share of events delivered twice (included in count).
+    - seed (int, optional): Seed of the random generator, for reproducible runs.
+
+    Yields:
+    - dict: The events.
+    """
+
+    rng = random.Random(seed)
+    activity_ids = itertools.count(int(time.time()) * 1000)
+    activities = []  # (owner_id, activity_id) of the activities created so far
+    event_time = int(time.time())
+
+    previous = None
+    for _ in range(count):
+        if previous is not None and rng.random() < duplicate_rate:
+            yield dict(previous)
+            continue
+
+        event_time += 1
+        aspect_type = "create" if not activities else rng.choices(ASPECT_TYPES, weights=(6, 3, 1))[0]
+        if aspect_type == "create":
+            owner_id, activity_id = rng.choice(owner_ids), next(activity_ids)
+            activities.append((owner_id, activity_id))
+        else:
+            owner_id, activity_id = rng.choice(activities)
+            if aspect_type == "delete":
+                activities.remove((owner_id, activity_id))
+
+        updates = {"title": "Updated run"} if aspect_type == "update" else None
+        previous = make_event(owner_id, activity_id, aspect_type, event_time=event_time, updates=updates)
+        yield previous
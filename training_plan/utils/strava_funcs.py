@@ -6,21 +6,44 @@ retrieving Strava runs, unlinking Strava accounts, and refreshing Strava access
 
 Functions:
 - save_profile(user, response, *args, **kwargs): Saves a Strava profile for a user based on the Strava API response.
-- get_strava_run_func(user, todays_run): Retrieves Strava run data for a user and updates the corresponding scheduled run.
+- sync_activities(user): Completes the scheduled runs of a user with the runs they recorded on Strava since the last sync.
+- enqueue_sync(user, now=None): Enqueues a background sync of a user's Strava activities.
+- enqueue_backfill(strava_profile, now=None): Enqueues a background import of a user's Strava history.
+- enqueue_streams(user, completed_run): Enqueues a background import of the streams of an imported run.
+- complete_runs(marathon_plan, activities, days=()): Matches Strava activities to the plan and upserts the completed runs.
+- completed_run_from_activities(activities, scheduled_run): Builds the completed run of one or more Strava activities.
+- import_activity(user, activity_id, aspect_type): Matches the day of one Strava activity again after a webhook event.
 - unlink_strava(username): Unlinks a Strava account from a user.
 - refresh_trava_token(username): Refreshes the Strava access token for a user.
+- get_access_token(user): Gets a valid Strava access token for a user, from the cache when possible.
+- request_token(strava_profile): Exchanges the refresh token of a Strava profile for a new access token.
+- apply_token(strava_profile, token_data): Updates a Strava profile and the token cache with new token data.
+- sync_status(user): Gets the last known state of a user's Strava sync, from the cache when possible.
 
 Note: These functions are designed to work with the Strava API and are intended for use in a Django web application.
+Every call to Strava goes through the shared client in strava_client.py (connection pooling, timeouts and retries),
+inside the circuit breaker of strava_breaker.py.
 """
 
 from decouple import config
-import requests
-from datetime import datetime, timedelta, date
+from datetime import datetime, timedelta, timezone as dt_timezone
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Q
 from django.utils import timezone
 import urllib3
-from ..models import StravaUserProfile, RunnerUser, CompletedRun
+from ..models import StravaUserProfile, RunnerUser, CompletedRun, MarathonPlan
+from . import jobs, plan_store, run_matching, strava_breaker, strava_client
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+SYNC_INTERVAL = timedelta(minutes=15)  # A user's activities are synced at most once per interval
+SYNC_PAGE_SIZE = 30  # Activities fetched per sync
+MAX_PAGE_SIZE = 200  # Most activities Strava returns per page
+IMPORTED_FIELDS = ["date", "distance", "duration", "avg_pace", "strava_activity_id", "strava_activity_ids"]
+TOKEN_FIELDS = ["strava_access_token", "strava_refresh_token", "expires_at"]
+TOKEN_CACHE_MARGIN = timedelta(minutes=5)  # Cached tokens are dropped this long before they expire
+SYNC_STATUS_TTL = timedelta(minutes=10)  # How long the last known sync state of a user is cached
+
 
 def save_profile(user, response, *args, **kwargs):
     """
@@ -51,70 +74,296 @@ def save_profile(user, response, *args, **kwargs):
 
     strava_profile.save()
 
+    # Pull the runs already on Strava since the start of the plan
+    enqueue_backfill(strava_profile)
+
 
-def get_strava_run_func(user, todays_run):
+def sync_activities(user) -> int:
     """
-    Retrieve Strava run data for a user and update the corresponding scheduled run.
+    Pull the runs a user recorded on Strava since the last sync and complete the matching scheduled runs.
+
+    The activities are fetched in the background (see enqueue_sync), so pages render from the database only.
+    The whole day of the last sync is fetched again, so that a second run on that day is aggregated with the first
+    (see complete_runs). The activities are paged through, oldest first, until a page comes back short; each day is
+    completed once all its activities have been fetched. If Strava fails part way, the last sync is moved to the
+    newest activity imported so far, so the next sync resumes from its day.
 
     Args:
-    - user: The user for whom to retrieve Strava run data.
-    - todays_run: The scheduled run corresponding to today's date.
+    - user: The user whose activities to sync.
 
     Raises:
-    - LookupError: If the Strava profile is not found.
+    - LookupError: If the Strava profile or the marathon plan is not found.
+    - StravaError: If Strava can't be reached or the circuit is open (the sync job is then retried).
 
     Returns:
-    None
+    - int: The number of runs completed or updated.
     """
 
     try:
         strava_profile = StravaUserProfile.objects.get(user=user)
-    except StravaUserProfile.DoesNotExist:
-        raise LookupError("Strava profile not found")
-    else:
-        # URLs
-        activites_url = "https://www.strava.com/api/v3/athlete/activities"
+        marathon_plan = MarathonPlan.objects.get(user=user)
+    except (StravaUserProfile.DoesNotExist, MarathonPlan.DoesNotExist):
+        raise LookupError("Strava profile or marathon plan not found")
 
-        access_token = strava_profile.strava_access_token
+    access_token = get_access_token(user)
 
-        # Get the latest n activities
-        n = 5
-        # Need to use the access token for the user you want to get the runs on
-        header = {'Authorization': 'Bearer ' + access_token}
-        param = {'per_page': n, 'page': 1}
-        my_dataset = requests.get(
-            activites_url, headers=header, params=param).json()
-
-        # Get the latest run activity of today's run
-        for activity in my_dataset:
-            date_of_run = activity["start_date"].split("T")[0]
-            date_of_run_formatted = (datetime.strptime(
-                date_of_run, '%Y-%m-%d')).date()
-
-            if (activity["type"] == "Run") and (date_of_run_formatted == date.today()):
-
-                distance = int(activity["distance"] // 1000)
-                duration = int(activity["moving_time"] // 60)
-                # Calculate pace in seconds per kilometer
-                pace_seconds_per_m = activity["moving_time"] / \
-                    activity["distance"]
-                # Convert pace back to minutes and seconds
-                pace_minutes, pace_seconds = divmod(
-                    pace_seconds_per_m * 1000, 60)
-                # Format the result as mm:ss
-                avg_pace = timedelta(minutes=pace_minutes,
-                                     seconds=pace_seconds)
-
-                completed_run = CompletedRun(
-                    scheduled_run=todays_run,
-                    date=date_of_run_formatted,
-                    distance=distance,
-                    duration=duration,
-                    avg_pace=avg_pace
-                )
-                completed_run.save()
+    # Only the activities since the day of the last sync (or the start of the plan)
+    synced_at = timezone.now()
+    if strava_profile.last_synced_at is not None:
+        after = day_start(strava_profile.last_synced_at.astimezone(dt_timezone.utc).date())
+    else:
+        after = day_start(marathon_plan.start_date)
+    client = strava_client.get_client()
+    completed, pending, page, imported_until = 0, [], 1, None
+    try:
+        while True:
+            with strava_breaker.guard():
+                activities = client.get_activities(access_token, per_page=SYNC_PAGE_SIZE, page=page, after=after)
+            pending += activities
+            if len(activities) < SYNC_PAGE_SIZE:
                 break
 
+            # The last day of the page may go on in the next one, so it is completed with it
+            last_day = run_matching.activity_date(pending[-1])
+            ready = [activity for activity in pending if run_matching.activity_date(activity) < last_day]
+            pending = [activity for activity in pending if run_matching.activity_date(activity) >= last_day]
+            if ready:
+                completed += complete_runs(marathon_plan, ready)
+                imported_until = max(datetime.fromisoformat(activity["start_date"].replace("Z", "+00:00"))
+                                     for activity in ready)
+            page += 1
+    except strava_client.StravaError:
+        if imported_until is not None:
+            _save_last_synced_at(strava_profile, imported_until)
+        raise
+
+    completed += complete_runs(marathon_plan, pending)
+    _save_last_synced_at(strava_profile, synced_at)
+
+    return completed
+
+
+def _save_last_synced_at(strava_profile, synced_at):
+    """
+    Save the time of the last sync of a Strava profile, and drop its cached sync state.
+    """
+
+    strava_profile.last_synced_at = synced_at
+    strava_profile.save(update_fields=["last_synced_at"])
+    cache.delete(sync_status_key(strava_profile.user_id))
+
+
+def complete_runs(marathon_plan, activities, days=()):
+    """
+    Match a batch of Strava activities to the scheduled runs of their days (see run_matching.py) and upsert the
+    completed run of every matched day. Runs completed by hand are left as they are.
+
+    Args:
+    - marathon_plan: The plan.
+    - activities (list): Strava activities, as returned by the API.
+    - days (iterable, optional): Days all of whose activities are in the batch: their runs imported from Strava
+      are deleted when no activity matches them any more.
+
+    Returns:
+    - int: The number of runs completed or updated.
+    """
+
+    days = set(days)
+    dates = days | {run_matching.activity_date(activity) for activity in activities if run_matching.is_run(activity)}
+    if not dates:
+        return 0
+
+    scheduled_runs = [run for run in plan_store.get_runs(marathon_plan, min(dates), max(dates)) if run.date in dates]
+    completed_runs = {run.date: run for run in CompletedRun.objects.filter(
+        scheduled_run__marathon_plan=marathon_plan, scheduled_run__date__in=dates)}
+
+    changed = 0
+    for match in run_matching.match_activities(activities, scheduled_runs):
+        completed_run = completed_runs.pop(match.scheduled_run.date, None)
+        if completed_run is not None and completed_run.strava_activity_id is None:
+            continue  # Completed by hand
+
+        imported_run = completed_run_from_activities(match.activities, plan_store.materialize(match.scheduled_run))
+        if completed_run is not None:
+            if all(getattr(completed_run, field) == getattr(imported_run, field) for field in IMPORTED_FIELDS):
+                continue
+            imported_run.pk = completed_run.pk
+        if completed_run is None or completed_run.strava_activity_id != imported_run.strava_activity_id:
+            # The activity may have completed another day before its date changed
+            CompletedRun.objects.filter(strava_activity_id=imported_run.strava_activity_id).exclude(
+                pk=imported_run.pk).delete()
+        imported_run.save()
+        enqueue_streams(marathon_plan.user, imported_run)
+        changed += 1
+
+    # Runs imported from activities that were deleted, moved or are no longer runs
+    CompletedRun.objects.filter(pk__in=[run.pk for run_date, run in completed_runs.items()
+                                        if run_date in days and run.strava_activity_id is not None]).delete()
+
+    return changed
+
+
+def enqueue_sync(user, now=None):
+    """
+    Enqueue a background sync of a user's Strava activities, at most once per SYNC_INTERVAL.
+
+    Args:
+    - user: The user whose activities to sync.
+    - now (datetime, optional): The current time (defaults to now).
+
+    Returns:
+    - Job: The new or existing sync job.
+    """
+
+    now = now or timezone.now()
+    interval = int(now.timestamp() // SYNC_INTERVAL.total_seconds())
+    return jobs.enqueue("strava_sync", f"strava_sync:{user.id}:{interval}", user=user)
+
+
+def enqueue_backfill(strava_profile, now=None):
+    """
+    Enqueue a background import of the runs a user recorded on Strava since the start of their plan
+    (see strava_backfill.py), once per linked Strava profile.
+
+    Args:
+    - strava_profile: The user's new Strava profile.
+    - now (datetime, optional): The end of the backfill (defaults to now).
+
+    Returns:
+    - Job or None: The backfill job, or None if the user has no plan yet.
+    """
+
+    marathon_plan = MarathonPlan.objects.filter(user_id=strava_profile.user_id).first()
+    if marathon_plan is None:
+        return None
+
+    return jobs.enqueue("strava_backfill", f"strava_backfill:{strava_profile.id}", user=strava_profile.user,
+                        payload={"after": day_start(marathon_plan.start_date),
+                                 "before": int((now or timezone.now()).timestamp())})
+
+
+def enqueue_streams(user, completed_run):
+    """
+    Enqueue a background import of the streams of the activities of an imported run, to compute the minutes it
+    spent in each heart rate zone (see activity_streams.py), once per set of activities.
+
+    Args:
+    - user: The runner.
+    - completed_run: The completed run, imported from Strava.
+
+    Returns:
+    - Job: The new or existing job.
+    """
+
+    activity_ids = completed_run.strava_activity_ids
+    return jobs.enqueue("strava_streams", "strava_streams:" + "-".join(map(str, activity_ids))[:180], user=user,
+                        payload={"activity_ids": activity_ids})
+
+
+def completed_run_from_activities(activities, scheduled_run):
+    """
+    Build the (unsaved) completed run of one or more Strava activities of the same day, e.g. a run and its
+    warm-up. Their distances and times are added up.
+
+    Args:
+    - activities (list): The Strava activities, as returned by the API, the main one first.
+    - scheduled_run: The stored scheduled run the activities complete.
+
+    Returns:
+    - CompletedRun: The completed run.
+    """
+
+    total_distance = sum(activity["distance"] for activity in activities)
+    total_time = sum(activity["moving_time"] for activity in activities)
+
+    distance = int(total_distance // 1000)
+    duration = int(total_time // 60)
+    # Calculate pace in seconds per kilometer
+    pace_seconds_per_m = total_time / total_distance
+    # Convert pace back to minutes and seconds
+    pace_minutes, pace_seconds = divmod(
+        pace_seconds_per_m * 1000, 60)
+    # Format the result as mm:ss
+    avg_pace = timedelta(minutes=pace_minutes,
+                         seconds=pace_seconds)
+
+    return CompletedRun(
+        scheduled_run=scheduled_run,
+        date=run_matching.activity_date(activities[0]),
+        distance=distance,
+        duration=duration,
+        avg_pace=avg_pace,
+        strava_activity_id=activities[0].get("id"),
+        strava_activity_ids=[activity["id"] for activity in activities if "id" in activity]
+    )
+
+
+def import_activity(user, activity_id, aspect_type):
+    """
+    Import one Strava activity after a webhook event (see strava_webhook.py).
+
+    The activities of the day of the activity, and of the day it completed before if its date changed or it was
+    deleted, are fetched and matched again (see complete_runs). So the activity is aggregated with the other runs
+    of its day, and its completed run is updated or deleted if it changed, was deleted or is no longer a run.
+
+    Args:
+    - user: The owner of the activity.
+    - activity_id: The ID of the Strava activity.
+    - aspect_type: "create", "update" or "delete".
+
+    Raises:
+    - LookupError: If the Strava profile or the marathon plan is not found.
+    - StravaError: If Strava can't be reached or the circuit is open (the job is then retried).
+
+    Returns:
+    - CompletedRun or None: The completed run the activity is part of, or None if there is none.
+    """
+
+    try:
+        marathon_plan = MarathonPlan.objects.get(user=user)
+    except MarathonPlan.DoesNotExist:
+        raise LookupError("Marathon plan not found")
+
+    days = {run.date for run in imported_runs(marathon_plan, activity_id)}
+    access_token = get_access_token(user)
+    client = strava_client.get_client()
+    if aspect_type != "delete":
+        with strava_breaker.guard():
+            days.add(run_matching.activity_date(client.get_activity(access_token, activity_id)))
+
+    activities = []
+    for day in sorted(days):
+        with strava_breaker.guard():
+            activities += client.get_activities(access_token, per_page=MAX_PAGE_SIZE, after=day_start(day),
+                                                before=day_start(day + timedelta(days=1)))
+    complete_runs(marathon_plan, activities, days)
+    cache.delete(sync_status_key(user.id))
+
+    return next(iter(imported_runs(marathon_plan, activity_id)), None)
+
+
+def imported_runs(marathon_plan, activity_id):
+    """
+    Get the completed runs of a plan that a Strava activity is part of (at most one, unless it is being moved),
+    filtered in the database so the cost doesn't grow with the runner's history.
+    """
+
+    runs = CompletedRun.objects.filter(scheduled_run__marathon_plan=marathon_plan)
+    if connection.features.supports_json_field_contains:
+        return list(runs.filter(Q(strava_activity_id=activity_id) | Q(strava_activity_ids__contains=[activity_id])))
+
+    # Without JSON containment (SQLite), only the runs aggregated from several activities are checked in Python
+    return [run for run in runs.filter(Q(strava_activity_id=activity_id) | Q(strava_activity_ids__1__isnull=False))
+            if activity_id in run.strava_activity_ids]
+
+
+def day_start(day):
+    """
+    Get the epoch timestamp of the start of a day, in UTC like the start dates of Strava activities.
+    """
+
+    return int(datetime.combine(day, datetime.min.time(), tzinfo=dt_timezone.utc).timestamp())
+
 
 def unlink_strava(username):
     """
@@ -132,6 +381,7 @@ def unlink_strava(username):
         strava_profile = StravaUserProfile.objects.get(user=user)
         if strava_profile:
             strava_profile.delete()
+            cache.delete_many([token_cache_key(user.id), sync_status_key(user.id)])
 
     except Exception as e:
         print(f"No user account found: {e}")
@@ -139,7 +389,7 @@ def unlink_strava(username):
 
 def refresh_trava_token(username):
     """
-    Refresh the Strava access token for a user.
+    Refresh the Strava access token for a user, if it has expired.
 
     Args:
     - username: The username of the user whose token needs to be refreshed.
@@ -148,49 +398,132 @@ def refresh_trava_token(username):
     - LookupError: If the Strava profile is not found.
 
     Returns:
-    None
+    - StravaUserProfile: The user's Strava profile, with a valid token unless the refresh failed.
     """
 
     try:
-        user = RunnerUser.objects.get(username=username)
-        strava_profile = StravaUserProfile.objects.get(user=user)
-    except Exception as e:
+        strava_profile = StravaUserProfile.objects.get(user__username=username)
+    except StravaUserProfile.DoesNotExist as e:
         raise LookupError("Strava profile not found", e)
-    else:
 
-        # Your Strava API credentials
-        client_id = config("STRAVA_CLIENT_ID")
-        client_secret = config("STRAVA_CLIENT_SECRET")
-
-        # Check if the access token has expired
-        if strava_profile.expires_at <= timezone.now():
-            # Access token has expired, refresh it using the refresh token
-            refresh_token = strava_profile.strava_refresh_token
-            token_url = 'https://www.strava.com/oauth/token'
-
-            # Prepare the data for the POST request
-            data = {
-                'client_id': client_id,
-                'client_secret': client_secret,
-                'grant_type': 'refresh_token',
-                'refresh_token': refresh_token,
-            }
-
-            # Make the POST request to refresh the token
-            response = requests.post(token_url, data=data)
-
-            if response.status_code == 200:
-                # Update the model with the new access token and refresh token
-                token_data = response.json()
-                strava_profile.strava_access_token = token_data['access_token']
-                strava_profile.strava_refresh_token = token_data['refresh_token']
-                expires_in = token_data['expires_in']
-                strava_profile.expires_at = timezone.now() + timedelta(seconds=expires_in)
-                strava_profile.save()
-            else:
-                # Handle the error, e.g., log it or raise an exception
-                print(
-                    f"Token refresh failed with status code {response.status_code}")
+    # Check if the access token has expired
+    if strava_profile.expires_at <= timezone.now():
+        # Access token has expired, refresh it using the refresh token
+        try:
+            token_data = request_token(strava_profile)
+        except strava_client.StravaError as e:
+            # Handle the error, e.g., log it or raise an exception
+            print(f"Token refresh failed: {e}")
         else:
-            # Access token is still valid, no need to refresh
-            print("Strava access token still valid")
+            apply_token(strava_profile, token_data)
+            strava_profile.save(update_fields=TOKEN_FIELDS)
+
+    return strava_profile
+
+
+def get_access_token(user):
+    """
+    Get a valid Strava access token for a user, from the cache when possible.
+
+    Tokens are refreshed ahead of expiry by `manage.py refresh_strava_tokens`, so this only refreshes a token
+    itself if the scheduler has fallen behind.
+
+    Args:
+    - user: The user.
+
+    Raises:
+    - LookupError: If the Strava profile is not found.
+
+    Returns:
+    - str: The access token.
+    """
+
+    access_token = cache.get(token_cache_key(user.id))
+    if access_token is None:
+        strava_profile = refresh_trava_token(user.username)
+        access_token = strava_profile.strava_access_token
+        cache_token(strava_profile)
+    return access_token
+
+
+def request_token(strava_profile):
+    """
+    Exchange the refresh token of a Strava profile for a new access token, without saving it.
+
+    Args:
+    - strava_profile: The Strava profile.
+
+    Raises:
+    - StravaError: If the refresh fails or the circuit is open.
+
+    Returns:
+    - dict: The token data sent by Strava.
+    """
+
+    # Your Strava API credentials
+    client_id = config("STRAVA_CLIENT_ID")
+    client_secret = config("STRAVA_CLIENT_SECRET")
+
+    with strava_breaker.guard():
+        return strava_client.get_client().refresh_token(client_id, client_secret, strava_profile.strava_refresh_token)
+
+
+def apply_token(strava_profile, token_data):
+    """
+    Update a Strava profile (without saving it) and the token cache with new token data.
+
+    Args:
+    - strava_profile: The Strava profile.
+    - token_data: The token data sent by Strava.
+    """
+
+    # Update the model with the new access token and refresh token
+    strava_profile.strava_access_token = token_data['access_token']
+    strava_profile.strava_refresh_token = token_data['refresh_token']
+    expires_in = token_data['expires_in']
+    strava_profile.expires_at = timezone.now() + timedelta(seconds=expires_in)
+    cache_token(strava_profile)
+
+
+def cache_token(strava_profile):
+    """
+    Cache the access token of a Strava profile until shortly before it expires.
+    """
+
+    timeout = (strava_profile.expires_at - timezone.now() - TOKEN_CACHE_MARGIN).total_seconds()
+    if timeout > 0:
+        cache.set(token_cache_key(strava_profile.user_id), strava_profile.strava_access_token, timeout)
+
+
+def token_cache_key(user_id):
+    return f"strava_token:{user_id}"
+
+
+def sync_status(user):
+    """
+    Get the last known state of a user's Strava sync, from a short-lived cache when possible, so it can be shown
+    without calling Strava, including while the circuit to Strava is open.
+
+    Args:
+    - user: The user.
+
+    Returns:
+    - dict: When the user was "last_synced_at", their "latest_run" imported from Strava (its date, distance and
+      duration, or None), and whether Strava is "available" (the circuit isn't open).
+    """
+
+    status = cache.get(sync_status_key(user.id))
+    if status is None:
+        status = {
+            "last_synced_at": StravaUserProfile.objects.filter(user=user).values_list(
+                "last_synced_at", flat=True).first(),
+            "latest_run": CompletedRun.objects.filter(
+                scheduled_run__marathon_plan__user=user, strava_activity_id__isnull=False).order_by(
+                "-date").values("date", "distance", "duration").first(),
+        }
+        cache.set(sync_status_key(user.id), status, SYNC_STATUS_TTL.total_seconds())
+    return {**status, "available": strava_breaker.state() != strava_breaker.OPEN}
+
+
+def sync_status_key(user_id):
+    return f"strava_sync_status:{user_id}"
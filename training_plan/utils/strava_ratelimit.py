@@ -0,0 +1,164 @@
+"""
+Module implementing the governor of the Strava API rate limits, shared by every process of the app.
+
+Strava limits the requests of the whole app over two windows: every 15 minutes (starting on the hour, at 15, 30
+and 45 past) and every day (starting at midnight UTC). Each window is a bucket of tokens, refilled when the window
+starts again, and its counter is kept in the Django cache, so the web processes and the job workers draw from the
+same budget. In production, use a cache shared by the processes whose incr() is atomic, i.e. Redis or Memcached:
+the database and file caches read and write the counter in two steps, so concurrent calls may take the same token.
+
+Every call to Strava acquires a token from both windows before it is made (see strava_client.py). The counters
+are brought in line with the X-RateLimit-Limit and X-RateLimit-Usage headers of every response, which give the
+limits and the usage of the two windows as Strava counts them. Once Strava reports a window as used up, calls are
+refused until it starts again.
+
+Interactive calls, made while a runner waits for a page, come first: background calls (syncs, webhook imports,
+backfills, token refreshes) may only use the STRAVA_BACKGROUND_SHARE setting of each window, so the rest is kept for
+interactive calls. Code running in the background marks its calls with the background() context manager.
+
+Current usage is exported as the strava.ratelimit.used and strava.ratelimit.limit gauges (see metrics.py).
+
+Functions:
+- background(): Context manager marking the Strava calls made in its block as background calls.
+- acquire(priority=None, now=None): Takes a token from both windows, or says how long to wait.
+- record(headers, now=None): Brings the counters in line with the rate limit headers of a response.
+- budget(now=None): Gets the usage and limit of both windows.
+
+Example:
+python
+with strava_ratelimit.background():
+    wait = strava_ratelimit.acquire()
+if wait is not None:
+    print(f"Rate limited for {wait:.0f} s")
+
+"""
+
+import contextvars
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+
+from . import metrics
+
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+
+WINDOWS = {"15min": 15 * 60, "daily": 24 * 60 * 60}  # Length of each window, in seconds, in the headers' order
+
+_priority = contextvars.ContextVar("strava_priority", default=INTERACTIVE)
+
+
+@contextmanager
+def background():
+    """
+    Mark the Strava calls made in the block as background calls.
+    """
+
+    token = _priority.set(BACKGROUND)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def acquire(priority=None, now=None):
+    """
+    Take a token from both windows if the priority allows it.
+
+    Args:
+    - priority (str, optional): INTERACTIVE or BACKGROUND (defaults to the priority of the current block).
+    - now (float, optional): Epoch timestamp (defaults to now).
+
+    Returns:
+    - float or None: None if a token was taken, or the seconds until the exhausted window starts again.
+    """
+
+    priority = priority or _priority.get()
+    now = now or time.time()
+    share = 1 if priority == INTERACTIVE else settings.STRAVA_BACKGROUND_SHARE
+
+    taken, wait = [], None
+    for name, seconds in WINDOWS.items():
+        key = _key(name, now)
+        cache.add(key, 0, seconds + 60)
+        taken.append(key)
+        if cache.incr(key) > int(_limit(name) * share):
+            wait = seconds - now % seconds
+            break
+
+    if wait is not None:
+        # Give back the tokens taken, so a refused call doesn't use up the budget
+        for key in taken:
+            cache.decr(key)
+        metrics.increment("strava.ratelimit.refused", priority=priority)
+
+    _export(now)
+    return wait
+
+
+def record(headers, now=None) -> None:
+    """
+    Bring the counters in line with the X-RateLimit-Limit and X-RateLimit-Usage headers of a response, e.g.
+    "200,2000" and "57,850" for the 15-minute and daily windows.
+
+    Args:
+    - headers (dict): The headers of the response.
+    - now (float, optional): Epoch timestamp (defaults to now).
+    """
+
+    now = now or time.time()
+    limits = _parse(headers.get("X-RateLimit-Limit"))
+    usage = _parse(headers.get("X-RateLimit-Usage"))
+
+    for (name, seconds), limit, used in zip(WINDOWS.items(), limits or [None] * 2, usage or [None] * 2):
+        if limit is not None:
+            cache.set(_limit_key(name), limit, None)
+        # Strava's count only replaces ours when it is higher, as other processes may have calls in flight
+        if used is not None and used > cache.get(_key(name, now), 0):
+            cache.set(_key(name, now), used, seconds + 60)
+
+    _export(now)
+
+
+def budget(now=None) -> dict:
+    """
+    Get the usage of both windows.
+
+    Args:
+    - now (float, optional): Epoch timestamp (defaults to now).
+
+    Returns:
+    - dict: The "used" tokens, the "limit" and the seconds until it "resets_in", by window.
+    """
+
+    now = now or time.time()
+    return {name: {"used": cache.get(_key(name, now), 0), "limit": _limit(name),
+                   "resets_in": seconds - now % seconds} for name, seconds in WINDOWS.items()}
+
+
+def _export(now) -> None:
+    for name, window in budget(now).items():
+        metrics.gauge("strava.ratelimit.used", window["used"], window=name)
+        metrics.gauge("strava.ratelimit.limit", window["limit"], window=name)
+
+
+def _limit(name) -> int:
+    default = settings.STRAVA_RATE_LIMIT_15MIN if name == "15min" else settings.STRAVA_RATE_LIMIT_DAILY
+    return cache.get(_limit_key(name), default)
+
+
+def _key(name, now) -> str:
+    return f"strava_ratelimit:{name}:{int(now // WINDOWS[name])}"
+
+
+def _limit_key(name) -> str:
+    return f"strava_ratelimit:{name}:limit"
+
+
+def _parse(header):
+    try:
+        return [int(value) for value in header.split(",")][:2]
+    except (AttributeError, ValueError):
+        return None
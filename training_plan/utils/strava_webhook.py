@@ -0,0 +1,95 @@
+"""
+Module implementing the Strava webhook (push subscription), so activities are imported as soon as they are
+uploaded instead of by polling.
+
+Strava validates the subscription with a GET handshake, echoing hub.challenge when hub.verify_token matches
+settings.STRAVA_WEBHOOK_VERIFY_TOKEN. Events are then POSTed for every activity created, updated or deleted, and
+when an athlete deauthorizes the app. Strava expects an answer within 2 seconds and may deliver an event more than
+once, so receiving an event only stores it (keyed by its content, see StravaWebhookEvent) and enqueues a job; the
+job fetches only the affected activity and upserts or deletes the matching CompletedRun (see
+strava_funcs.import_activity).
+
+Functions:
+- validate_subscription(params): Answers the subscription validation handshake.
+- receive_event(event): Stores an event and enqueues its processing, once per event.
+- event_key(event): Gets the unique key of an event.
+
+Example:
+python
+challenge = validate_subscription(request.GET)
+job = receive_event(json.loads(request.body))
+
+"""
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+
+from ..models import StravaUserProfile, StravaWebhookEvent
+from . import jobs
+
+
+def validate_subscription(params):
+    """
+    Answer the subscription validation handshake.
+
+    Args:
+    - params (dict): The query parameters of the GET request.
+
+    Returns:
+    - str or None: The challenge to echo, or None if the request isn't a valid handshake.
+    """
+
+    verify_token = getattr(settings, "STRAVA_WEBHOOK_VERIFY_TOKEN", "")
+    if params.get("hub.mode") != "subscribe" or not verify_token or params.get("hub.verify_token") != verify_token:
+        return None
+    return params.get("hub.challenge")
+
+
+def receive_event(event):
+    """
+    Store an event and enqueue its processing, unless the event has already been received.
+
+    Args:
+    - event (dict): The event as sent by Strava.
+
+    Raises:
+    - KeyError: If the event is missing a field.
+
+    Returns:
+    - Job or None: The job processing the event, or None if the event is a duplicate or isn't for a linked user.
+    """
+
+    try:
+        with transaction.atomic():
+            stored_event = StravaWebhookEvent.objects.create(
+                event_key=event_key(event), owner_id=event["owner_id"], payload=event)
+    except IntegrityError:
+        return None  # Already received
+
+    strava_profile = StravaUserProfile.objects.filter(client_id=event["owner_id"]).select_related("user").first()
+    if strava_profile is None:
+        return None
+
+    if event["object_type"] == "athlete":
+        if event.get("updates", {}).get("authorized") == "false":
+            return jobs.enqueue("strava_deauthorize", f"strava_event:{stored_event.id}", user=strava_profile.user)
+        return None
+
+    return jobs.enqueue("strava_activity", f"strava_event:{stored_event.id}", user=strava_profile.user, payload={
+        "activity_id": event["object_id"],
+        "aspect_type": event["aspect_type"],
+    })
+
+
+def event_key(event):
+    """
+    Get the unique key of an event: the same event delivered twice has the same key.
+
+    Args:
+    - event (dict): The event as sent by Strava.
+
+    Returns:
+    - str: The key.
+    """
+
+    return f"{event['object_type']}:{event['object_id']}:{event['aspect_type']}:{event['event_time']}"
@@ -8,19 +8,21 @@ Note: For brevity, the docstrings for the helper functions are kept concise.
 """
 
 import json
-from django.core import serializers
 from datetime import date, datetime, timedelta
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import authenticate, login
-from django.http import HttpResponseRedirect, JsonResponse
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from django.http import HttpResponse, HttpResponseRedirect, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render
 from django.urls import reverse
-from django.views.decorators.http import require_POST
-from django.views.decorators.csrf import csrf_protect
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition, require_POST
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
 
-from .utils import plan_algo, strava_funcs
-from .models import RunnerUser, MarathonPlan, ScheduledRun, CompletedRun, StravaUserProfile
-from .forms import MergedSignUpForm
+from .utils import dashboard, jobs, plan_store, plan_version, strava_funcs, strava_webhook
+from .models import ScheduledRun, CompletedRun, Job
+from .forms import MergedSignUpForm, PlanSettingsForm
 
 
 @login_required
@@ -44,7 +46,9 @@ def remove_strava_account(request):
 @login_required
 def settings(request):
     """
-    Renders the settings page for the currently authenticated user, displaying Strava user information if linked.
+    Renders the settings page for the currently authenticated user, displaying Strava user information if linked
+    and the settings of their plan. The state of the Strava sync is the last known one, so the page renders without
+    calling Strava.
 
     Args:
     - request: The HTTP request object.
@@ -53,28 +57,52 @@ def settings(request):
     - render: Renders the settings page with Strava user information.
     """
 
-    strava_user = None
+    strava_user = strava_status = plan_form = None
 
     if request.user.is_authenticated:
-        username = request.user.username
-        try:
-            user = RunnerUser.objects.get(username=username)
-        except Exception as e:
-            print(e)
-            return HttpResponseRedirect(reverse("index"))
-        else:
+        # The runner's Strava profile is read once per request (see utils/runner_context.py)
+        strava_user = request.runner.strava_profile
+        if strava_user is not None:
             try:
-                strava_user = StravaUserProfile.objects.get(user=user)
+                strava_status = strava_funcs.sync_status(request.user)
             except Exception as e:
                 print(e)
 
-            return render(request, "training_plan/settings.html", {
-                "strava_user": strava_user
-            })
+        if request.runner.plan is not None:
+            plan_form = PlanSettingsForm(instance=request.runner.plan)
+
+        return render(request, "training_plan/settings.html", {
+            "strava_user": strava_user,
+            "strava_status": strava_status,
+            "plan_form": plan_form
+        })
     else:
         return HttpResponseRedirect(reverse("settings"))
 
 
+@login_required
+@require_POST
+def update_plan_settings(request):
+    """
+    Saves the settings of the currently authenticated user's plan, e.g. whether it adapts to their completed runs.
+
+    Args:
+    - request: The HTTP request object.
+
+    Returns:
+    - HttpResponseRedirect: Redirects the user to the settings page.
+    """
+
+    if request.runner.plan is not None:
+        form = PlanSettingsForm(request.POST, instance=request.runner.plan)
+        if form.is_valid():
+            form.save()
+        else:
+            print(form.errors)
+
+    return HttpResponseRedirect(reverse("settings"))
+
+
 @login_required
 def scheduled_runs(request):
     """
@@ -107,6 +135,7 @@ def completed_runs(request):
 def index(request):
     """
     Renders the index page with information about the user's marathon plan and today's scheduled run.
+    The page and its JavaScript (see get_dashboard) share the same dashboard, read in at most two queries.
 
     Args:
     - request: The HTTP request object.
@@ -114,58 +143,25 @@ def index(request):
     Returns:
     - render: Renders the index page with relevant information.
     """
-    marathon_plan = days_to_go = todays_run = next_runs = today = None
+    board = plan_job = None
 
     if request.user.is_authenticated:
-        username = request.user.username
-
-        try:
-            user = RunnerUser.objects.get(username=username)
-            # Get the actual plan from the query set
-            marathon_plan = MarathonPlan.objects.get(user=user)
-            if marathon_plan:
-                # Calculate the days until the marathon
-                today = date.today()  # + timedelta(days = 344)
-                days_to_go = (marathon_plan.end_date - today).days
-
-                # Send user to create a new plan
-                if days_to_go <= -1:
-                    pass
-                    # TODO - return render a template to the user to get them to create a new plan
-                try:
-                    todays_run = ScheduledRun.objects.get(
-                        marathon_plan=marathon_plan, date=today)
-
-                    # Get the strava run and profile if there is one and update the run
-                    try:
-                        get_strava_run(username, user, marathon_plan)
-                    except LookupError:
-                        pass
-
-                except ScheduledRun.DoesNotExist:
-                    # If there is no run scheduled then it means that the plan hasn't started yet
-                    todays_run = None
-                try:
-                    next_runs = ScheduledRun.objects.filter(
-                        marathon_plan=marathon_plan, date__gte=today).order_by('date')[1:4]
-                except IndexError:
-                    # If there is no run scheduled then it means that the plan hasn't started yet
-                    next_runs = None
-
-            else:
-                # No marathon plan found for the specified user
-                print(f"No marathon plan found for user {username}")
-
-        except RunnerUser.DoesNotExist:
-            # User with the specified username does not exist
-            print(f"User with username {username} does not exist.")
+        # Strava runs are synced in the background (see strava_funcs.sync_activities)
+        board = dashboard.get_dashboard(request.runner.plan)
+        if board is None:
+            # The plan may still be being prepared by a background worker
+            plan_job = Job.objects.filter(user=request.user, kind="create_plan").first()
+        elif board.days_to_go <= -1:
+            pass
+            # TODO - return render a template to the user to get them to create a new plan
 
     return render(request, "training_plan/index.html", {
-        "plan": marathon_plan,
-        "today": today,
-        "days_to_go": days_to_go,
-        "todays_run": todays_run,
-        "next_runs": next_runs,
+        "plan": board and board.plan,
+        "plan_job": plan_job,
+        "today": board and board.today,
+        "days_to_go": board and board.days_to_go,
+        "todays_run": board and board.todays_run,
+        "next_runs": board and board.next_runs,
         "greeting": calc_greeting()
     })
 
@@ -178,7 +174,8 @@ def register(request):
     - request: The HTTP request object.
 
     Returns:
-    - HttpResponseRedirect: Redirects the user to the index page after successful registration.
+    - HttpResponseRedirect: Redirects the user to the index page after successful registration, while the plan
+      is being prepared.
     """
 
     if request.method == "POST":
@@ -186,20 +183,8 @@ def register(request):
         if form.is_valid():
             user = form.save()
 
-            plan = plan_algo.NewMarathonPlan(
-                user)  # Create Marathon plan object
-
-            # Create new plan
-            success, user_plan = plan.create_plan()
-
-            # If there is an error in the marathon date
-            if not success:
-                return render(request, "trainin_plan/error.html", {
-                    "error_msg": user_plan
-                }, status=422)
-
-            # Schedule the runs
-            plan.create_runs_in_plan()
+            # The plan is generated by a background worker so registration returns straight away
+            jobs.enqueue("create_plan", f"create_plan:{user.id}", user=user)
 
             # To log the user in after registration
             username = request.POST['username']
@@ -247,79 +232,165 @@ def calc_greeting():
     return time_of_day
 
 
+def _stream_completed_runs(rows, limit):
+    """
+    Serialize completed runs (from CompletedRun.objects.values()) as a JSON document, one run at a time.
+    """
+
+    encoder = DjangoJSONEncoder()
+    yield '{"all_completed_runs": ['
+    count, last = 0, None
+    for row in rows:
+        if limit is not None and count == limit:
+            break
+        yield ("," if count else "") + encoder.encode({
+            "completed_run": {
+                "id": row["id"],
+                "date": row["date"],
+                "distance": row["distance"],
+                "duration": row["duration"],
+                "avg_pace": row["avg_pace"],
+                "zone_minutes": row["zone_minutes"]
+            },
+            "scheduled_run": {
+                "dict_id": row["scheduled_run__dict_id"],
+                "run": row["scheduled_run__run"]
+            }
+        })
+        count, last = count + 1, row
+    else:
+        last = None  # Every run was read, so there is no next page
+
+    next_cursor = _encode_cursor((last["date"], last["id"])) if last is not None else None
+    yield '], "next_cursor": ' + encoder.encode(next_cursor) + "}"
+
+
+def _parse_date(value):
+    return date.fromisoformat(value) if value else None
+
+
+def _encode_cursor(after):
+    """
+    Encode the (date, id) a page ends on as the cursor of the next page, e.g. "2024-05-01.123".
+    """
+
+    if after is None:
+        return None
+    return f"{after[0].isoformat()}.{after[1] or ''}"
+
+
+def _decode_cursor(cursor):
+    """
+    Decode a cursor back into the (date, id) of the last run of the previous page.
+
+    Raises:
+    - ValueError: If the cursor is invalid.
+    """
+
+    if not cursor:
+        return None
+    day, _, run_id = cursor.partition(".")
+    try:
+        return date.fromisoformat(day), int(run_id) if run_id else None
+    except ValueError:
+        raise ValueError(f"Invalid cursor: {cursor}")
+
+
+def _runs_etag(request, *args, **kwargs):
+    """
+    Get the ETag of the run APIs from the version of the runner's plan (see utils/plan_version.py), so requests
+    with a matching If-None-Match are answered 304 Not Modified without the runs being read.
+    """
+
+    return plan_version.etag(request.runner.plan)
+
+
 @login_required
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=_runs_etag)
 def get_scheduled_runs(request):
     """
-    Retrieves the scheduled runs for the currently authenticated user.
+    Retrieves a page of the scheduled runs for the currently authenticated user, from tomorrow by default.
+
+    Query parameters:
+    - from, to (YYYY-MM-DD, optional): The first and last dates of the runs.
+    - cursor (optional): The next_cursor of the previous page.
+    - limit (optional): The number of runs in the page (see plan_store.PAGE_SIZE and MAX_PAGE_SIZE).
 
     Args:
     - request: The HTTP request object.
 
     Returns:
-    - JsonResponse: JSON response containing information about scheduled runs.
+    - JsonResponse: JSON response containing information about scheduled runs, and the cursor of the next page
+      (null on the last page).
     """
 
-    username = request.user.username
-
-    user = RunnerUser.objects.get(username=username)
-    marathon_plan = MarathonPlan.objects.get(user=user)
-    all_scheduled_runs = None
+    try:
+        start = _parse_date(request.GET.get("from")) or date.today() + timedelta(days=1)
+        end = _parse_date(request.GET.get("to"))
+        after = _decode_cursor(request.GET.get("cursor"))
+        limit = int(request.GET.get("limit", plan_store.PAGE_SIZE))
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
+    marathon_plan = request.runner.plan
+    all_scheduled_runs = next_cursor = None
     if marathon_plan:
+        runs, next_after = plan_store.get_runs_page(marathon_plan, start=start, end=end, after=after, limit=limit)
+        all_scheduled_runs = [plan_store.run_values(run) for run in runs]
+        next_cursor = _encode_cursor(next_after)
 
-        try:
-            all_scheduled_runs = list(ScheduledRun.objects.filter(
-                marathon_plan=marathon_plan, date__gt=date.today()).order_by("date").values())
-
-        except ScheduledRun.DoesNotExist:
-            all_scheduled_runs = None
-
-    return JsonResponse({"all_scheduled_runs": all_scheduled_runs})
+    return JsonResponse({"all_scheduled_runs": all_scheduled_runs, "next_cursor": next_cursor})
 
 
 @login_required
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=_runs_etag)
 def get_completed_runs(request):
     """
-    Retrieves the completed runs for the currently authenticated user.
+    Retrieves the completed runs for the currently authenticated user, most recent first. The runs and the fields
+    of their scheduled runs are read in one joined query and streamed, so memory stays constant for long histories.
+
+    Query parameters:
+    - from, to (YYYY-MM-DD, optional): The first and last dates of the runs (to defaults to today).
+    - cursor (optional): The next_cursor of the previous page.
+    - limit (optional): The number of runs in the page, at most plan_store.MAX_PAGE_SIZE (all of them if omitted).
 
     Args:
     - request: The HTTP request object.
 
     Returns:
-    - JsonResponse: JSON response containing information about completed runs.
+    - StreamingHttpResponse: JSON response containing information about completed runs, and the cursor of the
+      next page (null on the last page).
     """
 
-    username = request.user.username
-
-    user = RunnerUser.objects.get(username=username)
-    marathon_plan = MarathonPlan.objects.get(user=user)
-    all_completed_runs = None
-
-    if marathon_plan:
-        try:
-            # Get all completed runs for the logged-in user
-            completed_runs = CompletedRun.objects.filter(
-                scheduled_run__marathon_plan=marathon_plan, date__lte=date.today()).order_by("-date")
-
-            # Create a list of dictionaries with required information
-            all_completed_runs = [
-                {
-                    "completed_run": {
-                        "date": run.date,
-                        "distance": run.distance,
-                        "duration": run.duration,
-                        "avg_pace": run.avg_pace
-                    },
-                    "scheduled_run": {
-                        "dict_id": run.scheduled_run.dict_id,
-                        "run": run.scheduled_run.run
-                    }
-                }
-                for run in completed_runs
-            ]
-        except CompletedRun.DoesNotExist:
-            all_completed_runs = None
-
-    return JsonResponse({"all_completed_runs": all_completed_runs})
+    try:
+        start = _parse_date(request.GET.get("from"))
+        end = _parse_date(request.GET.get("to")) or date.today()
+        before = _decode_cursor(request.GET.get("cursor"))
+        limit = request.GET.get("limit")
+        limit = max(1, min(int(limit), plan_store.MAX_PAGE_SIZE)) if limit else None
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
+    marathon_plan = request.runner.plan
+    if not marathon_plan:
+        return JsonResponse({"all_completed_runs": None, "next_cursor": None})
+
+    completed_runs = CompletedRun.objects.filter(scheduled_run__marathon_plan=marathon_plan, date__lte=end)
+    if start is not None:
+        completed_runs = completed_runs.filter(date__gte=start)
+    if before is not None:
+        completed_runs = completed_runs.filter(Q(date__lt=before[0]) | Q(date=before[0], id__lt=before[1] or 0))
+    completed_runs = completed_runs.order_by("-date", "-id").values(
+        "id", "date", "distance", "duration", "avg_pace", "zone_minutes", "scheduled_run__dict_id",
+        "scheduled_run__run")
+    if limit is not None:
+        # One run more than the page is read to know whether there is a next page
+        completed_runs = completed_runs[:limit + 1]
+
+    return StreamingHttpResponse(_stream_completed_runs(completed_runs.iterator(), limit),
+                                 content_type="application/json")
 
 
 @login_required
@@ -341,9 +412,6 @@ def update_completed_run(request):
         payload = data.get("payload")
 
         if request.user.is_authenticated:
-            username = request.user.username
-            user = RunnerUser.objects.get(username=username)
-
             stats_dict = payload.copy()
 
             # Converting the pace into the correct format for the model
@@ -361,7 +429,12 @@ def update_completed_run(request):
             stats_dict["avg_pace"] = stats_dict["pace"]
             stats_dict.pop("pace")
 
-            scheduled_run = ScheduledRun.objects.get(id=payload["run_id"])
+            if payload["run_id"] is None:
+                # Runs of virtual plans are only stored once they have been completed
+                scheduled_run = plan_store.materialize(
+                    plan_store.get_run(request.runner.plan, stats_dict["date"].date()))
+            else:
+                scheduled_run = ScheduledRun.objects.get(id=payload["run_id"])
 
             # Check first if there isn"t a completed run, if so make one, if not then update the values
             completed_run, created = CompletedRun.objects.get_or_create(
@@ -383,9 +456,35 @@ def update_completed_run(request):
 
 
 @login_required
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=_runs_etag)
+def get_dashboard(request):
+    """
+    Retrieves the dashboard of the currently authenticated user: the plan countdown, today's run and whether it
+    has been completed, and the next runs, in at most two queries.
+
+    Args:
+    - request: The HTTP request object.
+
+    Returns:
+    - JsonResponse: JSON response containing the dashboard, or null while the plan is being prepared.
+    """
+
+    board = dashboard.get_dashboard(request.runner.plan)
+    if board is None:
+        # The plan is still being prepared
+        return JsonResponse(None, safe=False)
+
+    return JsonResponse(dashboard.dashboard_values(board))
+
+
+@login_required
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=_runs_etag)
 def get_todays_run(request):
     """
     Retrieves information about today's scheduled run for the currently authenticated user.
+    Kept for older clients; the index page uses get_dashboard.
 
     Args:
     - request: The HTTP request object.
@@ -394,76 +493,67 @@ def get_todays_run(request):
     - JsonResponse: JSON response containing information about today's scheduled run.
     """
 
-    if request.user.is_authenticated:
-        today = date.today()  # + timedelta(days = 339)
+    board = dashboard.get_dashboard(request.runner.plan, next_count=0)
+    if board is None:
+        # The plan is still being prepared
+        return JsonResponse(None, safe=False)
 
-        username = request.user.username
-        user = RunnerUser.objects.get(username=username)
-        marathon_plan = MarathonPlan.objects.get(user=user)
+    return JsonResponse(dashboard.todays_run_values(board), safe=False)
 
-        try:
-            scheduled_run = ScheduledRun.objects.get(
-                marathon_plan=marathon_plan, date=today)
-        except ScheduledRun.DoesNotExist:
-            scheduled_run = None
-            return JsonResponse(scheduled_run, safe=False)
 
-        else:
-            try:
-                todays_run = CompletedRun.objects.get(
-                    date=today, scheduled_run=scheduled_run)
-                completed = True
-            except CompletedRun.DoesNotExist:
-                todays_run = scheduled_run
-                completed = False
-
-            try:
-                serialized_data = serializers.serialize("python", [todays_run])
+@login_required
+def get_job_status(request, job_id):
+    """
+    Retrieves the status of a background job of the currently authenticated user.
 
-                response_data = serialized_data[0]["fields"]
-                # Add 'run_id' to the response_data dictionary
-                response_data['run_id'] = serialized_data[0]['pk']
-                # Add completed to easily identify if working with the scheduled or completed run
-                response_data['completed'] = completed
+    Args:
+    - request: The HTTP request object.
+    - job_id: The id of the job.
 
-                return JsonResponse(response_data, safe=False)
+    Returns:
+    - JsonResponse: JSON response containing the kind and status of the job.
+    """
 
-            except Exception as e:
-                return JsonResponse({"error": str(e)}, status=500)
-    else:
-        return HttpResponseRedirect(reverse("index"))
+    try:
+        job = Job.objects.get(id=job_id, user=request.user)
+    except Job.DoesNotExist:
+        return JsonResponse({"error": "Job not found"}, status=404)
+
+    return JsonResponse({
+        "id": job.id,
+        "kind": job.kind,
+        "status": job.status,
+        "attempts": job.attempts,
+        "error": job.last_error if job.status == Job.FAILED else None,
+    })
 
 
-def get_strava_run(username, user, marathon_plan):
+@csrf_exempt
+def strava_webhook_view(request):
     """
-    Retrieves and updates Strava run data for today's scheduled run.
+    Receives the Strava webhook: answers the subscription validation handshake (GET) and receives the activity and
+    athlete events (POST). Events are only stored and enqueued, so Strava gets its answer straight away.
 
     Args:
-    - username: The username of the currently authenticated user.
-    - user: The RunnerUser object representing the currently authenticated user.
-    - marathon_plan: The MarathonPlan object for the user's marathon plan.
+    - request: The HTTP request object.
 
     Returns:
-    - HttpResponseRedirect: Redirects the user to the index page after updating Strava run data.
+    - JsonResponse: The challenge for a handshake, or an acknowledgement for an event.
     """
 
-    try:
-        strava_funcs.refresh_trava_token(username)
-    except LookupError:
-        raise LookupError('No Strava User found')
+    if request.method == "GET":
+        challenge = strava_webhook.validate_subscription(request.GET)
+        if challenge is None:
+            return JsonResponse({"error": "Invalid subscription request"}, status=403)
+        return JsonResponse({"hub.challenge": challenge})
 
-    todays_run = ScheduledRun.objects.get(
-        marathon_plan=marathon_plan, date=date.today())
+    if request.method != "POST":
+        return HttpResponse(status=405)
 
     try:
-        completed_run = CompletedRun.objects.get(scheduled_run=todays_run)
-    except Exception as e:
-        completed_run = None
-        print(e)
-    try:
-        if not completed_run:
-            strava_funcs.get_strava_run_func(user, todays_run)
-    except LookupError:
-        return HttpResponseRedirect(reverse("index"))
+        job = strava_webhook.receive_event(json.loads(request.body))
+    except (ValueError, KeyError, TypeError) as e:
+        print(f"Invalid Strava event: {e}")
+        return JsonResponse({"error": "Invalid event"}, status=400)
 
-    return HttpResponseRedirect(reverse("index"))
+    return JsonResponse({"message": "Event received", "job_id": job.id if job else None})